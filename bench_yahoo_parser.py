@@ -0,0 +1,90 @@
+"""
+Yahoo 大戶籌碼頁解析器基準測試
+
+以專案內附的 yahoo.html（2330 major-holders 頁面）比較：
+- 內嵌 JSON 解析（parse_yahoo_holders 的主要路徑）
+- DOM 走訪（html.parser / lxml 備援路徑）
+
+並確認各解析方式的結果一致，內嵌 JSON 路徑至少快 MIN_SPEEDUP 倍，否則以非零狀態結束。
+
+用法：python bench_yahoo_parser.py [重複次數]
+"""
+
+import os
+import sys
+import time
+
+import server
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'yahoo.html')
+MIN_SPEEDUP = 10
+
+
+def bench(fn, html, repeat):
+    """回傳 (每次平均毫秒, 最後一次結果)"""
+    result = fn(html)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn(html)
+    return (time.perf_counter() - start) / repeat * 1000, result
+
+
+def dom_html_parser(html):
+    """原本的解析方式：BeautifulSoup html.parser 走訪 DOM"""
+    lxml, server.lxml = server.lxml, None
+    try:
+        return server._parse_yahoo_holders_dom(html)
+    finally:
+        server.lxml = lxml
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    with open(FIXTURE, encoding='utf-8') as f:
+        html = f.read()
+    print(f"fixture: {FIXTURE} ({len(html) / 1024:.0f} KB), 重複 {repeat} 次")
+
+    cases = [('embedded JSON', server._parse_yahoo_holders_json),
+             ('DOM html.parser', dom_html_parser)]
+    if server.lxml is not None:
+        cases.append(('DOM lxml', server._parse_yahoo_holders_dom))
+
+    timings = {}
+    results = {}
+    for name, fn in cases:
+        ms, rows = bench(fn, html, repeat)
+        timings[name] = ms
+        results[name] = rows
+        print(f"  {name:<16} {ms:9.3f} ms  ({len(rows or [])} 筆)")
+
+    ok = True
+    expected = results['embedded JSON']
+    if not expected:
+        print("錯誤：內嵌 JSON 未解析出任何資料")
+        ok = False
+    for name, rows in results.items():
+        if rows != expected:
+            print(f"錯誤：{name} 的結果與內嵌 JSON 不一致")
+            ok = False
+
+    speedup = timings['DOM html.parser'] / timings['embedded JSON']
+    print(f"內嵌 JSON 相對 html.parser 加速 {speedup:.0f} 倍")
+    if speedup < MIN_SPEEDUP:
+        print(f"錯誤：加速低於 {MIN_SPEEDUP} 倍")
+        ok = False
+
+    # 公開入口應走內嵌 JSON 路徑
+    if server.parse_yahoo_holders(html) != expected:
+        print("錯誤：parse_yahoo_holders 結果與內嵌 JSON 不一致")
+        ok = False
+    # 內嵌 JSON 不存在時應退回 DOM
+    stripped = html.replace(server._YAHOO_HOLDERS_KEY, '"majorHoldersRemoved":{"data":{"list":')
+    if server.parse_yahoo_holders(stripped) != expected:
+        print("錯誤：缺少內嵌 JSON 時 DOM 備援結果不一致")
+        ok = False
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
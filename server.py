@@ -3,11 +3,14 @@
 提供搜尋、K線、技術指標、籌碼面、基本面等 API 端點
 
 優化：
-- 統一 API 回傳格式 { status, data, message }
+- 統一 API 回傳格式 { status, data, message }（快速 JSON 編碼、gzip/brotli 壓縮、ETag 條件請求）
 - python-dotenv 管理環境變數
 - logging 取代 print
 - 股票清單記憶體快取（每日更新一次）
-- API 響應 TTL 快取（5 分鐘）
+- API 響應 LRU/TTL 快取（5 分鐘，依記憶體預算淘汰，含命中統計）
+- 個股日K本地 SQLite 歷史庫（增量同步，只補抓缺少的日期）
+- 全市場日K整批匯入，選股與排行共用價格面板
+- 向量化選股引擎（stocks × days 矩陣一次計算技術面條件）
 - CSV 匯出端點
 """
 
@@ -16,18 +19,51 @@ import os
 import sys
 import io
 import json
+import gzip
+import hashlib
+import shutil
+import sqlite3
+import time
+import bisect
+import re
+import contextvars
+import heapq
+import zlib
+import queue
+import uuid
 from datetime import datetime, timedelta, time as dtime
 from threading import Lock
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait as wait_futures
+from contextlib import contextmanager
 
 from flask import Flask, jsonify, request, send_from_directory, Response
 from flask_cors import CORS
 import requests as req
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pandas as pd
 import numpy as np
 import ta
-import urllib.request
+from urllib.parse import urlsplit
 from bs4 import BeautifulSoup
 
+try:
+    import orjson
+except ImportError:
+    orjson = None  # 未安裝時改用標準 json
+
+try:
+    import brotli
+except ImportError:
+    brotli = None  # 未安裝時只提供 gzip 壓縮
+
+try:
+    import lxml
+except ImportError:
+    lxml = None  # 未安裝時 BeautifulSoup 改用內建 html.parser
+
 # 載入 .env 環境變數
 try:
     from dotenv import load_dotenv
@@ -62,11 +98,99 @@ FINMIND_TOKEN = os.environ.get("FINMIND_TOKEN", "")
 # 統一回傳格式
 # ============================================================
 
+def _json_default(obj):
+    """JSON 編碼時處理 numpy / pandas / datetime 等非標準型別"""
+    if isinstance(obj, np.integer):
+        return int(obj)
+    if isinstance(obj, np.floating):
+        return float(obj)
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, (datetime, pd.Timestamp)):
+        return obj.isoformat()
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"無法序列化型別 {type(obj).__name__}")
+
+
+def json_dumps(obj):
+    """編碼為 UTF-8 JSON bytes（有 orjson 時使用 orjson，NaN 會輸出為 null）"""
+    if orjson is not None:
+        return orjson.dumps(obj, default=_json_default,
+                            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'), default=_json_default).encode('utf-8')
+
+
+# 小於此大小的回應不壓縮（壓縮收益小於 CPU 成本）
+COMPRESS_MIN_BYTES = 1024
+
+
+def _negotiate_encoding():
+    """依 Accept-Encoding 選擇壓縮方式：br 優先，其次 gzip"""
+    accept = request.accept_encodings
+    if brotli is not None and accept['br']:
+        return 'br'
+    if accept['gzip']:
+        return 'gzip'
+    return None
+
+
+def json_response(obj):
+    """輸出 JSON 回應：強 ETag（內容雜湊）+ If-None-Match 回 304 + gzip / brotli 壓縮"""
+    body = json_dumps(obj)
+    encoding = _negotiate_encoding() if len(body) >= COMPRESS_MIN_BYTES else None
+    # 壓縮後為不同的表示法，ETag 需加上編碼後綴以維持強驗證語意
+    etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+    if encoding:
+        etag = f"{etag}-{encoding}"
+
+    if request.method in ('GET', 'HEAD') and request.if_none_match.contains(etag):
+        resp = Response(status=304)
+    else:
+        if encoding == 'br':
+            body = brotli.compress(body, quality=4)
+        elif encoding == 'gzip':
+            body = gzip.compress(body, compresslevel=5)
+        resp = Response(body, mimetype='application/json')
+        if encoding:
+            resp.headers['Content-Encoding'] = encoding
+    resp.set_etag(etag)
+    resp.headers['Vary'] = 'Accept-Encoding'
+    # 每次使用前都向伺服器驗證，內容未變時只需回 304
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
+
+def ndjson_response(rows):
+    """串流輸出 NDJSON（每個物件一行）；gzip 時逐行 sync flush，讓前端能立即解出已送達的行"""
+    encoding = 'gzip' if request.accept_encodings['gzip'] else None
+
+    def generate():
+        z = zlib.compressobj(5, zlib.DEFLATED, 31) if encoding else None
+        for row in rows:
+            line = json_dumps(row) + b'\n'
+            if z is None:
+                yield line
+            else:
+                yield z.compress(line) + z.flush(zlib.Z_SYNC_FLUSH)
+        if z is not None:
+            yield z.flush()
+
+    resp = Response(generate(), mimetype='application/x-ndjson')
+    if encoding:
+        resp.headers['Content-Encoding'] = encoding
+    resp.headers['Vary'] = 'Accept-Encoding'
+    resp.headers['Cache-Control'] = 'no-cache'
+    # 避免反向代理緩衝整個串流
+    resp.headers['X-Accel-Buffering'] = 'no'
+    return resp
+
+
 def api_ok(data, **extra):
     """回傳成功格式"""
     result = {"status": "ok", "data": data}
     result.update(extra)
-    return jsonify(result)
+    return json_response(result)
 
 
 def api_error(message, status_code=400):
@@ -78,71 +202,419 @@ def api_error(message, status_code=400):
 # 快取系統
 # ============================================================
 
-class SimpleCache:
-    """簡易 TTL 快取"""
-    def __init__(self, maxsize=200, ttl=300):
-        self._cache = {}
-        self._maxsize = maxsize
+def _estimate_size(value, _depth=0):
+    """粗估物件佔用的位元組數（大型 list 以前幾筆抽樣推估，避免每次寫入都走訪全部資料）"""
+    size = sys.getsizeof(value)
+    if _depth > 4:
+        return size
+    if isinstance(value, dict):
+        for k, v in value.items():
+            size += _estimate_size(k, _depth + 1) + _estimate_size(v, _depth + 1)
+    elif isinstance(value, (list, tuple)):
+        n = len(value)
+        if n:
+            sample = value[:8]
+            per_item = sum(_estimate_size(v, _depth + 1) for v in sample) / len(sample)
+            size += int(per_item * n)
+    elif isinstance(value, np.ndarray):
+        size += value.nbytes
+    return size
+
+
+class LRUCache:
+    """LRU + TTL 快取
+
+    - OrderedDict 實作，get/set 皆為 O(1)
+    - 過期判斷使用 time.monotonic()，不受系統校時影響；過期項目保留至被淘汰，可用 peek_stale 取用
+    - 容量以估算位元組數計算，超過記憶體預算時淘汰最久未使用的項目
+    - 記錄命中 / 未命中 / 淘汰次數，供 /api/cache/stats 觀察
+    """
+    registry = {}
+
+    def __init__(self, name, max_bytes, ttl=300):
+        self.name = name
+        self._data = OrderedDict()  # key -> (value, expires_at, size)
+        self._max_bytes = int(max_bytes)
         self._ttl = ttl
+        self._bytes = 0
         self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        LRUCache.registry[name] = self
 
     def get(self, key):
         with self._lock:
-            if key in self._cache:
-                value, ts = self._cache[key]
-                if (datetime.now() - ts).total_seconds() < self._ttl:
-                    return value
-                del self._cache[key]
-            return None
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            value, expires_at, size = item
+            if time.monotonic() >= expires_at:
+                # 過期項目保留到被 LRU 淘汰或覆寫為止，供 peek_stale 在上游不可用時降級使用
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        size = _estimate_size(key) + _estimate_size(value)
+        if size > self._max_bytes:
+            logger.warning("快取 [%s] 單筆資料 %d bytes 超過預算，略過: %s", self.name, size, key)
+            return
+        expires_at = time.monotonic() + (self._ttl if ttl is None else ttl)
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._data[key] = (value, expires_at, size)
+            self._bytes += size
+            while self._bytes > self._max_bytes:
+                _, (_, _, evicted_size) = self._data.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def peek_stale(self, key):
+        """取得項目（即使已過期），不影響 LRU 順序與命中統計；不存在時回傳 None"""
+        with self._lock:
+            item = self._data.get(key)
+            return item[0] if item is not None else None
+
+    def delete(self, key):
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
 
-    def set(self, key, value):
+    def stats(self):
         with self._lock:
-            # 超過上限時清除最舊的
-            if len(self._cache) >= self._maxsize:
-                oldest = min(self._cache, key=lambda k: self._cache[k][1])
-                del self._cache[oldest]
-            self._cache[key] = (value, datetime.now())
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._data),
+                "bytes": self._bytes,
+                "max_bytes": self._max_bytes,
+                "ttl": self._ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+def _cache_budget(name, default_mb):
+    """各快取的記憶體預算（MB），可用環境變數 CACHE_<NAME>_MB 覆寫"""
+    mb = os.environ.get(f"CACHE_{name.upper()}_MB") or default_mb
+    return float(mb) * 1024 * 1024
+
 
 # API 快取（5 分鐘 TTL）
-api_cache = SimpleCache(maxsize=200, ttl=300)
+api_cache = LRUCache("api", max_bytes=_cache_budget("api", 128), ttl=300)
 
 # 即時報價快取（10 秒 TTL）
-realtime_cache = SimpleCache(maxsize=50, ttl=10)
+realtime_cache = LRUCache("realtime", max_bytes=_cache_budget("realtime", 4), ttl=10)
 
 # 股票清單快取（每日更新）
-_stock_list_cache = {"data": None, "timestamp": None, "df": None}
-_stock_list_lock = Lock()
-
 # Yahoo 籌碼獨立快取（1 天 TTL）
-yahoo_cache = SimpleCache(maxsize=100, ttl=86400)
+yahoo_cache = LRUCache("yahoo", max_bytes=_cache_budget("yahoo", 16), ttl=86400)
 
 # 神秘金字塔籌碼快取（1 天 TTL）
-norway_cache = SimpleCache(maxsize=100, ttl=86400)
+norway_cache = LRUCache("norway", max_bytes=_cache_budget("norway", 16), ttl=86400)
+
+# 預熱工作寫入的快取保留到此時間（epoch 秒）為止；None 時使用各快取的預設 TTL
+_cache_hold_until = contextvars.ContextVar("cache_hold_until", default=None)
+
+
+def held_ttl():
+    """目前執行緒寫入快取時使用的 TTL：預熱期間延長到下一次盤後資料發布，其他情況回傳 None"""
+    until = _cache_hold_until.get()
+    return None if until is None else max(until - time.time(), 0)
+
 
 import threading
 _in_flight = {}
 _in_flight_lock = threading.Lock()
 
 
-def get_stock_list():
-    """取得股票清單（快取版，每日更新一次）"""
-    with _stock_list_lock:
-        now = datetime.now()
-        if (_stock_list_cache["data"] and _stock_list_cache["timestamp"]
-                and (now - _stock_list_cache["timestamp"]).total_seconds() < 86400):
-            return _stock_list_cache["data"], _stock_list_cache["df"]
+# ============================================================
+# 上游 HTTP 連線池（每個主機一個 keep-alive Session + 同時請求數上限）
+# ============================================================
 
-        data = finmind_request_raw("TaiwanStockInfo")
-        if data:
-            df = pd.DataFrame(data)
+# TWSE / 神秘金字塔的 SSL 憑證在部分環境驗證失敗，以 verify=False 連線；警告只在啟動時關閉一次
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+# 各上游主機：(同時請求數上限 = 連線池大小, 失敗重試次數)
+UPSTREAM_POLICIES = {
+    'api.finmindtrade.com': (8, 2),
+    'mis.twse.com.tw': (4, 1),         # 即時報價時效短，只重試一次
+    'tw.stock.yahoo.com': (6, 2),
+    'feeds.finance.yahoo.com': (4, 1),
+    'norway.twsthr.info': (2, 1),      # 容易被擋，放慢並降低並行數
+    'smart.tdcc.com.tw': (1, 3),       # 每週一次的大檔下載，允許多重試
+}
+UPSTREAM_DEFAULT_POLICY = (4, 1)
+# 重試間隔 = backoff_factor × 2^(n-1) 秒
+UPSTREAM_BACKOFF = 0.5
+
+
+class UpstreamClient:
+    """共用的上游 HTTP 用戶端
+
+    每個主機建立一個 requests.Session 保持連線（不需每次重新 TCP / TLS 握手），連線池大小與
+    BoundedSemaphore 同時請求數上限一致，選股等大量並行請求時會排隊重用既有連線，
+    不會一次開出數百條連線。連線失敗與 429 / 5xx 回應依主機設定以指數退避重試（讀取逾時不重試）。
+    """
+
+    def __init__(self, policies, default_policy):
+        self.policies = policies
+        self.default_policy = default_policy
+        self._hosts = {}
+        self._lock = Lock()
+
+    def _for_host(self, host):
+        entry = self._hosts.get(host)
+        if entry is not None:
+            return entry
+        with self._lock:
+            entry = self._hosts.get(host)
+            if entry is None:
+                limit, retries = self.policies.get(host, self.default_policy)
+                retry = Retry(total=retries, connect=retries, read=0, status=retries,
+                              backoff_factor=UPSTREAM_BACKOFF, status_forcelist=(429, 500, 502, 503, 504),
+                              allowed_methods=frozenset({'GET'}), raise_on_status=False)
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=limit, max_retries=retry)
+                session = req.Session()
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                entry = (session, threading.BoundedSemaphore(limit))
+                self._hosts[host] = entry
+        return entry
+
+    def get(self, url, **kwargs):
+        session, slots = self._for_host(urlsplit(url).hostname)
+        with slots:
+            return session.get(url, **kwargs)
+
+
+upstream = UpstreamClient(UPSTREAM_POLICIES, UPSTREAM_DEFAULT_POLICY)
+
+
+def http_get(url, **kwargs):
+    """經由共用連線池發出 GET（參數同 requests.get）"""
+    return upstream.get(url, **kwargs)
+
+
+# ============================================================
+# 股票基本資料登錄表
+# ============================================================
+
+# 股票清單更新週期（秒）與載入失敗後的重試間隔（秒）
+STOCK_LIST_TTL = 86400
+STOCK_LIST_RETRY_SECONDS = 60
+
+
+class _StockSnapshot:
+    """某一版股票清單建好的查詢表（建立後不再修改，可在多執行緒間直接共用）"""
+
+    def __init__(self, data):
+        self.data = data or []
+        df = pd.DataFrame(self.data)
+        if not df.empty:
             df = df[df['type'].isin(['twse', 'tpex'])]
-            _stock_list_cache["data"] = data
-            _stock_list_cache["df"] = df
-            _stock_list_cache["timestamp"] = now
-            logger.info("股票清單已更新，共 %d 檔", len(df))
-            return data, df
+        self.df = df
+
+        self.names = {}
+        self.markets = {}
+        self.industries = {}
+        self.by_industry = {}
+        records = {}
+        if not df.empty:
+            # 同一代號可能因多個產業別出現多列：名稱 / 市場 / 產業取第一列，產業索引收錄所有列
+            for sid, name, t, ind in zip(df['stock_id'], df['stock_name'], df['type'], df['industry_category']):
+                if sid not in self.names:
+                    self.names[sid] = name
+                    self.markets[sid] = 'otc' if t == 'tpex' else 'tse'
+                    self.industries[sid] = ind
+                    records[sid] = {'stock_id': sid, 'stock_name': name, 'industry_category': ind, 'type': t}
+                if ind:
+                    self.by_industry.setdefault(ind, {})[sid] = None
+        self.by_industry = {ind: list(ids) for ind, ids in self.by_industry.items()}
+        self.search_index = StockSearchIndex(records)
+        self.directory = self._build_directory(records)
+
+    @staticmethod
+    def _build_directory(records):
+        """前端自動完成用的精簡股票目錄：產業別以索引表示，版本為內容雜湊"""
+        industries = sorted({str(r['industry_category'] or '') for r in records.values()})
+        ind_index = {ind: i for i, ind in enumerate(industries)}
+        rows = [[sid, r['stock_name'], ind_index[str(r['industry_category'] or '')], 1 if r['type'] == 'tpex' else 0]
+                for sid, r in sorted(records.items())]
+        version = hashlib.blake2b(json_dumps([industries, rows]), digest_size=8).hexdigest()
+        return {'version': version, 'fields': ['stock_id', 'stock_name', 'industry', 'otc'],
+                'industries': industries, 'rows': rows}
+
+
+class StockSearchIndex:
+    """股票搜尋索引（依相關度排序）
+
+    排序層級：代號完全相符 → 代號前綴 → 名稱前綴 → 代號 / 名稱包含（2 字 n-gram 倒排索引）→ 產業別。
+    前綴以排序陣列 + 二分搜尋查詢，包含查詢以 n-gram 交集縮小候選後再確認，皆不需掃描整張清單。
+    """
+
+    def __init__(self, records):
+        self.records = records  # stock_id -> {stock_id, stock_name, industry_category, type}
+        self.codes = sorted(records)
+        self.names = sorted((str(r['stock_name']).lower(), sid) for sid, r in records.items())
+        self.grams = {}
+        self.industries = {}
+        for sid, r in records.items():
+            text = f"{sid.lower()}\0{str(r['stock_name']).lower()}"
+            for gram in set(text[i:i + n] for n in (1, 2) for i in range(len(text) - n + 1)):
+                if '\0' not in gram:
+                    self.grams.setdefault(gram, set()).add(sid)
+            ind = r.get('industry_category')
+            if ind:
+                self.industries.setdefault(str(ind).lower(), []).append(sid)
+
+    def _contains(self, q):
+        if len(q) <= 2:
+            return self.grams.get(q, set())  # 1~2 字的 n-gram 倒排本身即為精確結果
+        postings = [self.grams.get(q[i:i + 2]) for i in range(len(q) - 1)]
+        if not all(postings):
+            return []
+        candidates = set.intersection(*sorted(postings, key=len))
+        return [sid for sid in candidates
+                if q in sid.lower() or q in str(self.records[sid]['stock_name']).lower()]
+
+    def search(self, query, limit=20):
+        q = query.strip().lower()
+        if not q:
+            return []
+        seen = {}
+
+        def add(sids):
+            for sid in sids:
+                if len(seen) >= limit:
+                    return
+                seen.setdefault(sid, None)
+
+        if q in self.records:
+            add([q])
+        i = bisect.bisect_left(self.codes, q)
+        prefix = []
+        while i < len(self.codes) and self.codes[i].startswith(q):
+            prefix.append(self.codes[i])
+            i += 1
+        add(sorted(prefix, key=lambda sid: (len(sid), sid)))
+        i = bisect.bisect_left(self.names, (q, ''))
+        prefix = []
+        while i < len(self.names) and self.names[i][0].startswith(q):
+            prefix.append(self.names[i])
+            i += 1
+        add(sid for _, sid in sorted(prefix, key=lambda t: (len(t[0]), t[1])))
+        if len(seen) < limit:
+            add(heapq.nsmallest(limit, self._contains(q),
+                                key=lambda sid: (len(self.records[sid]['stock_name']), sid)))
+        if len(seen) < limit:
+            for ind, sids in self.industries.items():
+                if q in ind:
+                    add(sids)
+        return [self.records[sid] for sid in seen]
+
+
+class StockRegistry:
+    """股票基本資料登錄表（代號 → 名稱 / 市場 / 產業，產業 → 代號）
+
+    所有查詢都是對目前快照的 dict 查表，O(1) 且不加鎖。每日更新時在背景執行緒建好新快照後
+    一次替換（雙緩衝），更新期間請求持續使用舊快照，不會被 30 秒的 FinMind 呼叫卡住。
+    只有伺服器啟動後第一次載入時必須等待。
+    """
+
+    def __init__(self, ttl=STOCK_LIST_TTL):
+        self.ttl = ttl
+        self._snapshot = None
+        self._refresh_at = 0.0
+        self._refreshing = False
+        self._lock = Lock()
+
+    def _load(self):
+        data = finmind_request_raw("TaiwanStockInfo")
+        if not data:
+            self._refresh_at = time.monotonic() + STOCK_LIST_RETRY_SECONDS
+            return False
+        snapshot = _StockSnapshot(data)
+        self._snapshot = snapshot
+        self._refresh_at = time.monotonic() + self.ttl
+        logger.info("股票清單已更新，共 %d 檔", len(snapshot.names))
+        return True
+
+    def _refresh_in_background(self):
+        try:
+            self._load()
+        except Exception as e:
+            logger.error("股票清單更新失敗: %s", e)
+            self._refresh_at = time.monotonic() + STOCK_LIST_RETRY_SECONDS
+        finally:
+            self._refreshing = False
+
+    def snapshot(self):
+        """取得目前快照；過期時在背景更新並立即回傳舊快照"""
+        snap = self._snapshot
+        if snap is None or not snap.names:
+            with self._lock:
+                # 尚無可用資料：同步載入（多個執行緒只會有一個真的呼叫 FinMind）
+                if (self._snapshot is None or not self._snapshot.names) and time.monotonic() >= self._refresh_at:
+                    self._load()
+                snap = self._snapshot
+            return snap if snap is not None else _StockSnapshot([])
+
+        if time.monotonic() >= self._refresh_at and not self._refreshing:
+            with self._lock:
+                if not self._refreshing:
+                    self._refreshing = True
+                    threading.Thread(target=self._refresh_in_background,
+                                     name="stock-registry-refresh", daemon=True).start()
+        return snap
+
+    def __contains__(self, stock_id):
+        return stock_id in self.snapshot().names
+
+    def __len__(self):
+        return len(self.snapshot().names)
+
+    def name(self, stock_id):
+        return self.snapshot().names.get(stock_id, "")
+
+    def market(self, stock_id):
+        """上市回傳 'tse'，上櫃回傳 'otc'，查無時回傳 None"""
+        return self.snapshot().markets.get(stock_id)
+
+    def industry(self, stock_id):
+        return self.snapshot().industries.get(stock_id, "")
 
-        return [], pd.DataFrame()
+    def ids_in_industry(self, industry):
+        return self.snapshot().by_industry.get(industry, [])
+
+    def industry_list(self):
+        return sorted(ind for ind in self.snapshot().by_industry if ind.strip())
+
+    def search(self, query, limit=20):
+        return self.snapshot().search_index.search(query, limit)
+
+    def directory(self):
+        return self.snapshot().directory
+
+
+stock_registry = StockRegistry()
+
+
+def get_stock_list():
+    """取得股票清單（原始資料, 上市櫃 DataFrame），資料來自登錄表目前的快照"""
+    snap = stock_registry.snapshot()
+    return snap.data, snap.df
 
 
 # ============================================================
@@ -169,8 +641,155 @@ def stock_adjusted_factors():
         return api_ok(data)
     return api_ok([])
 
-def finmind_request_raw(dataset, data_id=None, start_date=None, end_date=None):
-    """直接呼叫 FinMind API（不含快取）"""
+# ============================================================
+# FinMind 額度控管（token bucket + 優先順序）
+# ============================================================
+
+# 每小時可用請求數（免費方案約 300 次，帶 Token 約 600 次）
+FINMIND_HOURLY_QUOTA = int(os.environ.get("FINMIND_HOURLY_QUOTA") or (600 if FINMIND_TOKEN else 300))
+# 保留給互動請求的額度比例：批次工作（選股掃描、預先抓取）只能使用超過保留量的部分
+FINMIND_INTERACTIVE_RESERVE = 0.2
+# 剩餘額度低於此比例時，有過期快取就直接使用，不再消耗額度
+FINMIND_DEGRADE_RATIO = 0.1
+# 各優先順序取得額度的最長等待時間（秒）：batch 額度不足時立即失敗（有過期快取先用過期資料），
+# 不佔住執行緒等補充；需要等額度的批次工作（快取預熱）由呼叫端先以 batch_available() 等待
+FINMIND_MAX_WAIT = {'interactive': 5, 'batch': 0}
+
+
+class FinMindQuotaError(RuntimeError):
+    """FinMind 額度不足，在等待時間內無法取得請求額度"""
+
+
+class FinMindLimiter:
+    """FinMind 請求額度的 token bucket
+
+    額度以每小時配額等速補充（容量 = 每小時配額）。interactive 請求可用到 0，batch 請求
+    只能用到保留量以上，且有 interactive 請求在等待時會讓出，頁面載入不會被選股掃描餓死。
+    FinMind 回應 402（超過使用上限）時直接清空額度，等補充後再恢復。
+    """
+
+    def __init__(self, per_hour, reserve_ratio):
+        self.capacity = float(per_hour)
+        self.rate = per_hour / 3600.0
+        self.reserve = per_hour * reserve_ratio
+        self.tokens = float(per_hour)
+        self._updated = time.monotonic()
+        self._cond = threading.Condition(Lock())
+        self._waiting = {'interactive': 0, 'batch': 0}
+        self._calls = deque()  # 近一小時的請求時間
+        self.denied = 0
+        self.degraded = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        while self._calls and now - self._calls[0] > 3600:
+            self._calls.popleft()
+        return now
+
+    def acquire(self, priority='interactive'):
+        """取得一次請求額度，等待逾時則拋出 FinMindQuotaError"""
+        floor = 0.0 if priority == 'interactive' else self.reserve
+        deadline = time.monotonic() + FINMIND_MAX_WAIT.get(priority, 5)
+        with self._cond:
+            self._waiting[priority] += 1
+            try:
+                while True:
+                    now = self._refill()
+                    yield_to_interactive = priority != 'interactive' and self._waiting['interactive']
+                    if self.tokens >= floor + 1 and not yield_to_interactive:
+                        self.tokens -= 1
+                        self._calls.append(now)
+                        return
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        self.denied += 1
+                        raise FinMindQuotaError(f"FinMind 額度不足（{priority}）")
+                    needed = (floor + 1 - self.tokens) / self.rate
+                    self._cond.wait(min(max(needed, 0.05), remaining))
+            finally:
+                self._waiting[priority] -= 1
+                self._cond.notify_all()
+
+    def exhaust(self):
+        """上游回報已超過使用上限：清空額度"""
+        with self._cond:
+            self._refill()
+            self.tokens = 0.0
+
+    def note_degraded(self):
+        with self._cond:
+            self.degraded += 1
+
+    def is_low(self):
+        with self._cond:
+            self._refill()
+            return self.tokens < self.capacity * FINMIND_DEGRADE_RATIO
+
+    def batch_available(self):
+        """batch 工作目前可用的額度（扣除保留給互動請求的部分）"""
+        with self._cond:
+            self._refill()
+            return max(self.tokens - self.reserve, 0.0)
+
+    def stats(self):
+        with self._cond:
+            self._refill()
+            return {
+                "quota_per_hour": int(self.capacity),
+                "remaining": int(self.tokens),
+                "reserved_for_interactive": int(self.reserve),
+                "used_last_hour": len(self._calls),
+                "waiting": dict(self._waiting),
+                "denied": self.denied,
+                "served_stale": self.degraded,
+            }
+
+
+finmind_limiter = FinMindLimiter(FINMIND_HOURLY_QUOTA, FINMIND_INTERACTIVE_RESERVE)
+_finmind_priority = contextvars.ContextVar("finmind_priority", default="interactive")
+
+
+@contextmanager
+def finmind_priority(priority):
+    """在此區塊內（同一執行緒）發出的 FinMind 請求使用指定優先順序（interactive / batch）"""
+    token = _finmind_priority.set(priority)
+    try:
+        yield
+    finally:
+        _finmind_priority.reset(token)
+
+
+_batch_stop = contextvars.ContextVar("batch_stop", default=None)
+
+
+@contextmanager
+def stop_when(check):
+    """在此區塊內的長時間批次工作（例如全市場日K回補）定期呼叫 check()，回傳 True 時提前停止"""
+    token = _batch_stop.set(check)
+    try:
+        yield
+    finally:
+        _batch_stop.reset(token)
+
+
+def batch_stopped():
+    check = _batch_stop.get()
+    return check is not None and check()
+
+
+def run_as_batch(fn, *args, **kwargs):
+    """以 batch 優先順序執行 fn（供 ThreadPoolExecutor.submit 使用，工作執行緒不會繼承呼叫端設定）"""
+    with finmind_priority('batch'):
+        return fn(*args, **kwargs)
+
+
+def finmind_request_raw(dataset, data_id=None, start_date=None, end_date=None, raise_errors=False):
+    """直接呼叫 FinMind API（不含快取）
+
+    raise_errors=True 時連線或格式錯誤會直接拋出，讓呼叫端區分「查無資料」與「請求失敗」
+    """
     params = {"dataset": dataset}
     if data_id:
         params["data_id"] = data_id
@@ -184,67 +803,883 @@ def finmind_request_raw(dataset, data_id=None, start_date=None, end_date=None):
         headers["Authorization"] = f"Bearer {FINMIND_TOKEN}"
 
     try:
-        resp = req.get(FINMIND_API_URL, params=params, headers=headers, timeout=30)
+        finmind_limiter.acquire(_finmind_priority.get())
+        resp = http_get(FINMIND_API_URL, params=params, headers=headers, timeout=30)
+        if resp.status_code == 402:
+            finmind_limiter.exhaust()
         resp.raise_for_status()
         data = resp.json()
         if data.get("msg") == "success" and data.get("data"):
             return data["data"]
+        if raise_errors and data.get("msg") != "success":
+            raise RuntimeError(data.get("msg") or "FinMind 回應格式錯誤")
         return []
     except Exception as e:
         logger.error("FinMind API 錯誤 [%s]: %s", dataset, e)
+        if raise_errors:
+            raise
         return []
 
 
-def finmind_request(dataset, data_id=None, start_date=None, end_date=None):
-    """帶快取與去重 (Cache Stampede Protection) 的 FinMind API 請求"""
-    cache_key = f"{dataset}:{data_id}:{start_date}:{end_date}"
-    cached = api_cache.get(cache_key)
-    if cached is not None:
-        return cached
+def _single_flight(key, fn):
+    """同一個 key 同時只讓一個執行緒執行 fn，其餘執行緒等待並共用結果
 
+    fn 拋出例外時，執行 fn 的執行緒照常拋出；等待中的執行緒沒有結果可共用，回傳 None。
+    """
+    priority = _finmind_priority.get()
     with _in_flight_lock:
-        if cache_key in _in_flight:
-            event, result_box = _in_flight[cache_key]
-            is_fetching = False
+        if key in _in_flight:
+            event, result_box, leader_priority = _in_flight[key]
+            is_leader = False
         else:
             event = threading.Event()
             result_box = []
-            _in_flight[cache_key] = (event, result_box)
-            is_fetching = True
+            _in_flight[key] = (event, result_box, priority)
+            is_leader = True
+
+    if not is_leader and priority == 'interactive' and leader_priority != 'interactive':
+        # 頁面載入不等 batch 工作（可能正在等額度）：互動請求之間另行去重後自己抓取
+        return _single_flight(('interactive', key), fn)
 
-    if is_fetching:
+    if is_leader:
         try:
-            data = finmind_request_raw(dataset, data_id, start_date, end_date)
-            result_box.append(data)
-            if data:
-                api_cache.set(cache_key, data)
+            result = fn()
+            result_box.append(result)
         finally:
             with _in_flight_lock:
-                del _in_flight[cache_key]
+                del _in_flight[key]
             event.set()
-    else:
-        # 等待另一個 Thread 取回資料
-        event.wait()
-        data = result_box[0] if result_box else []
+        return result
+
+    # 等待另一個 Thread 取回資料
+    event.wait()
+    return result_box[0] if result_box else None
+
+
+def finmind_request(dataset, data_id=None, start_date=None, end_date=None):
+    """帶快取與去重 (Cache Stampede Protection) 的 FinMind API 請求，額度不足時降級使用過期快取"""
+    # 尚未發布的日期不會有資料：結束日截到已發布的最後一天，隔天開盤前的請求可共用前一晚的快取
+    published = published_through()
+    if end_date and end_date > published:
+        end_date = published
+    cache_key = f"{dataset}:{data_id}:{start_date}:{end_date}"
+    cached = api_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    # 額度將盡（或 batch 工作已用完可用額度）時，有過期快取就先用過期資料
+    batch = _finmind_priority.get() == 'batch'
+    if finmind_limiter.is_low() or (batch and finmind_limiter.batch_available() < 1):
+        stale = api_cache.peek_stale(cache_key)
+        if stale is not None:
+            finmind_limiter.note_degraded()
+            return stale
+
+    def fetch():
+        if dataset == "TaiwanStockPrice" and data_id:
+            # 個股日K 先查本地歷史庫，只向 FinMind 補抓缺少的日期
+            data = get_price_history(data_id, start_date, end_date)
+        else:
+            data = finmind_request_raw(dataset, data_id, start_date, end_date)
+        if data:
+            api_cache.set(cache_key, data, ttl=held_ttl())
+        return data
+
+    data = _single_flight(cache_key, fetch)
+    if not data:
+        # 請求失敗（含額度不足）時退回過期資料，而不是回傳空結果
+        stale = api_cache.peek_stale(cache_key)
+        if stale is not None:
+            finmind_limiter.note_degraded()
+            return stale
+    return data if data is not None else []
+
+
+# 多來源並行抓取共用的執行緒池（逾時的工作會在背景跑完並寫入各自的快取）
+FANOUT_WORKERS = 32
+_fanout_pool = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix="fanout")
+
+
+def fan_out(tasks, deadline, enough=None):
+    """並行執行多個資料來源，在整體期限內收集結果
+
+    tasks: {名稱: 無參數函式}；enough(status) 回傳 True 時不再等待其餘來源。
+    回傳 (results, status)：results 只含已完成的來源；status 為每個來源的
+    ok / empty / error，以及期限到仍未完成的 timeout、提前返回而未等待的 pending。
+    """
+    # 工作執行緒沿用呼叫端的 contextvars（FinMind 優先順序、快取保留時間）
+    futures = {_fanout_pool.submit(contextvars.copy_context().run, fn): name for name, fn in tasks.items()}
+    results = {}
+    status = dict.fromkeys(tasks)
+    end = time.monotonic() + deadline
+    pending = set(futures)
+    early = False
+    while pending:
+        remaining = end - time.monotonic()
+        if remaining <= 0:
+            break
+        done, pending = wait_futures(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+        for f in done:
+            name = futures[f]
+            try:
+                results[name] = f.result()
+                status[name] = 'ok' if results[name] else 'empty'
+            except Exception as e:
+                logger.warning("資料來源 %s 失敗: %s", name, e)
+                status[name] = 'error'
+        if pending and enough is not None and enough(status):
+            early = True
+            break
+    for f in pending:
+        status[futures[f]] = 'pending' if early else 'timeout'
+    return results, status
+
+
+# ============================================================
+# 本地日K歷史庫（SQLite，增量同步）
+# ============================================================
+
+PRICE_DB_PATH = os.environ.get("PRICE_DB_PATH") or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "data", "price_history.sqlite3")
+
+# FinMind 收盤資料約於此時間後發布，之前只同步到前一個交易日
+FINMIND_PUBLISH_TIME = dtime(14, 30)
+# 發布時間後若當日K棒尚未出現，最短隔多久再向 FinMind 確認一次（秒）
+PRICE_RECHECK_SECONDS = 600
+
+PRICE_COLUMNS = ('date', 'stock_id', 'Trading_Volume', 'Trading_money', 'open', 'max',
+                 'min', 'close', 'spread', 'Trading_turnover')
 
-    return data
 
+class PriceHistoryStore:
+    """日K永久儲存（每檔記錄已同步的日期區間，重啟後不需重新下載）"""
 
-def get_default_dates(months=6):
-    """取得預設日期區間"""
-    end = datetime.now()
+    def __init__(self, path):
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS price_bars (
+                    stock_id TEXT NOT NULL,
+                    date TEXT NOT NULL,
+                    Trading_Volume INTEGER,
+                    Trading_money INTEGER,
+                    open REAL, max REAL, min REAL, close REAL,
+                    spread REAL,
+                    Trading_turnover INTEGER,
+                    PRIMARY KEY (stock_id, date)
+                ) WITHOUT ROWID
+            """)
+            # first_date ~ synced_through 之間的日期都已向 FinMind 確認過（含休市日）
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS price_sync (
+                    stock_id TEXT PRIMARY KEY,
+                    first_date TEXT NOT NULL,
+                    synced_through TEXT NOT NULL,
+                    checked_at REAL NOT NULL
+                )
+            """)
+            # 全市場整批匯入紀錄：該日所有個股K棒都已寫入
+            # bar_count=0 只代表整批查詢為空（可能尚未發布），需記錄於 market_closed 才視為休市
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS market_sync (
+                    date TEXT PRIMARY KEY,
+                    bar_count INTEGER NOT NULL,
+                    checked_at REAL NOT NULL
+                )
+            """)
+            # 已確認休市的平日
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS market_closed (
+                    date TEXT PRIMARY KEY
+                )
+            """)
+            self._conn.commit()
+
+    def coverage(self, stock_id):
+        """回傳 (first_date, synced_through, checked_at)，尚未同步過則為 None"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT first_date, synced_through, checked_at FROM price_sync WHERE stock_id = ?",
+                (stock_id,)).fetchone()
+
+    def read(self, stock_id, start_date, end_date):
+        cols = ', '.join(PRICE_COLUMNS)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {cols} FROM price_bars WHERE stock_id = ? AND date >= ? AND date <= ? ORDER BY date",
+                (stock_id, start_date, end_date)).fetchall()
+        return [dict(zip(PRICE_COLUMNS, r)) for r in rows]
+
+    def write(self, stock_id, rows, first_date, synced_through):
+        """寫入K棒並擴展同步區間"""
+        values = [tuple(r.get(c) if c != 'stock_id' else stock_id for c in PRICE_COLUMNS)
+                  for r in rows if r.get('date')]
+        placeholders = ', '.join('?' * len(PRICE_COLUMNS))
+        with self._lock:
+            if values:
+                self._conn.executemany(
+                    f"INSERT OR REPLACE INTO price_bars ({', '.join(PRICE_COLUMNS)}) VALUES ({placeholders})",
+                    values)
+            self._conn.execute("""
+                INSERT INTO price_sync (stock_id, first_date, synced_through, checked_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(stock_id) DO UPDATE SET
+                    first_date = MIN(first_date, excluded.first_date),
+                    synced_through = MAX(synced_through, excluded.synced_through),
+                    checked_at = excluded.checked_at
+            """, (stock_id, first_date, synced_through, time.time()))
+            self._conn.commit()
+
+    def write_market(self, date, rows):
+        """寫入單一交易日的全市場K棒，回傳寫入筆數"""
+        values = [tuple(r.get(c) for c in PRICE_COLUMNS)
+                  for r in rows if r.get('stock_id') and r.get('date') == date]
+        placeholders = ', '.join('?' * len(PRICE_COLUMNS))
+        with self._lock:
+            if values:
+                self._conn.executemany(
+                    f"INSERT OR REPLACE INTO price_bars ({', '.join(PRICE_COLUMNS)}) VALUES ({placeholders})",
+                    values)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO market_sync (date, bar_count, checked_at) VALUES (?, ?, ?)",
+                (date, len(values), time.time()))
+            self._conn.commit()
+        return len(values)
+
+    def market_dates(self, start_date, end_date):
+        """回傳區間內已整批匯入的日期 -> (bar_count, checked_at, 是否已確認休市)"""
+        with self._lock:
+            rows = self._conn.execute("""
+                SELECT s.date, s.bar_count, s.checked_at, c.date IS NOT NULL
+                FROM market_sync s LEFT JOIN market_closed c ON c.date = s.date
+                WHERE s.date >= ? AND s.date <= ?
+            """, (start_date, end_date)).fetchall()
+        return {d: (n, ts, bool(closed)) for d, n, ts, closed in rows}
+
+    def mark_market_closed(self, dates):
+        with self._lock:
+            self._conn.executemany("INSERT OR IGNORE INTO market_closed (date) VALUES (?)",
+                                   [(d,) for d in dates])
+            self._conn.commit()
+
+    def read_panel(self, start_date, end_date, stock_ids=None):
+        """一次讀出區間內多檔（或全部）個股的K棒，依 stock_id、date 排序"""
+        cols = ', '.join(PRICE_COLUMNS)
+        sql = f"SELECT {cols} FROM price_bars WHERE date >= ? AND date <= ?"
+        params = [start_date, end_date]
+        if stock_ids is not None:
+            sql += f" AND stock_id IN ({', '.join('?' * len(stock_ids))})"
+            params.extend(stock_ids)
+        with self._lock:
+            return self._conn.execute(sql + " ORDER BY stock_id, date", params).fetchall()
+
+
+price_store = PriceHistoryStore(PRICE_DB_PATH)
+
+_price_sync_locks = {}
+_price_sync_locks_guard = Lock()
+
+
+def _get_price_sync_lock(stock_id):
+    """同一檔股票同時只允許一個執行緒向 FinMind 補資料"""
+    with _price_sync_locks_guard:
+        lock = _price_sync_locks.get(stock_id)
+        if lock is None:
+            lock = _price_sync_locks[stock_id] = Lock()
+        return lock
+
+
+def _price_sync_cutoff():
+    """目前可向 FinMind 要求的最後日期（收盤資料發布前只到前一日）"""
+    now = datetime.now()
+    if now.weekday() < 5 and now.time() < FINMIND_PUBLISH_TIME:
+        return (now - timedelta(days=1)).strftime("%Y-%m-%d")
+    return now.strftime("%Y-%m-%d")
+
+
+def published_through(now=None):
+    """FinMind 日資料已發布到哪一天：平日發布時間後為當天，否則為前一個平日"""
+    now = now or datetime.now()
+    d = now.date()
+    if d.weekday() >= 5 or now.time() < FINMIND_PUBLISH_TIME:
+        d -= timedelta(days=1)
+        while d.weekday() >= 5:
+            d -= timedelta(days=1)
+    return d.strftime("%Y-%m-%d")
+
+
+def _shift_date(date_str, days):
+    return (datetime.strptime(date_str, "%Y-%m-%d") + timedelta(days=days)).strftime("%Y-%m-%d")
+
+
+def _sync_price_segment(stock_id, seg_start, seg_end):
+    """向 FinMind 抓取 [seg_start, seg_end] 並寫入歷史庫，失敗時不更新同步區間"""
+    rows = finmind_request_raw("TaiwanStockPrice", data_id=stock_id,
+                               start_date=seg_start, end_date=seg_end, raise_errors=True)
+    through = seg_end
+    today = datetime.now()
+    if seg_end >= today.strftime("%Y-%m-%d") and today.weekday() < 5:
+        # 當日K棒若尚未發布，只標記同步到前一日，之後再補
+        if not any(r.get('date') == seg_end for r in rows):
+            through = _shift_date(seg_end, -1)
+    price_store.write(stock_id, rows, seg_start, max(through, _shift_date(seg_start, -1)))
+    logger.info("日K歷史庫同步 %s %s~%s，共 %d 筆", stock_id, seg_start, seg_end, len(rows))
+
+
+def get_price_history(stock_id, start_date=None, end_date=None):
+    """取得個股日K：優先讀本地歷史庫，只補抓最後一根K棒之後（或更早）的缺口"""
+    today = datetime.now().strftime("%Y-%m-%d")
+    end_date = min(end_date or today, today)
+    start_date = start_date or _shift_date(end_date, -365)
+    if start_date > end_date:
+        return []
+
+    with _get_price_sync_lock(stock_id):
+        cutoff = min(end_date, _price_sync_cutoff())
+        cov = price_store.coverage(stock_id)
+        segments = []
+        if cov is None:
+            segments.append((start_date, cutoff))
+        else:
+            first_date, synced_through, checked_at = cov
+            if start_date < first_date:
+                segments.append((start_date, _shift_date(first_date, -1)))
+            if cutoff > synced_through:
+                recently_checked = (time.time() - checked_at) < PRICE_RECHECK_SECONDS
+                # 只缺當日K棒且剛確認過時，不重複打 FinMind
+                if not (recently_checked and _shift_date(synced_through, 1) == cutoff == today):
+                    segments.append((_shift_date(synced_through, 1), cutoff))
+
+        for seg_start, seg_end in segments:
+            if seg_start > seg_end:
+                continue
+            # 已由全市場整批匯入涵蓋的尾段日期不必再逐檔抓取
+            fetch_end = _market_uncovered_end(seg_start, seg_end)
+            try:
+                if fetch_end >= seg_start:
+                    _sync_price_segment(stock_id, seg_start, fetch_end)
+                if fetch_end < seg_end:
+                    price_store.write(stock_id, [], seg_start, seg_end)
+            except Exception as e:
+                # 同步失敗時仍回傳本地已有的資料
+                logger.warning("日K歷史庫同步失敗 %s %s~%s: %s", stock_id, seg_start, seg_end, e)
+
+    return price_store.read(stock_id, start_date, end_date)
+
+
+# ============================================================
+# 全市場日K整批匯入與價格面板
+# ============================================================
+
+# 選股 / 排行使用的面板回溯天數（MA20、MACD 預熱）
+PANEL_LOOKBACK_DAYS = 120
+# 整批匯入失敗（例如 Token 等級不支援不帶 data_id 的查詢）後，隔多久再嘗試（秒）
+MARKET_BULK_RETRY_SECONDS = 3600
+# 整批查詢為空的平日，以此個股逐檔查詢確認是否休市（當日無K棒且之後的交易日有K棒）
+MARKET_REFERENCE_STOCK = '2330'
+# 請求當下最多補抓的交易日數（平日只缺最新一、兩日）；冷啟動等較長的缺口改由背景執行緒回補
+MARKET_SYNC_INLINE_DAYS = 3
+
+_market_sync_lock = Lock()
+_market_bulk_state = {"unavailable_until": 0, "backfilling": False}
+_panel_cache = {"key": None, "panel": None}
+_panel_lock = Lock()
+
+
+def _weekdays(start_date, end_date):
+    """區間內的週一~週五日期字串"""
+    days = []
+    d = datetime.strptime(start_date, "%Y-%m-%d")
+    end = datetime.strptime(end_date, "%Y-%m-%d")
+    while d <= end:
+        if d.weekday() < 5:
+            days.append(d.strftime("%Y-%m-%d"))
+        d += timedelta(days=1)
+    return days
+
+
+def _market_covered(info):
+    """整批匯入已涵蓋該日：有K棒，或整批查詢為空且已確認休市"""
+    return info is not None and (info[0] > 0 or info[2])
+
+
+def _market_uncovered_end(start_date, end_date):
+    """由 end_date 往前略過已整批匯入（或週末、已確認休市）的日期，回傳仍需逐檔抓取的最後一天
+
+    整批查詢為空但未確認休市的日期不算涵蓋，個股的同步區間才不會越過可能尚未發布的K棒
+    """
+    synced = price_store.market_dates(start_date, end_date)
+    d = end_date
+    while d >= start_date:
+        is_weekend = datetime.strptime(d, "%Y-%m-%d").weekday() >= 5
+        if not (is_weekend or _market_covered(synced.get(d))):
+            break
+        d = _shift_date(d, -1)
+    return d
+
+
+def _confirm_market_closed(dates, end_date):
+    """整批查詢為空的日期逐檔查參考個股確認：當日無K棒、之後卻有K棒才記為休市
+
+    參考個股當日有K棒代表整批資料只是尚未發布；之後也沒有K棒則仍無法判斷，兩者都留待下次重新查詢
+    """
+    try:
+        rows = finmind_request_raw("TaiwanStockPrice", data_id=MARKET_REFERENCE_STOCK,
+                                   start_date=min(dates), end_date=end_date, raise_errors=True)
+    except Exception as e:
+        logger.warning("全市場日K休市確認失敗 %s: %s", dates, e)
+        return
+    traded = {r.get('date') for r in rows}
+    last = max(traded, default='')
+    closed = [d for d in dates if d not in traded and d < last]
+    if closed:
+        price_store.mark_market_closed(closed)
+        logger.info("全市場日K確認休市：%s", ', '.join(closed))
+
+
+def sync_market_bars(start_date, end_date=None, max_requests=None, blocking=True):
+    """整批匯入全市場日K：每個交易日只發一次 FinMind 請求（不帶 data_id）
+
+    回傳 True 代表區間內每個交易日都已匯入；整批查詢不可用時回傳 False，由呼叫端改走逐檔查詢。
+    缺少的交易日超過 max_requests，或 blocking=False 而另一個執行緒正在匯入時，不發請求直接回傳 False
+    """
+    if time.time() < _market_bulk_state["unavailable_until"]:
+        return False
+    if not _market_sync_lock.acquire(blocking=blocking):
+        return False
+
+    try:
+        today = datetime.now().strftime("%Y-%m-%d")
+        cutoff = min(end_date or today, _price_sync_cutoff())
+        synced = price_store.market_dates(start_date, cutoff)
+        now = time.time()
+        missing = []
+        for d in _weekdays(start_date, cutoff):
+            info = synced.get(d)
+            # 整批查詢為空且未確認休市的日期（不論是否已過當日）每隔一段時間重新查詢
+            if not (_market_covered(info) or (info and now - info[1] < PRICE_RECHECK_SECONDS)):
+                missing.append(d)
+        if max_requests is not None and len(missing) > max_requests:
+            return False
+        fetched = 0
+        empty = []
+        for d in missing:
+            if batch_stopped():
+                logger.info("全市場日K整批匯入中止（發起的工作已取消）[%s]", d)
+                return False
+            try:
+                rows = finmind_request_raw("TaiwanStockPrice", start_date=d, end_date=d, raise_errors=True)
+            except FinMindQuotaError as e:
+                logger.warning("全市場日K整批匯入暫停 [%s]: %s", d, e)
+                return False
+            except Exception as e:
+                logger.warning("全市場日K整批匯入失敗 [%s]，改用逐檔查詢: %s", d, e)
+                _market_bulk_state["unavailable_until"] = time.time() + MARKET_BULK_RETRY_SECONDS
+                return False
+            fetched += 1
+            if not price_store.write_market(d, rows):
+                empty.append(d)
+        if empty:
+            _confirm_market_closed(empty, cutoff)
+        if fetched:
+            logger.info("全市場日K整批匯入 %s~%s，共 %d 個交易日請求", start_date, cutoff, fetched)
+        return True
+    finally:
+        _market_sync_lock.release()
+
+
+def _start_market_backfill(start_date, end_date):
+    """在背景執行緒（batch 優先順序）回補較長的缺口；回補期間呼叫端改走逐檔查詢，不等候匯入"""
+    if _market_bulk_state["backfilling"] or time.time() < _market_bulk_state["unavailable_until"]:
+        return
+
+    def run():
+        try:
+            with finmind_priority('batch'):
+                sync_market_bars(start_date, end_date)
+        except Exception as e:
+            logger.warning("全市場日K背景回補失敗: %s", e)
+        finally:
+            _market_bulk_state["backfilling"] = False
+
+    _market_bulk_state["backfilling"] = True
+    threading.Thread(target=run, name="market-backfill", daemon=True).start()
+
+
+class PricePanel:
+    """全市場日K面板：每檔股票一組依日期排序的 numpy 欄位，供選股與排行共用"""
+
+    FIELDS = ('open', 'max', 'min', 'close', 'Trading_Volume')
+
+    def __init__(self, rows, start_date, end_date):
+        self.start_date = start_date
+        self.end_date = end_date
+        self.series = {}
+        if not rows:
+            self.last_date = None
+            return
+        cols = list(zip(*rows))
+        col_idx = {c: i for i, c in enumerate(PRICE_COLUMNS)}
+        ids = np.array(cols[col_idx['stock_id']])
+        dates = np.array(cols[col_idx['date']])
+        values = {f: np.array(cols[col_idx[f]], dtype=float) for f in self.FIELDS}
+        # read_panel 已依 stock_id 排序，找出每檔的切分點
+        bounds = np.concatenate(([0], np.flatnonzero(ids[1:] != ids[:-1]) + 1, [len(ids)]))
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            entry = {'date': dates[lo:hi]}
+            entry.update({f: values[f][lo:hi] for f in self.FIELDS})
+            self.series[str(ids[lo])] = entry
+        self.last_date = max(cols[col_idx['date']])
+
+    def __contains__(self, stock_id):
+        return stock_id in self.series
+
+    def __len__(self):
+        return len(self.series)
+
+    def rows(self, stock_id):
+        """轉回與 FinMind TaiwanStockPrice 相同格式的 list[dict]"""
+        entry = self.series.get(stock_id)
+        if entry is None:
+            return []
+        out = []
+        for i, d in enumerate(entry['date']):
+            row = {'date': str(d), 'stock_id': stock_id}
+            for f in self.FIELDS:
+                row[f] = float(entry[f][i])
+            out.append(row)
+        return out
+
+    def latest_quotes(self):
+        """每檔在面板最後交易日的收盤、漲跌與成交量（停牌個股不列入）"""
+        quotes = []
+        for sid, entry in self.series.items():
+            if len(entry['date']) < 2 or entry['date'][-1] != self.last_date:
+                continue
+            close = entry['close'][-1]
+            prev = entry['close'][-2]
+            change = close - prev
+            quotes.append({
+                'stock_id': sid,
+                'date': self.last_date,
+                'close': round(float(close), 2),
+                'change': round(float(change), 2),
+                'change_pct': round(float(change / prev * 100), 2) if prev else 0,
+                'volume': int(entry['Trading_Volume'][-1] // 1000),  # 張
+            })
+        return quotes
+
+
+def get_market_panel(lookback_days=PANEL_LOOKBACK_DAYS):
+    """取得全市場價格面板（必要時先整批補齊缺少的交易日）
+
+    整批查詢不可用、缺口較長已交給背景回補，或其他請求正在匯入時回傳 None（不等候）
+    """
+    end_date = datetime.now().strftime("%Y-%m-%d")
+    start_date = _shift_date(end_date, -lookback_days)
+    if not sync_market_bars(start_date, end_date, max_requests=MARKET_SYNC_INLINE_DAYS, blocking=False):
+        _start_market_backfill(start_date, end_date)
+        return None
+
+    synced = price_store.market_dates(start_date, end_date)
+    key = (start_date, max((d for d, (n, _, _) in synced.items() if n > 0), default=None))
+    with _panel_lock:
+        if _panel_cache["key"] == key:
+            return _panel_cache["panel"]
+        panel = PricePanel(price_store.read_panel(start_date, end_date), start_date, end_date)
+        _panel_cache["key"] = key
+        _panel_cache["panel"] = panel
+        logger.info("價格面板已載入：%d 檔，%s~%s", len(panel), start_date, panel.last_date)
+        return panel
+
+
+# ============================================================
+# 集保股權分散表（TDCC）欄式儲存
+# ============================================================
+
+TDCC_OPENDATA_URL = "https://smart.tdcc.com.tw/opendata/getOD.ashx?id=1-5"
+TDCC_STORE_DIR = os.environ.get("TDCC_STORE_DIR") or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "data", "tdcc")
+# 專案內附的開放資料檔，儲存區缺少該週時先行匯入
+TDCC_SEED_FILES = ('tdcc.csv', 'tdcc_data.csv')
+
+# 持股分級 1~17（陣列欄位索引 = 分級 - 1）
+TDCC_LEVELS = 17
+TDCC_MAJOR_LEVELS = slice(11, 15)   # 分級 12~15：400 張以上
+TDCC_MAJOR_1000_LEVEL = 14          # 分級 15：1000 張以上
+TDCC_RETAIL_LEVELS = slice(0, 8)    # 分級 1~8：50 張以下
+TDCC_TOTAL_LEVEL = 16               # 分級 17：合計
+
+# 集保每週五資料日、隔日公布；最新一週早於此天數時視為過期（天）
+TDCC_STALE_DAYS = 8
+# 過期時最短隔多久再下載一次（秒）
+TDCC_RECHECK_SECONDS = 6 * 3600
+# 儲存區週數不足此值時，/api/stock/holders 仍以爬蟲補齊較早的週次
+TDCC_MIN_WEEKS = 5
+
+
+def parse_tdcc_csv(text):
+    """解析集保股權分散表 CSV → [(週日期 YYYY-MM-DD, 代號陣列, 人數 [n, 17], 股數 [n, 17])]"""
+    df = pd.read_csv(io.StringIO(text.lstrip('\ufeff')), dtype={'證券代號': str, '資料日期': str})
+    df = df.rename(columns=lambda c: c.strip())
+    df['證券代號'] = df['證券代號'].str.strip()
+    df['持股分級'] = pd.to_numeric(df['持股分級'], errors='coerce')
+    df = df[df['持股分級'].between(1, TDCC_LEVELS)]
+
+    weeks = []
+    for date, g in df.groupby('資料日期'):
+        ids, inv = np.unique(g['證券代號'].to_numpy(dtype=str), return_inverse=True)
+        levels = g['持股分級'].to_numpy(dtype=np.int64) - 1
+        holders = np.zeros((len(ids), TDCC_LEVELS), dtype=np.int64)
+        shares = np.zeros((len(ids), TDCC_LEVELS), dtype=np.int64)
+        holders[inv, levels] = pd.to_numeric(g['人數'], errors='coerce').fillna(0).to_numpy(dtype=np.int64)
+        shares[inv, levels] = pd.to_numeric(g['股數'], errors='coerce').fillna(0).to_numpy(dtype=np.int64)
+        weeks.append((f"{date[:4]}-{date[4:6]}-{date[6:8]}", ids, holders, shares))
+    return weeks
+
+
+class TdccStore:
+    """集保股權分散表的欄式儲存
+
+    每週一個目錄（data/tdcc/YYYY-MM-DD/），內含排序後的代號陣列 ids.npy 與對應的
+    人數 / 股數矩陣 holders.npy、shares.npy（每檔一列、17 個持股分級一欄）。讀取時以 mmap 載入，
+    單檔查詢只需在代號陣列上二分搜尋，不必解析 CSV 也不佔用整份資料的記憶體。
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self._weeks = {}  # date -> (ids, holders, shares)
+        self._lock = Lock()
+        self.checked_at = 0.0
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            if len(name) == 10 and os.path.exists(os.path.join(path, 'shares.npy')):
+                self._weeks[name] = self._open(path)
+
+    @staticmethod
+    def _open(path):
+        return tuple(np.load(os.path.join(path, f"{col}.npy"), mmap_mode='r')
+                     for col in ('ids', 'holders', 'shares'))
+
+    def dates(self):
+        """已儲存的週次（新 → 舊）"""
+        return sorted(self._weeks, reverse=True)
+
+    def has_week(self, date):
+        return date in self._weeks
+
+    def write_week(self, date, ids, holders, shares):
+        """寫入一週資料（先寫暫存目錄再改名，讀取端不會看到寫到一半的檔案）"""
+        final = os.path.join(self.root, date)
+        tmp = f"{final}.tmp{os.getpid()}"
+        os.makedirs(tmp, exist_ok=True)
+        np.save(os.path.join(tmp, 'ids.npy'), np.asarray(ids, dtype='<U8'))
+        np.save(os.path.join(tmp, 'holders.npy'), np.asarray(holders, dtype=np.int64))
+        np.save(os.path.join(tmp, 'shares.npy'), np.asarray(shares, dtype=np.int64))
+        with self._lock:
+            if os.path.exists(final):
+                shutil.rmtree(final)
+            os.replace(tmp, final)
+            self._weeks[date] = self._open(final)
+
+    def _row(self, date, stock_id):
+        ids = self._weeks[date][0]
+        i = int(np.searchsorted(ids, stock_id))
+        return i if i < len(ids) and ids[i] == stock_id else None
+
+    def ratios(self, date):
+        """某一週所有代號的股權分散比例（向量化），回傳 {ids, total_holders, major_ratio, major_1000_ratio, retail_ratio}"""
+        ids, holders, shares = self._weeks[date]
+        total = shares[:, TDCC_TOTAL_LEVEL].astype(float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pct = lambda part: np.where(total > 0, part / total * 100, np.nan)
+            return {
+                'ids': np.asarray(ids),
+                'total_holders': np.asarray(holders[:, TDCC_TOTAL_LEVEL]),
+                'major_ratio': pct(shares[:, TDCC_MAJOR_LEVELS].sum(axis=1)),
+                'major_1000_ratio': pct(shares[:, TDCC_MAJOR_1000_LEVEL]),
+                'retail_ratio': pct(shares[:, TDCC_RETAIL_LEVELS].sum(axis=1)),
+            }
+
+    def history(self, stock_id, limit=10):
+        """單檔近幾週的股權分散摘要（新 → 舊）"""
+        result = []
+        for date in self.dates():
+            i = self._row(date, stock_id)
+            if i is None:
+                continue
+            _, holders, shares = self._weeks[date]
+            total = int(shares[i, TDCC_TOTAL_LEVEL])
+            if total <= 0:
+                continue
+            result.append({
+                'date': date,
+                'total_holders': int(holders[i, TDCC_TOTAL_LEVEL]),
+                'major_ratio': round(float(shares[i, TDCC_MAJOR_LEVELS].sum()) / total * 100, 2),
+                'major_1000_ratio': round(float(shares[i, TDCC_MAJOR_1000_LEVEL]) / total * 100, 2),
+                'retail_ratio': round(float(shares[i, TDCC_RETAIL_LEVELS].sum()) / total * 100, 2),
+            })
+            if len(result) >= limit:
+                break
+        return result
+
+
+tdcc_store = TdccStore(TDCC_STORE_DIR)
+_tdcc_sync_lock = Lock()
+_tdcc_state = {"seeded": False, "syncing": False}
+
+
+def _ingest_tdcc_text(text):
+    """匯入一份 TDCC CSV，回傳新增的週次"""
+    added = []
+    for date, ids, holders, shares in parse_tdcc_csv(text):
+        if not tdcc_store.has_week(date):
+            tdcc_store.write_week(date, ids, holders, shares)
+            added.append(date)
+    return added
+
+
+def _seed_tdcc():
+    """匯入專案內附的 TDCC 開放資料檔（只寫入儲存區尚未有的週次）"""
+    base = os.path.dirname(os.path.abspath(__file__))
+    for name in TDCC_SEED_FILES:
+        path = os.path.join(base, name)
+        if not os.path.exists(path):
+            continue
+        try:
+            with open(path, encoding='utf-8-sig') as f:
+                added = _ingest_tdcc_text(f.read())
+            if added:
+                logger.info("已匯入 TDCC 資料檔 %s：%s", name, ', '.join(added))
+        except Exception as e:
+            logger.error("TDCC 資料檔匯入失敗 [%s]: %s", name, e)
+
+
+def sync_tdcc():
+    """下載集保開放資料的最新一週並寫入儲存區，回傳新增的週次"""
+    with _tdcc_sync_lock:
+        tdcc_store.checked_at = time.monotonic()
+        try:
+            resp = http_get(TDCC_OPENDATA_URL, headers={'User-Agent': 'Mozilla/5.0'}, timeout=60)
+            resp.raise_for_status()
+            resp.encoding = 'utf-8'
+            added = _ingest_tdcc_text(resp.text)
+        except Exception as e:
+            logger.error("TDCC 開放資料下載失敗: %s", e)
+            return []
+    if added:
+        logger.info("TDCC 股權分散表已更新：%s", ', '.join(added))
+        get_chip_deltas()  # 新週次入庫後立即算好全市場週變化
+    return added
+
+
+def tdcc_is_stale():
+    dates = tdcc_store.dates()
+    if not dates:
+        return True
+    latest = datetime.strptime(dates[0], "%Y-%m-%d")
+    return (datetime.now() - latest).days >= TDCC_STALE_DAYS
+
+
+def ensure_tdcc_fresh():
+    """首次使用時匯入內附資料檔；資料過期時在背景下載最新一週（不阻塞請求）"""
+    if not _tdcc_state["seeded"]:
+        with _tdcc_sync_lock:
+            if not _tdcc_state["seeded"]:
+                _seed_tdcc()
+                _tdcc_state["seeded"] = True
+
+    if (not tdcc_is_stale() or _tdcc_state["syncing"]
+            or time.monotonic() - tdcc_store.checked_at < TDCC_RECHECK_SECONDS):
+        return
+
+    def run():
+        try:
+            sync_tdcc()
+        finally:
+            _tdcc_state["syncing"] = False
+
+    _tdcc_state["syncing"] = True
+    threading.Thread(target=run, name="tdcc-sync", daemon=True).start()
+
+
+class ChipDeltas:
+    """全市場最近兩週的大戶（>400 張）/ 散戶（<=50 張）持股比例與週變化（兩週皆有資料的代號）"""
+
+    def __init__(self, date, prev_date, curr, prev):
+        self.date = date
+        self.prev_date = prev_date
+        ids, ci, pi = np.intersect1d(curr['ids'], prev['ids'], return_indices=True)
+        self.ids = ids
+        self.major_ratio = curr['major_ratio'][ci]
+        self.retail_ratio = curr['retail_ratio'][ci]
+        self.total_holders = curr['total_holders'][ci]
+        self.major_diff = self.major_ratio - prev['major_ratio'][pi]
+        self.retail_diff = self.retail_ratio - prev['retail_ratio'][pi]
+        self.holders_diff = self.total_holders - prev['total_holders'][pi]
+        valid = np.isfinite(self.major_diff) & np.isfinite(self.retail_diff)
+        self._index = {sid: i for i, sid in enumerate(ids.tolist()) if valid[i]}
+
+    def __contains__(self, stock_id):
+        return stock_id in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def get(self, stock_id):
+        """單檔 (大戶週變化, 散戶週變化)，無資料時回傳 None"""
+        i = self._index.get(stock_id)
+        if i is None:
+            return None
+        return float(self.major_diff[i]), float(self.retail_diff[i])
+
+    def rows(self):
+        """所有有效代號的明細（比例與變化四捨五入至小數第二位）"""
+        r2 = lambda a: np.round(a.astype(float), 2).tolist()
+        cols = (self.ids.tolist(), r2(self.major_ratio), r2(self.major_diff), r2(self.retail_ratio),
+                r2(self.retail_diff), self.total_holders.tolist(), self.holders_diff.tolist())
+        return [{
+            'stock_id': sid, 'major_ratio': mr, 'major_diff': md, 'retail_ratio': rr,
+            'retail_diff': rd, 'total_holders': int(th), 'holders_diff': int(hd),
+        } for sid, mr, md, rr, rd, th, hd in zip(*cols) if sid in self._index]
+
+
+_chip_delta_cache = {"key": None, "deltas": None}
+
+
+def get_chip_deltas():
+    """最近兩週的全市場籌碼變化（每週只計算一次，之後直接取用），週數不足時回傳 None"""
+    ensure_tdcc_fresh()
+    dates = tdcc_store.dates()
+    if len(dates) < 2:
+        return None
+    key = (dates[0], dates[1])
+    cached = _chip_delta_cache
+    if cached["key"] == key:
+        return cached["deltas"]
+    deltas = ChipDeltas(dates[0], dates[1], tdcc_store.ratios(dates[0]), tdcc_store.ratios(dates[1]))
+    _chip_delta_cache.update(key=key, deltas=deltas)
+    logger.info("籌碼週變化已計算：%s vs %s，共 %d 檔", dates[0], dates[1], len(deltas))
+    return deltas
+
+
+def get_default_dates(months=6, now=None):
+    """取得預設日期區間（以 now 為結束日，預設為今天）"""
+    end = now or datetime.now()
     start = end - timedelta(days=months * 30)
     return start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")
 
 
 def get_stock_name(stock_id):
-    """從快取中取得股票名稱"""
-    _, df = get_stock_list()
-    if df is not None and not df.empty:
-        match = df[df['stock_id'] == stock_id]
-        if not match.empty:
-            return match.iloc[0]['stock_name']
-    return ""
+    """從股票登錄表取得股票名稱"""
+    return stock_registry.name(stock_id)
 
 
 def is_trading_hours():
@@ -255,80 +1690,108 @@ def is_trading_hours():
     return dtime(9, 0) <= now.time() <= dtime(13, 30)
 
 
-def get_stock_type(stock_id):
-    """判斷股票是上市(tse)還是上櫃(otc)"""
-    _, df = get_stock_list()
-    if df is not None and not df.empty:
-        match = df[df['stock_id'] == stock_id]
-        if not match.empty:
-            t = match.iloc[0].get('type', 'twse')
-            return 'otc' if t == 'tpex' else 'tse'
-    return 'tse'  # 預設上市
-
-
-def fetch_twse_realtime(stock_id):
-    """從 TWSE/TPEX 取得盤中即時報價"""
-    cached = realtime_cache.get(f"realtime:{stock_id}")
-    if cached is not None:
-        return cached
+# 每次向 mis.twse 查詢的代號數上限（以 | 串接於 ex_ch，避免 URL 過長）
+REALTIME_BATCH_SIZE = 50
+
+
+def _parse_mis_quote(info):
+    """解析 getStockInfo.jsp msgArray 的單筆報價，無有效價格時回傳 None"""
+    # z = 最新成交價, o = 開盤, h = 最高, l = 最低, v = 累計成交量, y = 昨收
+    price = _safe_float(info.get('z'))
+    if price is None:
+        price = _safe_float(info.get('pz'))  # 試用 pz
+    if price is None:
+        # 若無最新成交價，嘗試以最佳買價第一檔作為基準
+        b_prices = info.get('b', '').split('_')
+        if b_prices and b_prices[0] and b_prices[0] != '-':
+            price = _safe_float(b_prices[0])
+    if price is None:
+        # 嘗試最佳賣價
+        a_prices = info.get('a', '').split('_')
+        if a_prices and a_prices[0] and a_prices[0] != '-':
+            price = _safe_float(a_prices[0])
+    if price is None:
+        # 沒辦法的話使用昨日收盤價
+        price = _safe_float(info.get('y'))
+
+    if price is None:
+        return None
 
-    ex = get_stock_type(stock_id)
-    url = f"https://mis.twse.com.tw/stock/api/getStockInfo.jsp?ex_ch={ex}_{stock_id}.tw&json=1&delay=0"
-    try:
-        # TWSE SSL 憑證在 Python 3.14 下驗證可能失敗，使用 verify=False 繞過
-        import urllib3
-        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-        resp = req.get(url, timeout=10, verify=False, headers={
-            'User-Agent': 'Mozilla/5.0',
-            'Referer': 'https://mis.twse.com.tw/stock/fibest.jsp'
-        })
-        resp.raise_for_status()
-        data = resp.json()
-        if not data.get('msgArray'):
-            return None
+    result = {
+        'price': price,
+        'open': _safe_float(info.get('o')) or price,
+        'high': _safe_float(info.get('h')) or price,
+        'low': _safe_float(info.get('l')) or price,
+        'volume': int(float(info.get('v', '0').replace(',', ''))) if info.get('v') else 0,
+        'yesterday_close': _safe_float(info.get('y')) or price,
+        'name': info.get('n', ''),
+        'time': info.get('t', ''),
+        'is_trading': is_trading_hours(),
+    }
+    result['change'] = round(result['price'] - result['yesterday_close'], 2)
+    yc = result['yesterday_close']
+    result['change_pct'] = round(result['change'] / yc * 100, 2) if yc else 0
+    return result
+
+
+def _mis_symbols(stock_ids):
+    """一次判斷多檔的上市/上櫃別並組成 ex_ch 代號；清單中查無的代號同時查詢 tse 與 otc"""
+    symbols = []
+    for sid in stock_ids:
+        market = stock_registry.market(sid)
+        if market is None:
+            symbols += [f"tse_{sid}.tw", f"otc_{sid}.tw"]
+        else:
+            symbols.append(f"{market}_{sid}.tw")
+    return symbols
+
+
+def fetch_twse_realtime_batch(stock_ids):
+    """批次取得多檔盤中即時報價，回傳 {stock_id: 報價}
+
+    快取中已有的代號直接使用，其餘以 | 串接成多檔查詢（每次最多 REALTIME_BATCH_SIZE 個代號），
+    回應中的每一檔都會寫入 realtime_cache。
+    """
+    results = {}
+    missing = []
+    for sid in dict.fromkeys(stock_ids):
+        cached = realtime_cache.get(f"realtime:{sid}")
+        if cached is not None:
+            results[sid] = cached
+        else:
+            missing.append(sid)
+    if not missing:
+        return results
+
+    # TWSE SSL 憑證在 Python 3.14 下驗證可能失敗，使用 verify=False 繞過
+    symbols = _mis_symbols(missing)
+    for i in range(0, len(symbols), REALTIME_BATCH_SIZE):
+        chunk = symbols[i:i + REALTIME_BATCH_SIZE]
+        url = f"https://mis.twse.com.tw/stock/api/getStockInfo.jsp?ex_ch={'|'.join(chunk)}&json=1&delay=0"
+        try:
+            resp = http_get(url, timeout=10, verify=False, headers={
+                'User-Agent': 'Mozilla/5.0',
+                'Referer': 'https://mis.twse.com.tw/stock/fibest.jsp'
+            })
+            resp.raise_for_status()
+            data = resp.json()
+        except Exception as e:
+            logger.error("TWSE 即時 API 錯誤 [%s]: %s", ','.join(chunk), e)
+            continue
 
-        info = data['msgArray'][0]
-        # z = 最新成交價, o = 開盤, h = 最高, l = 最低, v = 累計成交量, y = 昨收
-        price = _safe_float(info.get('z'))
-        if price is None:
-            price = _safe_float(info.get('pz'))  # 試用 pz
-        if price is None:
-            # 若無最新成交價，嘗試以最佳買價第一檔作為基準
-            b_prices = info.get('b', '').split('_')
-            if b_prices and b_prices[0] and b_prices[0] != '-':
-                price = _safe_float(b_prices[0])
-        if price is None:
-            # 嘗試最佳賣價
-            a_prices = info.get('a', '').split('_')
-            if a_prices and a_prices[0] and a_prices[0] != '-':
-                price = _safe_float(a_prices[0])
-        if price is None:
-            # 沒辦法的話使用昨日收盤價
-            price = _safe_float(info.get('y'))
-            
-        if price is None:
-            return None
+        for info in data.get('msgArray') or []:
+            sid = info.get('c')
+            result = _parse_mis_quote(info)
+            if not sid or result is None:
+                continue
+            realtime_cache.set(f"realtime:{sid}", result)
+            results[sid] = result
+    return results
 
-        result = {
-            'price': price,
-            'open': _safe_float(info.get('o')) or price,
-            'high': _safe_float(info.get('h')) or price,
-            'low': _safe_float(info.get('l')) or price,
-            'volume': int(float(info.get('v', '0').replace(',', ''))) if info.get('v') else 0,
-            'yesterday_close': _safe_float(info.get('y')) or price,
-            'name': info.get('n', ''),
-            'time': info.get('t', ''),
-            'is_trading': is_trading_hours(),
-        }
-        result['change'] = round(result['price'] - result['yesterday_close'], 2)
-        yc = result['yesterday_close']
-        result['change_pct'] = round(result['change'] / yc * 100, 2) if yc else 0
 
-        realtime_cache.set(f"realtime:{stock_id}", result)
-        return result
-    except Exception as e:
-        logger.error("TWSE 即時 API 錯誤 [%s]: %s", stock_id, e)
-        return None
+def fetch_twse_realtime(stock_id):
+    """從 TWSE/TPEX 取得盤中即時報價"""
+    return fetch_twse_realtime_batch([stock_id]).get(stock_id)
 
 
 def _safe_float(val):
@@ -341,6 +1804,203 @@ def _safe_float(val):
         return None
 
 
+def _json_array(values):
+    """numpy 陣列 → JSON 用 list，NaN / inf 以向量化方式轉成 None"""
+    arr = np.asarray(values)
+    if arr.dtype.kind == 'f':
+        out = arr.astype(object)
+        out[~np.isfinite(arr)] = None
+        return out.tolist()
+    if arr.dtype.kind == 'O':
+        mask = pd.isna(arr)
+        if mask.any():
+            arr = arr.copy()
+            arr[mask] = None
+    return arr.tolist()
+
+
+def _columnar(rows, drop=('stock_id',)):
+    """list[dict] → {欄位: [...]} 欄式格式，省去每列重複的鍵名（stock_id 等常數欄位不輸出）"""
+    if not rows:
+        return {}
+    df = pd.DataFrame(rows)
+    return {col: _json_array(df[col].to_numpy()) for col in df.columns if col not in drop}
+
+
+# ============================================================
+# Yahoo 大戶籌碼頁解析
+# ============================================================
+
+# 頁面內嵌的 root.App.main 狀態中，大戶持股清單的起點
+_YAHOO_HOLDERS_KEY = '"majorHolders":{"data":{"list":'
+_json_decoder = json.JSONDecoder()
+
+
+def _yahoo_number(val):
+    """Yahoo 頁面數值（可能含 % 與千分位）→ float，無效值為 0"""
+    v = _safe_float(str(val).replace('%', '')) if val is not None else None
+    return v if v is not None else 0
+
+
+def _parse_yahoo_holders_json(html):
+    """從內嵌狀態 JSON 解出大戶持股清單（只解碼該段陣列，不建立 DOM），找不到時回傳 None"""
+    i = html.find(_YAHOO_HOLDERS_KEY)
+    if i < 0:
+        return None
+    try:
+        items, _ = _json_decoder.raw_decode(html, i + len(_YAHOO_HOLDERS_KEY))
+    except ValueError:
+        return None
+
+    rows = []
+    for item in items:
+        date = str(item.get('endDate') or '')[:10]
+        if not date:
+            continue
+        rows.append({
+            'date': date,
+            'foreign_ratio': _yahoo_number(item.get('foreignHoldPercent')),
+            'major_ratio': _yahoo_number(item.get('mainHoldPercent')),
+            'director_ratio': _yahoo_number(item.get('dirSupHoldPercent')),
+            'price': _yahoo_number((item.get('quoteStats') or {}).get('closePrice')),
+        })
+    return rows
+
+
+def _parse_yahoo_holders_dom(html):
+    """以 DOM 走訪表格列解析（內嵌 JSON 改版或缺少時的備援）"""
+    soup = BeautifulSoup(html, 'lxml' if lxml is not None else 'html.parser')
+    rows = []
+    for li in soup.find_all('li', class_='List(n)'):
+        row_div = li.find('div', class_=lambda x: x and 'table-row' in x)
+        if not row_div:
+            continue
+        cols = row_div.find_all('div', recursive=False)
+        if len(cols) < 5:
+            continue
+        date = cols[0].text.strip().replace('/', '-')
+        if not date:
+            continue
+        rows.append({
+            'date': date,
+            'foreign_ratio': _yahoo_number(cols[1].text.strip()),
+            'major_ratio': _yahoo_number(cols[2].text.strip()),
+            'director_ratio': _yahoo_number(cols[3].text.strip()),
+            'price': _yahoo_number(cols[4].text.strip()),
+        })
+    return rows
+
+
+def parse_yahoo_holders(html):
+    """解析 Yahoo 大戶籌碼頁（/quote/{id}/major-holders），回傳新 → 舊的
+    [{date, foreign_ratio, major_ratio, director_ratio, price}]
+
+    優先讀取內嵌 JSON（約 0.5 ms），失敗時才走訪 DOM（數十 ms）。
+    """
+    rows = _parse_yahoo_holders_json(html)
+    if rows is None:
+        rows = _parse_yahoo_holders_dom(html)
+    return rows
+
+
+YAHOO_HOLDERS_URL = "https://tw.stock.yahoo.com/quote/{stock_id}/major-holders"
+YAHOO_HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
+YAHOO_TIMEOUT = 10
+
+
+def fetch_yahoo_holders(stock_id):
+    """取得 Yahoo 大戶籌碼（快取 1 天；同一檔同時只會有一個請求向 Yahoo 抓取）
+
+    回傳新 → 舊的 [{date, foreign_ratio, major_ratio, director_ratio, price, retail_ratio}]，
+    retail_ratio 為 100 - 大戶比例的粗估值；抓取失敗時回傳 []（不快取，下次再試）。
+    """
+    cache_key = f"yahoo_{stock_id}"
+    cached = yahoo_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    def fetch():
+        try:
+            resp = http_get(YAHOO_HOLDERS_URL.format(stock_id=stock_id), headers=YAHOO_HEADERS,
+                           timeout=YAHOO_TIMEOUT)
+            resp.raise_for_status()
+            rows = parse_yahoo_holders(resp.text)
+        except Exception as e:
+            logger.error("Yahoo 大戶籌碼 API 錯誤 [%s]: %s", stock_id, e)
+            return []
+        for row in rows:
+            # 粗估散戶比例 = 100 - 大戶比例
+            major_val = row['major_ratio']
+            row['retail_ratio'] = max(0, round(100 - major_val, 2)) if major_val > 0 else 0
+        if rows:
+            yahoo_cache.set(cache_key, rows)
+        return rows
+
+    return _single_flight(cache_key, fetch) or []
+
+
+NORWAY_HOLDERS_URL = "https://norway.twsthr.info/StockHolders.aspx?stock={stock_id}"
+NORWAY_HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'}
+NORWAY_TIMEOUT = 15
+
+
+def fetch_norway_holders(stock_id):
+    """爬取神秘金字塔股權分散（快取 1 天；同一檔同時只會有一個請求），
+    回傳新 → 舊的 [{date, total_holders, major_ratio, major_1000_ratio}]，失敗時回傳 []
+    """
+    norway_cache_key = f"norway_{stock_id}"
+    cached = norway_cache.get(norway_cache_key)
+    if cached is not None:
+        return cached
+
+    def fetch():
+        norway_data = []
+        try:
+            # 關閉 SSL 驗證以防憑證過期（警告已於啟動時關閉）
+            resp = http_get(NORWAY_HOLDERS_URL.format(stock_id=stock_id), headers=NORWAY_HEADERS,
+                            verify=False, timeout=NORWAY_TIMEOUT)
+            resp.raise_for_status()
+            soup = BeautifulSoup(resp.text, 'html.parser')
+            detail_tables = soup.find_all('table', id='Details')
+            target_table = None
+            for t in detail_tables:
+                trs = t.find_all('tr')
+                if len(trs) > 0 and '總股東' in trs[0].text:
+                    target_table = t
+                    break
+
+            if target_table:
+                trs = target_table.find_all('tr')
+                for tr in trs[1:]:  # 跳過表頭
+                    tds = tr.find_all('td')
+                    if len(tds) >= 14:
+                        date_str = tds[2].text.strip()
+                        # 確認 date_str 真的是日期格式 (YYYYMMDD)
+                        if len(date_str) == 8 and date_str.isdigit() and date_str.startswith('20'):
+                            formatted_date = f"{date_str[:4]}-{date_str[4:6]}-{date_str[6:]}"
+                            total_holders = tds[4].text.strip().replace(',', '')
+                            major_400_ratio = tds[7].text.strip()
+                            major_1000_ratio = tds[13].text.strip()
+                            try:
+                                norway_data.append({
+                                    'date': formatted_date,
+                                    'total_holders': int(total_holders) if total_holders else 0,
+                                    'major_ratio': float(major_400_ratio) if major_400_ratio else 0,
+                                    'major_1000_ratio': float(major_1000_ratio) if major_1000_ratio else 0
+                                })
+                            except ValueError:
+                                pass
+                # 只有當抓取到的資料筆數大於等於 5 筆時才進行一天長度的快取
+                # 避免因網站短暫擋 IP 或解析失敗導致將空陣列快取 24 小時
+                if norway_data and len(norway_data) >= 5:
+                    norway_cache.set(norway_cache_key, norway_data)
+        except Exception as e:
+            logger.error("神秘金字塔爬蟲 API 錯誤 [%s]: %s", stock_id, e)
+        return norway_data
+
+    return _single_flight(norway_cache_key, fetch) or []
+
+
 # ============================================================
 # 靜態頁面路由
 # ============================================================
@@ -361,27 +2021,59 @@ def stock_page():
 
 @app.route('/api/stock/search')
 def stock_search():
-    """搜尋股票 — 支援名稱或代號模糊查詢（使用快取）"""
+    """搜尋股票 — 支援名稱或代號查詢，依相關度排序（使用預建索引）"""
     query = request.args.get('q', '').strip()
     if not query:
         return api_ok([])
 
-    _, df = get_stock_list()
-    if df is None or df.empty:
+    if not len(stock_registry):
         return api_error("無法取得股票清單", 503)
 
-    mask = (
-        df['stock_id'].str.contains(query, case=False, na=False) |
-        df['stock_name'].str.contains(query, case=False, na=False)
-    )
-    results = df[mask].head(20)
+    return api_ok(stock_registry.search(query))
+
+
+# 目錄內容以版本雜湊定址，同一版本永遠不變，可讓瀏覽器長期快取
+DIRECTORY_MAX_AGE = 365 * 86400
+
+
+@app.route('/api/stock/directory/version')
+def stock_directory_version():
+    """股票目錄目前版本（前端比對本地 IndexedDB 版本，不同才重新下載）"""
+    if not len(stock_registry):
+        return api_error("無法取得股票清單", 503)
+    return api_ok({'version': stock_registry.directory()['version']})
+
 
-    return api_ok(results[['stock_id', 'stock_name', 'industry_category', 'type']].to_dict('records'))
+@app.route('/api/stock/directory')
+def stock_directory():
+    """完整上市櫃股票目錄（精簡格式，供前端本地自動完成）
+
+    rows 為 [stock_id, stock_name, industry（industries 索引）, otc（1=上櫃）]。
+    帶 v=<目前版本> 時回應可被長期快取；版本不符或未帶 v 時每次都需重新驗證。
+    """
+    if not len(stock_registry):
+        return api_error("無法取得股票清單", 503)
+    directory = stock_registry.directory()
+    resp = api_ok(directory)
+    if request.args.get('v') == directory['version']:
+        resp.headers['Cache-Control'] = f'public, max-age={DIRECTORY_MAX_AGE}, immutable'
+    return resp
 
 
 @app.route('/api/stock/realtime')
 def stock_realtime():
-    """取得盤中即時報價（TWSE/TPEX）"""
+    """取得盤中即時報價（TWSE/TPEX）
+
+    - id=2330：單檔報價
+    - ids=2330,2317,...：多檔報價 {stock_id: 報價}（以批次查詢，查無報價的代號不列出）
+    """
+    ids = request.args.get('ids', '')
+    if ids:
+        stock_ids = [s.strip() for s in ids.split(',') if s.strip()]
+        if len(stock_ids) > 200:
+            return api_error("一次最多查詢 200 檔")
+        return api_ok(fetch_twse_realtime_batch(stock_ids))
+
     stock_id = request.args.get('id', '')
     if not stock_id:
         return api_error("缺少股票代號")
@@ -393,9 +2085,127 @@ def stock_realtime():
     return api_ok(data)
 
 
+# ============================================================
+# 即時報價推播（SSE）— 單一上游輪詢，廣播給所有訂閱者
+# ============================================================
+
+# 推播輪詢間隔（秒），與 realtime_cache 的 TTL 一致
+REALTIME_STREAM_INTERVAL = 10
+# 無資料時送出心跳的間隔（秒），避免代理伺服器切斷閒置連線
+REALTIME_STREAM_KEEPALIVE = 15
+
+
+class QuoteHub:
+    """即時報價訂閱中心
+
+    每個 SSE 連線訂閱一組股票代號並取得一個佇列；背景輪詢執行緒在交易時段內每輪以
+    fetch_twse_realtime_batch 對所有訂閱代號的聯集查詢一次，只把有變動的報價推入相關佇列。
+    沒有訂閱者時輪詢執行緒自動結束，下一個訂閱者出現時再啟動。
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._subscribers = {}  # queue -> set(stock_id)
+        self._last = {}  # stock_id -> 最後推送的報價
+        self._thread = None
+
+    def subscribe(self, stock_ids):
+        q = queue.Queue(maxsize=64)
+        with self._lock:
+            self._subscribers[q] = set(stock_ids)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="quote-hub", daemon=True)
+                self._thread.start()
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subscribers.pop(q, None)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._subscribers:
+                    self._thread = None
+                    self._last.clear()
+                    return
+                symbols = set().union(*self._subscribers.values())
+            if is_trading_hours():
+                self._poll(symbols)
+            time.sleep(self.interval)
+
+    def _poll(self, symbols):
+        try:
+            quotes = fetch_twse_realtime_batch(sorted(symbols))
+        except Exception as e:
+            logger.error("即時推播輪詢失敗: %s", e)
+            return
+        changed = {sid: q for sid, q in quotes.items() if self._last.get(sid) != q}
+        if not changed:
+            return
+        self._last.update(changed)
+        with self._lock:
+            subscribers = list(self._subscribers.items())
+        for q, ids in subscribers:
+            payload = {sid: changed[sid] for sid in ids if sid in changed}
+            if not payload:
+                continue
+            try:
+                q.put_nowait(payload)
+            except queue.Full:
+                pass  # 用戶端讀取太慢時略過本輪，下一輪仍會收到最新值
+
+
+quote_hub = QuoteHub(REALTIME_STREAM_INTERVAL)
+
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json_dumps(data).decode('utf-8')}\n\n"
+
+
+@app.route('/api/stock/realtime/stream')
+def stock_realtime_stream():
+    """盤中即時報價推播（Server-Sent Events）
+
+    ids=2330,2317,...
+    - event: quote  → {stock_id: 報價}，連線時先送一次目前報價，之後只推送有變動的代號
+    - event: closed → 非交易時段，伺服器結束串流
+    """
+    stock_ids = [s.strip() for s in request.args.get('ids', request.args.get('id', '')).split(',') if s.strip()]
+    if not stock_ids:
+        return api_error("缺少股票代號")
+    if len(stock_ids) > 200:
+        return api_error("一次最多訂閱 200 檔")
+
+    def generate():
+        snapshot = fetch_twse_realtime_batch(stock_ids)
+        if snapshot:
+            yield _sse('quote', snapshot)
+        if not is_trading_hours():
+            yield _sse('closed', {'is_trading': False})
+            return
+
+        q = quote_hub.subscribe(stock_ids)
+        try:
+            while is_trading_hours():
+                try:
+                    yield _sse('quote', q.get(timeout=REALTIME_STREAM_KEEPALIVE))
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+            yield _sse('closed', {'is_trading': False})
+        finally:
+            quote_hub.unsubscribe(q)
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+
 @app.route('/api/stock/price')
 def stock_price():
-    """取得股票 K 線數據"""
+    """取得股票 K 線數據（format=columnar 時以欄式輸出）"""
     stock_id = request.args.get('id', '')
     start_date = request.args.get('start', '')
     end_date = request.args.get('end', '')
@@ -408,12 +2218,21 @@ def stock_price():
 
     data = finmind_request("TaiwanStockPrice", data_id=stock_id,
                            start_date=start_date, end_date=end_date)
-                           
+    data = build_price_rows(stock_id, data, request.args.get('realtime', '0') == '1')
+
+    # 附加股票名稱
+    name = get_stock_name(stock_id)
+
+    if request.args.get('format') == 'columnar':
+        return api_ok({"name": name, "data": _columnar(data)})
+    return api_ok({"name": name, "data": data})
+
+
+def build_price_rows(stock_id, data, use_realtime=False):
+    """過濾異常日K（停牌或收盤價為0），盤中且 use_realtime 時以即時報價取代今日K棒"""
     if data:
-        # 過濾異常資料（停牌或收盤價為0）
         data = [d for d in data if d.get('close', 0) > 0 and d.get('max', 0) > 0]
-                           
-    use_realtime = request.args.get('realtime', '0') == '1'
+
     if use_realtime and is_trading_hours() and data is not None:
         rt = fetch_twse_realtime(stock_id)
         if rt and rt.get('price'):
@@ -429,65 +2248,11 @@ def stock_price():
                 'Trading_Volume': rt['volume'],
                 'stock_id': stock_id,
             })
+    return data
 
-    # 附加股票名稱
-    name = get_stock_name(stock_id)
-
-    return api_ok({"name": name, "data": data})
-
-
-@app.route('/api/stock/chart-data')
-def stock_chart_data():
-    """合併計算技術指標與 K 線數據：RSI, MACD, KD, BB, OBV, MA, VWAP, DMI, W%R"""
-    stock_id = request.args.get('id', '')
-    start_date = request.args.get('start', '')
-    end_date = request.args.get('end', '')
-
-    if not stock_id:
-        return api_error("缺少股票代號")
-
-    if not start_date or not end_date:
-        start_date, end_date = get_default_dates(12)
-
-    # 多抓前 120 天用於指標預熱
-    warmup_start = (datetime.strptime(start_date, "%Y-%m-%d") - timedelta(days=120)).strftime("%Y-%m-%d")
-    data = finmind_request("TaiwanStockPrice", data_id=stock_id,
-                           start_date=warmup_start, end_date=end_date)
-
-    if not data:
-        return api_error("無法取得股價資料", 404)
-
-    # 過濾異常資料（停牌或收盤價為0）
-    data = [d for d in data if d.get('close', 0) > 0 and d.get('max', 0) > 0]
-
-    if not data:
-        return api_error("該區間無有效交易資料", 404)
-
-    df = pd.DataFrame(data)
-    df['date'] = pd.to_datetime(df['date'])
-    df = df.sort_values('date').reset_index(drop=True)
-
-    # realtime=1 時，合併盤中即時數據
-    use_realtime = request.args.get('realtime', '0') == '1'
-    if use_realtime and is_trading_hours():
-        rt = fetch_twse_realtime(stock_id)
-        if rt and rt.get('price'):
-            today_str = datetime.now().strftime('%Y-%m-%d')
-            # 移除可能已存在的今日資料（避免重複）
-            df = df[df['date'].dt.strftime('%Y-%m-%d') != today_str]
-            today_row = pd.DataFrame([{
-                'date': pd.Timestamp(today_str),
-                'open': rt['open'],
-                'max': rt['high'],
-                'min': rt['low'],
-                'close': rt['price'],
-                'Trading_Volume': rt['volume'] * 1000,
-                'stock_id': stock_id,
-            }])
-            df = pd.concat([df, today_row], ignore_index=True)
-            logger.info("合併盤中數據: %s close=%s vol=%s",
-                       stock_id, rt['price'], rt['volume'])
 
+def compute_chart_indicators(df):
+    """以完整日K DataFrame 計算所有技術指標（date 為字串 list，其餘為 numpy 陣列）"""
     close = df['close'].astype(float)
     high = df['max'].astype(float)
     low = df['min'].astype(float)
@@ -497,105 +2262,413 @@ def stock_chart_data():
 
     # RSI (14)
     rsi = ta.momentum.RSIIndicator(close, window=14)
-    result['rsi'] = rsi.rsi().round(2).tolist()
+    result['rsi'] = rsi.rsi().round(2).to_numpy()
 
     # MACD (12, 26, 9)
     macd = ta.trend.MACD(close, window_slow=26, window_fast=12, window_sign=9)
-    result['macd'] = macd.macd().round(2).tolist()
-    result['macd_signal'] = macd.macd_signal().round(2).tolist()
-    result['macd_histogram'] = macd.macd_diff().round(2).tolist()
+    result['macd'] = macd.macd().round(2).to_numpy()
+    result['macd_signal'] = macd.macd_signal().round(2).to_numpy()
+    result['macd_histogram'] = macd.macd_diff().round(2).to_numpy()
 
     # KD (Stochastic, 9, 3)
     stoch = ta.momentum.StochasticOscillator(high, low, close, window=9, smooth_window=3)
-    result['k'] = stoch.stoch().round(2).tolist()
-    result['d'] = stoch.stoch_signal().round(2).tolist()
+    result['k'] = stoch.stoch().round(2).to_numpy()
+    result['d'] = stoch.stoch_signal().round(2).to_numpy()
 
     # Bollinger Bands (20, 2)
     bb = ta.volatility.BollingerBands(close, window=20, window_dev=2)
-    result['bb_upper'] = bb.bollinger_hband().round(2).tolist()
-    result['bb_middle'] = bb.bollinger_mavg().round(2).tolist()
-    result['bb_lower'] = bb.bollinger_lband().round(2).tolist()
+    result['bb_upper'] = bb.bollinger_hband().round(2).to_numpy()
+    result['bb_middle'] = bb.bollinger_mavg().round(2).to_numpy()
+    result['bb_lower'] = bb.bollinger_lband().round(2).to_numpy()
 
     # OBV
     obv = ta.volume.OnBalanceVolumeIndicator(close, volume)
-    result['obv'] = obv.on_balance_volume().tolist()
+    result['obv'] = obv.on_balance_volume().to_numpy()
 
     # MA (5, 10, 20, 60, 120)
     for period in [5, 10, 20, 60, 120]:
         ma = ta.trend.SMAIndicator(close, window=period)
-        result[f'ma{period}'] = ma.sma_indicator().round(2).tolist()
+        result[f'ma{period}'] = ma.sma_indicator().round(2).to_numpy()
 
     # VWAP（20 日滾動）
     typical_price = (high + low + close) / 3
     vwap_window = 20
     vwap = (typical_price * volume).rolling(window=vwap_window, min_periods=1).sum() / \
            volume.rolling(window=vwap_window, min_periods=1).sum()
-    result['vwap'] = vwap.round(2).tolist()
+    result['vwap'] = vwap.round(2).to_numpy()
 
     # DMI (14)
     adx_ind = ta.trend.ADXIndicator(high, low, close, window=14)
-    result['adx'] = adx_ind.adx().round(2).tolist()
-    result['di_plus'] = adx_ind.adx_pos().round(2).tolist()
-    result['di_minus'] = adx_ind.adx_neg().round(2).tolist()
+    result['adx'] = adx_ind.adx().round(2).to_numpy()
+    result['di_plus'] = adx_ind.adx_pos().round(2).to_numpy()
+    result['di_minus'] = adx_ind.adx_neg().round(2).to_numpy()
 
     # Williams %R (14)
     wr = ta.momentum.WilliamsRIndicator(high, low, close, lbp=14)
-    result['williams_r'] = wr.williams_r().round(2).tolist()
+    result['williams_r'] = wr.williams_r().round(2).to_numpy()
 
     # BIAS 乖離率 (5, 10, 20)
     for period in [5, 10, 20]:
         ma = ta.trend.SMAIndicator(close, window=period).sma_indicator()
         bias = ((close - ma) / ma * 100).round(2)
-        result[f'bias{period}'] = bias.tolist()
+        result[f'bias{period}'] = bias.to_numpy()
 
     # ATR 真實波幅 (14)
     atr_ind = ta.volatility.AverageTrueRange(high, low, close, window=14)
-    result['atr'] = atr_ind.average_true_range().round(2).tolist()
+    result['atr'] = atr_ind.average_true_range().round(2).to_numpy()
+
+    return result
+
+
+def _round2(value):
+    """與 pandas Series.round(2) 相同的捨入方式"""
+    return float(np.round(value, 2))
+
+
+class IndicatorState:
+    """盤中增量指標狀態
+
+    保存截至前一交易日收盤的 EMA 累積值、滾動視窗緩衝與區間和、OBV 累計值以及 DMI/ATR 的
+    Wilder 平滑狀態。盤中新K棒到來時，每個指標只需 O(1) 就能算出當日數值，不必重算整段歷史。
+    step() 的結果與 compute_chart_indicators 在「歷史 + 當日K棒」上重算的最後一筆相同
+    （均線類數值恰好落在小數第三位為 5 時，浮點誤差可能使捨入相差 0.01）。
+    """
+
+    # 少於此K棒數時（ADX 需 2 倍視窗以上才會穩定）改回完整重算
+    MIN_BARS = 60
+    MA_PERIODS = (5, 10, 20, 60, 120)
+
+    def __init__(self, df):
+        close = df['close'].astype(float)
+        high = df['max'].astype(float)
+        low = df['min'].astype(float)
+        volume = df['Trading_Volume'].astype(float)
+
+        self.count = len(df)
+        self.prev_close = float(close.iloc[-1])
+        self.prev_high = float(high.iloc[-1])
+        self.prev_low = float(low.iloc[-1])
+
+        # RSI (14)：Wilder EMA 累積值
+        diff = close.diff(1)
+        up = diff.where(diff > 0, 0.0)
+        down = -diff.where(diff < 0, 0.0)
+        self.rsi_up = float(up.ewm(alpha=1 / 14, adjust=False).mean().iloc[-1])
+        self.rsi_down = float(down.ewm(alpha=1 / 14, adjust=False).mean().iloc[-1])
+
+        # MACD (12, 26, 9)：快慢 EMA 與訊號線 EMA
+        ema12 = close.ewm(span=12, min_periods=12, adjust=False).mean()
+        ema26 = close.ewm(span=26, min_periods=26, adjust=False).mean()
+        self.ema12 = float(ema12.iloc[-1])
+        self.ema26 = float(ema26.iloc[-1])
+        self.macd_signal = float((ema12 - ema26).ewm(span=9, min_periods=9, adjust=False).mean().iloc[-1])
+
+        # KD (9, 3)：前 8 日高低點與前 2 日 K 值
+        self.high_buf9 = high.iloc[-8:].to_numpy()
+        self.low_buf9 = low.iloc[-8:].to_numpy()
+        stoch = ta.momentum.StochasticOscillator(high, low, close, window=9, smooth_window=3)
+        self.prev_k = stoch.stoch().iloc[-2:].to_numpy()
+
+        # MA / BIAS：前 (p-1) 日收盤和
+        self.close_sums = {p: float(close.iloc[-(p - 1):].sum()) for p in self.MA_PERIODS}
+        # 布林通道：前 19 日收盤（標準差需完整視窗）
+        self.close_buf20 = close.iloc[-19:].to_numpy()
+
+        # OBV 累計值
+        self.obv = float(ta.volume.OnBalanceVolumeIndicator(close, volume).on_balance_volume().iloc[-1])
+
+        # VWAP（20 日滾動）：前 19 日量價和與量和
+        typical_price = (high + low + close) / 3
+        self.pv_sum19 = float((typical_price * volume).iloc[-19:].sum())
+        self.vol_sum19 = float(volume.iloc[-19:].sum())
+
+        # DMI (14)：ta 的 Wilder 平滑狀態（最後一個已計算的 TR / +DM / -DM 累積值）
+        adx_ind = ta.trend.ADXIndicator(high, low, close, window=14)
+        self.trs = float(adx_ind._trs[-2])
+        self.dip = float(adx_ind._dip[-2])
+        self.din = float(adx_ind._din[-2])
+        self.adx = float(adx_ind.adx().iloc[-1])
+
+        # Williams %R (14)：前 13 日高低點
+        self.high_buf14 = high.iloc[-13:].to_numpy()
+        self.low_buf14 = low.iloc[-13:].to_numpy()
+
+        # ATR (14)
+        self.atr = float(ta.volatility.AverageTrueRange(high, low, close, window=14)
+                         .average_true_range().iloc[-1])
+
+    @classmethod
+    def from_frame(cls, df):
+        if len(df) < cls.MIN_BARS:
+            return None
+        return cls(df)
+
+    def step(self, bar):
+        """以盤中K棒（open/max/min/close/Trading_Volume）算出當日各指標值（不改變狀態）"""
+        c = float(bar['close'])
+        h = float(bar['max'])
+        lo = float(bar['min'])
+        v = float(bar['Trading_Volume'])
+        out = {}
+
+        # RSI
+        change = c - self.prev_close
+        up = (1 - 1 / 14) * self.rsi_up + (1 / 14) * max(change, 0.0)
+        down = (1 - 1 / 14) * self.rsi_down + (1 / 14) * max(-change, 0.0)
+        out['rsi'] = _round2(100.0 if down == 0 else 100 - 100 / (1 + up / down))
+
+        # MACD
+        ema12 = self.ema12 + 2 / 13 * (c - self.ema12)
+        ema26 = self.ema26 + 2 / 27 * (c - self.ema26)
+        macd = ema12 - ema26
+        signal = self.macd_signal + 2 / 10 * (macd - self.macd_signal)
+        out['macd'] = _round2(macd)
+        out['macd_signal'] = _round2(signal)
+        out['macd_histogram'] = _round2(macd - signal)
+
+        # KD
+        with np.errstate(invalid='ignore', divide='ignore'):
+            lowest = min(self.low_buf9.min(), lo)
+            highest = max(self.high_buf9.max(), h)
+            k = np.float64(100) * (c - lowest) / np.float64(highest - lowest)
+            d = (self.prev_k[0] + self.prev_k[1] + k) / 3
+        out['k'] = _round2(k)
+        out['d'] = _round2(d)
+
+        # MA
+        ma = {p: (self.close_sums[p] + c) / p if self.count + 1 >= p else np.nan
+              for p in self.MA_PERIODS}
+        for p in self.MA_PERIODS:
+            out[f'ma{p}'] = _round2(ma[p])
+
+        # 布林通道（window 固定 20，為常數成本）
+        window = np.append(self.close_buf20, c)
+        mid = window.mean()
+        std = window.std(ddof=0)
+        out['bb_upper'] = _round2(mid + 2 * std)
+        out['bb_middle'] = _round2(mid)
+        out['bb_lower'] = _round2(mid - 2 * std)
+
+        # OBV
+        out['obv'] = self.obv + (-v if c < self.prev_close else v)
+
+        # VWAP
+        tp = (h + lo + c) / 3
+        out['vwap'] = _round2((self.pv_sum19 + tp * v) / (self.vol_sum19 + v))
+
+        # DMI（Wilder 平滑）
+        tr = max(h, self.prev_close) - min(lo, self.prev_close)
+        diff_up = h - self.prev_high
+        diff_down = self.prev_low - lo
+        pos = diff_up if (diff_up > diff_down and diff_up > 0) else 0.0
+        neg = diff_down if (diff_down > diff_up and diff_down > 0) else 0.0
+        trs = self.trs - self.trs / 14 + tr
+        dip = self.dip - self.dip / 14 + pos
+        din = self.din - self.din / 14 + neg
+        di_plus = 100 * (dip / trs) if trs != 0 else 0.0
+        di_minus = 100 * (din / trs) if trs != 0 else 0.0
+        dx = 100 * abs((di_plus - di_minus) / (di_plus + di_minus)) if (di_plus + di_minus) != 0 else 0.0
+        out['adx'] = _round2((self.adx * 13 + dx) / 14)
+        out['di_plus'] = _round2(di_plus)
+        out['di_minus'] = _round2(di_minus)
+
+        # Williams %R
+        with np.errstate(invalid='ignore', divide='ignore'):
+            hh = max(self.high_buf14.max(), h)
+            ll = min(self.low_buf14.min(), lo)
+            out['williams_r'] = _round2(np.float64(-100) * (hh - c) / np.float64(hh - ll))
+
+        # BIAS
+        for p in (5, 10, 20):
+            out[f'bias{p}'] = _round2((c - ma[p]) / ma[p] * 100)
+
+        # ATR
+        true_range = max(h - lo, abs(h - self.prev_close), abs(lo - self.prev_close))
+        out['atr'] = _round2((self.atr * 13 + true_range) / 14)
+
+        return out
+
+
+# 盤中增量指標狀態快取（以歷史區間與最後一根K棒日期為鍵，隔日自然失效）
+indicator_state_cache = LRUCache("indicator_state", max_bytes=_cache_budget("indicator_state", 32), ttl=43200)
+
+
+def get_indicator_state(stock_id, warmup_start, base_df):
+    """取得（或建立）截至 base_df 最後一根K棒的增量指標狀態，連同歷史區段的指標結果"""
+    if base_df.empty:
+        return None, None
+    last_date = base_df['date'].iloc[-1].strftime('%Y-%m-%d')
+    cache_key = f"{stock_id}:{warmup_start}:{last_date}:{len(base_df)}"
+    cached = indicator_state_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    state = IndicatorState.from_frame(base_df)
+    if state is None:
+        return None, None
+    entry = (state, compute_chart_indicators(base_df))
+    indicator_state_cache.set(cache_key, entry, ttl=held_ttl())
+    return entry
+
+
+# 技術指標計算結果快取：鍵含最後一根K棒日期（盤中含即時K棒內容），有新K棒時自然換鍵失效
+chart_cache = LRUCache("chart", max_bytes=_cache_budget("chart", 64), ttl=300)
+
+
+def build_chart_payload(stock_id, data, start_date, warmup_start, rt=None, fmt='rows'):
+    """由日K資料計算 chart-data 回傳內容（rt 為盤中即時報價時併入當日K棒）
+
+    fmt='columnar' 時 price 以欄為單位輸出（{date: [...], open: [...], ...}），省去每列重複的鍵名
+    """
+    df = pd.DataFrame(data)
+    df['date'] = pd.to_datetime(df['date'])
+    df = df.sort_values('date').reset_index(drop=True)
+
+    result = None
+    if rt:
+        today_str = datetime.now().strftime('%Y-%m-%d')
+        # 移除可能已存在的今日資料（避免重複）
+        df = df[df['date'].dt.strftime('%Y-%m-%d') != today_str].reset_index(drop=True)
+        today_bar = {
+            'date': pd.Timestamp(today_str),
+            'open': rt['open'],
+            'max': rt['high'],
+            'min': rt['low'],
+            'close': rt['price'],
+            'Trading_Volume': rt['volume'] * 1000,
+            'stock_id': stock_id,
+        }
+        # 歷史部分的指標與狀態只算一次，盤中每次更新只推進當日K棒
+        state, base_result = get_indicator_state(stock_id, warmup_start, df)
+        if state is not None:
+            today_values = state.step(today_bar)
+            result = {'date': base_result['date'] + [today_str]}
+            for key, values in base_result.items():
+                if key != 'date':
+                    result[key] = np.append(values, today_values[key])
+        df = pd.concat([df, pd.DataFrame([today_bar])], ignore_index=True)
+        logger.info("合併盤中數據: %s close=%s vol=%s",
+                   stock_id, rt['price'], rt['volume'])
+
+    if result is None:
+        result = compute_chart_indicators(df)
 
     # 過濾掉預熱期
     dates = result['date']
-    start_idx = 0
-    for i, d in enumerate(dates):
-        if d >= start_date:
-            start_idx = i
-            break
+    start_idx = bisect.bisect_left(dates, start_date)
+    if start_idx >= len(dates):
+        start_idx = 0
 
-    # 建立 Price 輸出陣列
-    price_result = []
-    df_result = df.iloc[start_idx:]
-    for _, row in df_result.iterrows():
-        price_result.append({
-            'date': row['date'].strftime('%Y-%m-%d'),
-            'open': row['open'],
-            'max': row['max'],
-            'min': row['min'],
-            'close': row['close'],
-            'Trading_Volume': row['Trading_Volume'],
-            'stock_id': stock_id
-        })
-
-    filtered_result = {}
+    # 指標陣列直接由 numpy 轉出，NaN / inf → null 以向量化處理
+    filtered_result = {'date': dates[start_idx:]}
     for key, values in result.items():
-        filtered_result[key] = values[start_idx:]
-
-    # NaN → null
-    for key, values in filtered_result.items():
         if key != 'date':
-            filtered_result[key] = [
-                None if (isinstance(v, float) and (np.isnan(v) or np.isinf(v))) else v
-                for v in values
-            ]
+            filtered_result[key] = _json_array(values[start_idx:])
+
+    df_result = df.iloc[start_idx:]
+    price_columns = {'date': filtered_result['date']}
+    for col in ('open', 'max', 'min', 'close', 'Trading_Volume'):
+        price_columns[col] = _json_array(df_result[col].to_numpy())
 
-    return api_ok({
+    if fmt == 'columnar':
+        price_result = price_columns
+    else:
+        # 建立 Price 輸出陣列
+        price_result = [
+            {'date': d, 'open': o, 'max': h, 'min': lo, 'close': c,
+             'Trading_Volume': v, 'stock_id': stock_id}
+            for d, o, h, lo, c, v in zip(price_columns['date'], price_columns['open'],
+                                         price_columns['max'], price_columns['min'],
+                                         price_columns['close'], price_columns['Trading_Volume'])
+        ]
+
+    return {
         "name": get_stock_name(stock_id),
         "price": price_result,
         "indicators": filtered_result
-    })
+    }
+
+
+class StockDataError(Exception):
+    """個股資料無法組成回應（帶 HTTP 狀態碼，供端點與資料包共用）"""
+
+    def __init__(self, message, status_code=404):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def chart_warmup_start(start_date):
+    """技術指標預熱起始日：多抓前 120 天"""
+    return (datetime.strptime(start_date, "%Y-%m-%d") - timedelta(days=120)).strftime("%Y-%m-%d")
+
+
+def build_chart_data(stock_id, data, start_date, end_date, use_realtime=False, fmt='rows'):
+    """以預熱區間起算的日K計算 K 線與技術指標回應（結果依資料版本快取）"""
+    warmup_start = chart_warmup_start(start_date)
+    if not data:
+        raise StockDataError("無法取得股價資料")
+
+    # 過濾異常資料（停牌或收盤價為0）
+    data = [d for d in data if d.get('close', 0) > 0 and d.get('max', 0) > 0]
+
+    if not data:
+        raise StockDataError("該區間無有效交易資料")
+
+    # realtime=1 時，合併盤中即時數據
+    rt = None
+    if use_realtime and is_trading_hours():
+        rt = fetch_twse_realtime(stock_id)
+        if not (rt and rt.get('price')):
+            rt = None
+
+    last_date = max(d['date'] for d in data)
+    cache_key = f"{stock_id}:{start_date}:{end_date}:{last_date}:{len(data)}:{fmt}"
+    if rt:
+        cache_key += f":rt:{rt['open']}:{rt['high']}:{rt['low']}:{rt['price']}:{rt['volume']}"
+
+    payload = chart_cache.get(cache_key)
+    if payload is None:
+        # 多個頁面同時開啟同一檔時，只計算一次
+        def compute():
+            result = build_chart_payload(stock_id, data, start_date, warmup_start, rt, fmt)
+            chart_cache.set(cache_key, result, ttl=held_ttl())
+            return result
+        payload = _single_flight(f"chart:{cache_key}", compute)
+        if payload is None:
+            raise StockDataError("技術指標計算失敗", 500)
+
+    return payload
+
+
+@app.route('/api/stock/chart-data')
+def stock_chart_data():
+    """合併計算技術指標與 K 線數據：RSI, MACD, KD, BB, OBV, MA, VWAP, DMI, W%R"""
+    stock_id = request.args.get('id', '')
+    start_date = request.args.get('start', '')
+    end_date = request.args.get('end', '')
+
+    fmt = request.args.get('format', 'rows')
+
+    if not stock_id:
+        return api_error("缺少股票代號")
+
+    if not start_date or not end_date:
+        start_date, end_date = get_default_dates(12)
+
+    warm_set.touch('viewed', [stock_id])
+    warmup_start = chart_warmup_start(start_date)
+    data = finmind_request("TaiwanStockPrice", data_id=stock_id,
+                           start_date=warmup_start, end_date=end_date)
+    try:
+        payload = build_chart_data(stock_id, data, start_date, end_date,
+                                   request.args.get('realtime', '0') == '1', fmt)
+    except StockDataError as e:
+        return api_error(str(e), e.status_code)
+    return api_ok(payload)
 
 
 @app.route('/api/stock/institutional')
 def stock_institutional():
-    """取得三大法人買賣超資料（含連續買賣超天數）"""
+    """取得三大法人買賣超資料（含連續買賣超天數，format=columnar 時以欄式輸出）"""
     stock_id = request.args.get('id', '')
     start_date = request.args.get('start', '')
     end_date = request.args.get('end', '')
@@ -607,19 +2680,28 @@ def stock_institutional():
 
     data = finmind_request("TaiwanStockInstitutionalInvestorsBuySell",
                            data_id=stock_id, start_date=start_date, end_date=end_date)
+    consecutive = institutional_consecutive(data)
+
+    if request.args.get('format') == 'columnar':
+        return api_ok(_columnar(data), consecutive=consecutive)
+    return api_ok(data, consecutive=consecutive)
 
-    # 計算各法人連續買賣超天數
+
+# FinMind 法人 name 可能是中文或英文格式
+INSTITUTIONAL_NAME_PATTERNS = {
+    '外資': ['外資', 'Foreign'],
+    '投信': ['投信', 'Investment_Trust'],
+    '自營商': ['自營商', 'Dealer'],
+}
+
+
+def institutional_consecutive(data):
+    """計算各法人連續買賣超天數（正=連買，負=連賣）"""
     consecutive = {}
     if data:
         df = pd.DataFrame(data)
         df['net'] = df['buy'].fillna(0) - df['sell'].fillna(0)
-        # FinMind name 可能是中文或英文格式
-        name_patterns = {
-            '外資': ['外資', 'Foreign'],
-            '投信': ['投信', 'Investment_Trust'],
-            '自營商': ['自營商', 'Dealer'],
-        }
-        for display_name, patterns in name_patterns.items():
+        for display_name, patterns in INSTITUTIONAL_NAME_PATTERNS.items():
             pattern = '|'.join(patterns)
             mask = df['name'].str.contains(pattern, na=False)
             sub = df[mask].groupby('date')['net'].sum().sort_index()
@@ -634,8 +2716,7 @@ def stock_institutional():
                     else:
                         break
                 consecutive[display_name] = count * direction  # 正=連買，負=連賣
-
-    return api_ok(data, consecutive=consecutive)
+    return consecutive
 
 
 @app.route('/api/stock/shareholding')
@@ -669,8 +2750,11 @@ def stock_margin():
 
     data = finmind_request("TaiwanStockMarginPurchaseShortSale",
                            data_id=stock_id, start_date=start_date, end_date=end_date)
+    return api_ok(add_short_margin_ratio(data))
 
-    # 計算券資比
+
+def add_short_margin_ratio(data):
+    """為融資融券資料加上券資比欄位 short_margin_ratio（%）"""
     if data:
         for row in data:
             margin_bal = row.get('MarginPurchaseTodayBalance') or row.get('MarginPurchaseBalance') or 0
@@ -678,8 +2762,7 @@ def stock_margin():
             margin_bal = float(margin_bal) if margin_bal else 0
             short_bal = float(short_bal) if short_bal else 0
             row['short_margin_ratio'] = round(short_bal / margin_bal * 100, 2) if margin_bal > 0 else 0
-
-    return api_ok(data)
+    return data
 
 @app.route('/api/stock/holders/debug')
 def stock_holders_debug():
@@ -687,9 +2770,7 @@ def stock_holders_debug():
     norway_url = f"https://norway.twsthr.info/StockHolders.aspx?stock={stock_id}"
     norway_headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'}
     try:
-        import urllib3
-        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-        resp = req.get(norway_url, headers=norway_headers, verify=False, timeout=15)
+        resp = http_get(norway_url, headers=norway_headers, verify=False, timeout=15)
         return api_ok({
             "status_code": resp.status_code, 
             "text": resp.text[:2000], 
@@ -698,111 +2779,65 @@ def stock_holders_debug():
     except Exception as e:
         return api_error(str(e))
 
-@app.route('/api/stock/holders')
-def stock_holders():
-    """取得大戶籌碼與外資等持股資料"""
-    stock_id = request.args.get('id', '')
-    if not stock_id:
-        return api_error("缺少股票代號")
+# 籌碼資料各來源並行抓取的整體等待上限（秒），逾時的來源在背景完成後寫入快取供下次使用
+HOLDERS_DEADLINE = 8
+
+
+def holders_start_date(now=None):
+    """籌碼資料取近 70 天，涵蓋約 8 週"""
+    return ((now or datetime.now()) - timedelta(days=70)).strftime("%Y-%m-%d")
+
+
+def build_holders(stock_id, fetch_shareholding=None, fetch_price=None):
+    """組合大戶籌碼與外資等持股資料（股權分散優先取自集保欄式儲存，不足時才爬蟲）
 
-    # 取近70天資料涵蓋約8週
-    start_date = (datetime.now() - timedelta(days=70)).strftime("%Y-%m-%d")
-    
-    # 取真實外資持股與股價
-    share_data = finmind_request("TaiwanStockShareholding", data_id=stock_id, start_date=start_date)
-    price_data = finmind_request("TaiwanStockPrice", data_id=stock_id, start_date=start_date)
-    
-    price_dict = {d.get('date'): d.get('close') for d in price_data} if price_data else {}
-    share_dict = {d.get('date'): d.get('ForeignInvestmentSharesRatio', 0) for d in share_data} if share_data else {}
-    
-    # 爬取神秘金字塔 (norway.twsthr.info)
-    norway_cache_key = f"norway_{stock_id}"
-    norway_data = norway_cache.get(norway_cache_key)
-    if norway_data is None:
-        norway_data = []
-        norway_url = f"https://norway.twsthr.info/StockHolders.aspx?stock={stock_id}"
-        norway_headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'}
-        try:
-            # 關閉 SSL 驗證以防憑證過期
-            import urllib3
-            urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-            resp = req.get(norway_url, headers=norway_headers, verify=False, timeout=15)
-            resp.raise_for_status()
-            soup = BeautifulSoup(resp.text, 'html.parser')
-            detail_tables = soup.find_all('table', id='Details')
-            target_table = None
-            for t in detail_tables:
-                trs = t.find_all('tr')
-                if len(trs) > 0 and '總股東' in trs[0].text:
-                    target_table = t
-                    break
+    FinMind 與爬蟲來源並行抓取，整體最多等待 HOLDERS_DEADLINE 秒；逾時或失敗的來源在 sources 中標示，
+    每列的 missing 列出取不到的欄位，stale 列出以最新一天資料代替的欄位。
+    fetch_shareholding / fetch_price 可傳入已共用的資料來源（資料包使用），預設直接查 FinMind。
+    回傳 (rows, sources, partial)
+    """
+    start_date = holders_start_date()
 
-            if target_table:
-                trs = target_table.find_all('tr')
-                for tr in trs[1:]:  # 跳過表頭
-                    tds = tr.find_all('td')
-                    if len(tds) >= 14:
-                        date_str = tds[2].text.strip()
-                        # 確認 date_str 真的是日期格式 (YYYYMMDD)
-                        if len(date_str) == 8 and date_str.isdigit() and date_str.startswith('20'):
-                            formatted_date = f"{date_str[:4]}-{date_str[4:6]}-{date_str[6:]}"
-                            total_holders = tds[4].text.strip().replace(',', '')
-                            major_400_ratio = tds[7].text.strip()
-                            major_1000_ratio = tds[13].text.strip()
-                            try:
-                                norway_data.append({
-                                    'date': formatted_date,
-                                    'total_holders': int(total_holders) if total_holders else 0,
-                                    'major_ratio': float(major_400_ratio) if major_400_ratio else 0,
-                                    'major_1000_ratio': float(major_1000_ratio) if major_1000_ratio else 0
-                                })
-                            except ValueError:
-                                pass
-                # 只有當抓取到的資料筆數大於等於 5 筆時才進行一天長度的快取
-                # 避免因網站短暫擋 IP 或解析失敗導致將空陣列快取 24 小時
-                if norway_data and len(norway_data) >= 5:
-                    norway_cache.set(norway_cache_key, norway_data)
-        except Exception as e:
-            logger.error("神秘金字塔爬蟲 API 錯誤 [%s]: %s", stock_id, e)
+    # 集保股權分散表（本地欄式儲存，每週更新）
+    ensure_tdcc_fresh()
+    tdcc_weeks = tdcc_store.history(stock_id, limit=10)
+    # 儲存區週數不足時才爬取外部網站補齊
+    need_scrape = len(tdcc_weeks) < TDCC_MIN_WEEKS
 
-    # 爬取 Yahoo Finance 散戶比例
-    yahoo_cache_key = f"yahoo_{stock_id}"
-    yahoo_data = yahoo_cache.get(yahoo_cache_key)
-    if yahoo_data is None:
-        yahoo_data = []
-        yahoo_url = f"https://tw.stock.yahoo.com/quote/{stock_id}/major-holders"
-        yahoo_headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
-        try:
-            resp = req.get(yahoo_url, headers=yahoo_headers, timeout=10)
-            resp.raise_for_status()
-            soup = BeautifulSoup(resp.text, 'html.parser')
-            lis = soup.find_all('li', class_='List(n)')
-            for li in lis:
-                row_div = li.find('div', class_=lambda x: x and 'table-row' in x)
-                if row_div:
-                    cols = row_div.find_all('div', recursive=False)
-                    if len(cols) >= 5:
-                        d_str = cols[0].text.strip().replace('/', '-')
-                        c_foreign = cols[1].text.strip().replace('%', '').replace(',', '')
-                        c_major = cols[2].text.strip().replace('%', '').replace(',', '')
-                        c_director = cols[3].text.strip().replace('%', '').replace(',', '')
-                        c_price = cols[4].text.strip().replace(',', '')
-                        if d_str:
-                            major_val = float(c_major) if c_major and c_major != '-' else 0
-                            # 粗估散戶比例 = 100 - 大戶比例
-                            retail_val = max(0, round(100 - major_val, 2)) if major_val > 0 else 0
-                            yahoo_data.append({
-                                'date': d_str,
-                                'foreign_ratio': float(c_foreign) if c_foreign and c_foreign != '-' else 0,
-                                'major_ratio': major_val,
-                                'director_ratio': float(c_director) if c_director and c_director != '-' else 0,
-                                'price': float(c_price) if c_price and c_price != '-' else 0,
-                                'retail_ratio': retail_val
-                            })
-            if yahoo_data:
-                yahoo_cache.set(yahoo_cache_key, yahoo_data)
-        except Exception as e:
-            logger.error("Yahoo 大戶籌碼 API 錯誤 [%s]: %s", stock_id, e)
+    # 真實外資持股與股價（FinMind）、神秘金字塔與 Yahoo 爬蟲同時進行
+    tasks = {
+        'shareholding': fetch_shareholding or (lambda: finmind_request(
+            "TaiwanStockShareholding", data_id=stock_id, start_date=start_date)),
+        'price': fetch_price or (lambda: finmind_request(
+            "TaiwanStockPrice", data_id=stock_id, start_date=start_date)),
+    }
+    if need_scrape:
+        tasks['norway'] = lambda: fetch_norway_holders(stock_id)
+        tasks['yahoo'] = lambda: fetch_yahoo_holders(stock_id)
+
+    def enough(status):
+        # FinMind 兩項到齊，且股權分散已有主要來源（集保 / 神秘金字塔）或爬蟲都已結束
+        if status['shareholding'] is None or status['price'] is None:
+            return False
+        return (not need_scrape or status['norway'] == 'ok'
+                or (status['norway'] is not None and status['yahoo'] is not None))
+
+    fetched, sources = fan_out(tasks, HOLDERS_DEADLINE, enough)
+    share_data = fetched.get('shareholding') or []
+    price_data = fetched.get('price') or []
+    norway_data = fetched.get('norway') or []
+    yahoo_data = fetched.get('yahoo') or []
+    if tdcc_weeks:
+        sources['tdcc'] = 'ok'
+
+    price_dict = {d.get('date'): d.get('close') for d in price_data}
+    share_dict = {d.get('date'): d.get('ForeignInvestmentSharesRatio', 0) for d in share_data}
+
+    if tdcc_weeks:
+        # 同一週以集保儲存區為準，爬蟲結果只補足較早的週次
+        merged = {item['date']: item for item in norway_data}
+        merged.update({item['date']: item for item in tdcc_weeks})
+        norway_data = [merged[d] for d in sorted(merged, reverse=True)]
 
     result = []
     # 建立 Yahoo 散戶字典 (使用從大戶推估的散戶估值)
@@ -816,7 +2851,8 @@ def stock_holders():
             # 尋找最近的交易日價格與外資持股
             closest_price = 0
             closest_share = 0
-            closest_retail = 0
+            closest_retail = item.get('retail_ratio', 0)  # 集保資料含實際 50 張以下比例
+            stale = []
             
             # 往前找最多 5 天有資料的日子
             target_date = datetime.strptime(d_str, "%Y-%m-%d")
@@ -832,10 +2868,13 @@ def stock_holders():
             # 如果找不到，就用最新的一天
             if not closest_price and price_dict:
                 closest_price = price_dict[list(price_dict.keys())[-1]]
+                stale.append('price')
             if not closest_share and share_dict:
                 closest_share = share_dict[list(share_dict.keys())[-1]]
+                stale.append('foreign_ratio')
             if not closest_retail and yahoo_dict:
                 closest_retail = yahoo_dict[list(yahoo_dict.keys())[-1]]
+                stale.append('retail_ratio')
 
             result.append({
                 "date": d_str,
@@ -844,8 +2883,11 @@ def stock_holders():
                 "major_1000_ratio": item['major_1000_ratio'], # >1000張
                 "total_holders": item['total_holders'],       # 總股東人數
                 "director_ratio": 0, # 已棄用，保留相容
-                "retail_ratio": closest_retail,               # <50張估算
-                "price": closest_price
+                "retail_ratio": closest_retail,               # <50張（集保實際值或估算）
+                "price": closest_price,
+                "missing": [k for k, v in (('foreign_ratio', closest_share), ('retail_ratio', closest_retail),
+                                           ('price', closest_price)) if not v],
+                "stale": stale,
             })
     else:
         # 備援：若被 Cloudflare 阻擋，以 yahoo_data 為主
@@ -873,10 +2915,26 @@ def stock_holders():
                 "total_holders": 0,                           # 無資料
                 "director_ratio": item['director_ratio'],
                 "retail_ratio": item['retail_ratio'],
-                "price": closest_price
+                "price": closest_price,
+                "missing": ['major_1000_ratio', 'total_holders'] + [
+                    k for k, v in (('foreign_ratio', closest_share), ('price', closest_price)) if not v],
+                "stale": [],
             })
 
-    return api_ok(result)
+    # pending 是已有足夠資料而刻意不等的來源，不算缺資料
+    partial = any(st in ('timeout', 'error') for st in sources.values())
+    return result, sources, partial
+
+
+@app.route('/api/stock/holders')
+def stock_holders():
+    """取得大戶籌碼與外資等持股資料（各列含 missing / stale 標記，sources 為各來源狀態）"""
+    stock_id = request.args.get('id', '')
+    if not stock_id:
+        return api_error("缺少股票代號")
+
+    result, sources, partial = build_holders(stock_id)
+    return api_ok(result, sources=sources, partial=partial)
 
 
 @app.route('/api/stock/dividend')
@@ -1018,38 +3076,475 @@ def stock_news():
         yahoo_id = f"{stock_id}.TW"
         url = f"https://feeds.finance.yahoo.com/rss/2.0/headline?s={yahoo_id}&region=TW&lang=zh-Hant-TW"
         
-        req = urllib.request.Request(url, headers={'User-Agent': 'Mozilla/5.0'})
-        with urllib.request.urlopen(req, timeout=10) as response:
-            xml_content = response.read().decode('utf-8')
-            
-            # 使用 BeautifulSoup 解析 RSS XML
-            soup = BeautifulSoup(xml_content, 'xml')
-            items = soup.find_all('item')
-            
-            news_list = []
-            for item in items[:10]: # 取前 10 則
-                news_list.append({
-                    "title": item.title.text if item.title else "無標題",
-                    "link": item.link.text if item.link else "#",
-                    "pubDate": item.pubDate.text if item.pubDate else "",
-                    "source": "Yahoo Finance"
-                })
-            
-            # 如果 Yahoo 沒新聞，回傳備位模擬資料
-            if not news_list:
-                news_list = [
-                    {"title": f"今日股市焦點：{stock_id} 表現強勁", "link": "#", "pubDate": "2024-02-25", "source": "模擬新聞"},
-                    {"title": f"{stock_id} 財報發布後市場反應正向", "link": "#", "pubDate": "2024-02-24", "source": "模擬新聞"}
-                ]
+        resp = http_get(url, headers={'User-Agent': 'Mozilla/5.0'}, timeout=10)
+        resp.raise_for_status()
+        xml_content = resp.content.decode('utf-8')
+        
+        # 使用 BeautifulSoup 解析 RSS XML
+        soup = BeautifulSoup(xml_content, 'xml')
+        items = soup.find_all('item')
+        
+        news_list = []
+        for item in items[:10]: # 取前 10 則
+            news_list.append({
+                "title": item.title.text if item.title else "無標題",
+                "link": item.link.text if item.link else "#",
+                "pubDate": item.pubDate.text if item.pubDate else "",
+                "source": "Yahoo Finance"
+            })
+        
+        # 如果 Yahoo 沒新聞，回傳備位模擬資料
+        if not news_list:
+            news_list = [
+                {"title": f"今日股市焦點：{stock_id} 表現強勁", "link": "#", "pubDate": "2024-02-25", "source": "模擬新聞"},
+                {"title": f"{stock_id} 財報發布後市場反應正向", "link": "#", "pubDate": "2024-02-24", "source": "模擬新聞"}
+            ]
 
-            api_cache.set(cache_key, news_list) # 快取
-            return api_ok(news_list)
+        api_cache.set(cache_key, news_list) # 快取
+        return api_ok(news_list)
 
     except Exception as e:
         logger.error(f"取得新聞失敗: {e}")
         return api_ok([])
 
 
+@app.route('/api/cache/stats')
+def cache_stats():
+    """各快取命名空間的記憶體用量與命中 / 淘汰統計"""
+    return api_ok({name: cache.stats() for name, cache in LRUCache.registry.items()})
+
+
+@app.route('/api/finmind/quota')
+def finmind_quota():
+    """FinMind 請求額度：每小時配額、剩餘額度、近一小時用量與降級次數"""
+    return api_ok(finmind_limiter.stats())
+
+
+# ============================================================
+# 個股頁資料包（單一連線串流所有區塊）
+# ============================================================
+
+BUNDLE_SECTIONS = ('chart', 'per', 'institutional', 'holders', 'margin', 'shareholding',
+                   'dividend', 'revenue', 'financial', 'balance_sheet', 'price', 'adjusted_factors')
+# 整個資料包的等待上限（秒），逾時的區塊回報 timeout，由前端改打個別 API
+BUNDLE_DEADLINE = 30
+# 區塊組裝與資料集抓取分開兩個池：區塊會等待資料集，放在同一池中可能互相卡住
+_bundle_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="bundle")
+
+
+class BundleDatasets:
+    """同一資料包內共用的 FinMind 資料集
+
+    各區塊先以 need() 登記需要的區間，start() 後每個資料集只以最寬區間抓一次，
+    get() 再依各區塊的區間切片，避免同一資料集以不同區間重複請求。
+    """
+
+    def __init__(self, stock_id):
+        self.stock_id = stock_id
+        self._ranges = {}
+        self._futures = {}
+
+    def need(self, dataset, start_date, end_date=None):
+        if dataset in self._ranges:
+            lo, hi = self._ranges[dataset]
+            start_date = min(lo, start_date)
+            end_date = None if hi is None or end_date is None else max(hi, end_date)
+        self._ranges[dataset] = (start_date, end_date)
+
+    def start(self):
+        for dataset, (start_date, end_date) in self._ranges.items():
+            self._futures[dataset] = _fanout_pool.submit(
+                contextvars.copy_context().run, finmind_request, dataset, data_id=self.stock_id, start_date=start_date, end_date=end_date)
+
+    def get(self, dataset, start_date=None, end_date=None):
+        rows = self._futures[dataset].result() or []
+        return [r for r in rows
+                if (start_date is None or r.get('date', '') >= start_date)
+                and (end_date is None or r.get('date', '') <= end_date)]
+
+
+def plan_bundle(stock_id, start_date, end_date, price_start, use_realtime, sections, now=None):
+    """登記各區塊需要的資料集並回傳 (datasets, {區塊: 組裝函式})
+
+    組裝函式回傳該區塊 NDJSON 行的內容（data 與額外欄位），與對應的個別 API 回應相同。
+    now 為頁面開啟的時間（預熱時傳入下一個交易日，讓資料集區間與隔天的請求一致）。
+    """
+    ds = BundleDatasets(stock_id)
+    now = now or datetime.now()
+    warmup_start = chart_warmup_start(start_date)
+    holders_start = holders_start_date(now)
+    per_start, per_end = get_default_dates(3, now)
+    fund_start, fund_end = get_default_dates(36, now)
+    div_start = (now - timedelta(days=3650)).strftime("%Y-%m-%d")
+    adj_start = (now - timedelta(days=365 * 3)).strftime('%Y-%m-%d')
+
+    def chart():
+        data = ds.get("TaiwanStockPrice", warmup_start, end_date)
+        return {"data": build_chart_data(stock_id, data, start_date, end_date, use_realtime)}
+
+    def institutional():
+        data = ds.get("TaiwanStockInstitutionalInvestorsBuySell", start_date, end_date)
+        return {"data": data, "consecutive": institutional_consecutive(data)}
+
+    def holders():
+        rows, sources, partial = build_holders(
+            stock_id,
+            fetch_shareholding=lambda: ds.get("TaiwanStockShareholding", holders_start),
+            fetch_price=lambda: ds.get("TaiwanStockPrice", holders_start))
+        return {"data": rows, "sources": sources, "partial": partial}
+
+    def price():
+        data = build_price_rows(stock_id, ds.get("TaiwanStockPrice", price_start, end_date))
+        return {"data": {"name": get_stock_name(stock_id), "data": data}}
+
+    def rows(dataset, lo, hi=None, post=None):
+        def build():
+            data = ds.get(dataset, lo, hi)
+            return {"data": post(data) if post else data}
+        return build
+
+    # 區塊: (需要的資料集區間, 組裝函式)
+    plans = {
+        'chart': ([("TaiwanStockPrice", warmup_start, end_date)], chart),
+        'per': ([("TaiwanStockPER", per_start, per_end)], rows("TaiwanStockPER", per_start, per_end)),
+        'institutional': ([("TaiwanStockInstitutionalInvestorsBuySell", start_date, end_date)], institutional),
+        'holders': ([("TaiwanStockShareholding", holders_start), ("TaiwanStockPrice", holders_start)], holders),
+        'margin': ([("TaiwanStockMarginPurchaseShortSale", start_date, end_date)],
+                   rows("TaiwanStockMarginPurchaseShortSale", start_date, end_date, add_short_margin_ratio)),
+        'shareholding': ([("TaiwanStockShareholding", start_date, end_date)],
+                         rows("TaiwanStockShareholding", start_date, end_date)),
+        'dividend': ([("TaiwanStockDividend", div_start)], rows("TaiwanStockDividend", div_start)),
+        'revenue': ([("TaiwanStockMonthRevenue", fund_start, fund_end)],
+                    rows("TaiwanStockMonthRevenue", fund_start, fund_end)),
+        'financial': ([("TaiwanStockFinancialStatements", fund_start, fund_end)],
+                      rows("TaiwanStockFinancialStatements", fund_start, fund_end)),
+        'balance_sheet': ([("TaiwanStockBalanceSheet", fund_start, fund_end)],
+                          rows("TaiwanStockBalanceSheet", fund_start, fund_end)),
+        'price': ([("TaiwanStockPrice", price_start, end_date)], price),
+        'adjusted_factors': ([("TaiwanStockDividend", adj_start)], rows("TaiwanStockDividend", adj_start)),
+    }
+
+    builders = {}
+    for name in sections:
+        needs, build = plans[name]
+        for need in needs:
+            ds.need(*need)
+        builders[name] = build
+    return ds, builders
+
+
+def stream_bundle(ds, builders, deadline=BUNDLE_DEADLINE):
+    """並行組裝各區塊，依完成順序逐一產生 NDJSON 行，最後一行為 done 摘要"""
+    started = time.monotonic()
+    ds.start()
+    futures = {_bundle_pool.submit(contextvars.copy_context().run, build): name
+               for name, build in builders.items()}
+    pending = set(futures)
+    end = started + deadline
+    while pending:
+        remaining = end - time.monotonic()
+        if remaining <= 0:
+            break
+        done, pending = wait_futures(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+        for f in done:
+            name = futures[f]
+            try:
+                line = {"section": name, "status": "ok"}
+                line.update(f.result())
+            except StockDataError as e:
+                line = {"section": name, "status": "error", "message": str(e)}
+            except Exception as e:
+                logger.warning("資料包區塊 %s 失敗: %s", name, e)
+                line = {"section": name, "status": "error", "message": "資料取得失敗"}
+            yield line
+    timeouts = sorted(futures[f] for f in pending)
+    for name in timeouts:
+        yield {"section": name, "status": "timeout"}
+    yield {"done": True, "elapsed_ms": round((time.monotonic() - started) * 1000), "timeouts": timeouts}
+
+
+@app.route('/api/stock/bundle')
+def stock_bundle():
+    """個股頁所有區塊的資料包（NDJSON 串流，每完成一個區塊輸出一行）
+
+    id=2330&start=&end=&price_start=&realtime=1&sections=chart,per,...
+    - 每行 {"section", "status": ok / error / timeout, "data", ...個別 API 的額外欄位}
+    - 最後一行 {"done": true, "elapsed_ms", "timeouts"}
+    上游資料集在伺服器端並行抓取，多個區塊共用的資料集（日K、股利、外資持股）只抓一次。
+    """
+    stock_id = request.args.get('id', '')
+    if not stock_id:
+        return api_error("缺少股票代號")
+
+    start_date = request.args.get('start', '')
+    end_date = request.args.get('end', '')
+    if not start_date or not end_date:
+        start_date, end_date = get_default_dates(6)
+    price_start = request.args.get('price_start', '') or get_default_dates(24)[0]
+
+    sections = request.args.get('sections', '')
+    sections = [s.strip() for s in sections.split(',') if s.strip()] if sections else list(BUNDLE_SECTIONS)
+    unknown = [s for s in sections if s not in BUNDLE_SECTIONS]
+    if unknown:
+        return api_error(f"未知的區塊: {', '.join(unknown)}")
+
+    warm_set.touch('viewed', [stock_id])
+    ds, builders = plan_bundle(stock_id, start_date, end_date, price_start,
+                               request.args.get('realtime', '0') == '1', dict.fromkeys(sections))
+    return ndjson_response(stream_bundle(ds, builders))
+
+
+# ============================================================
+# 收盤後快取預熱（自選股、最近瀏覽、成交量排行）
+# ============================================================
+
+WARM_ENABLED = os.environ.get("WARM_ENABLED", "1") != "0"
+# 每個交易日於此時間後預熱（各項盤後資料發布完成後，融資融券約 21:00 發布）
+WARM_TIME = dtime(*map(int, (os.environ.get("WARM_TIME") or "21:30").split(":")))
+# 隔天此時間後不再開始預熱新的個股，把額度留給開盤後的互動請求
+WARM_STOP_TIME = dtime(8, 30)
+WARM_MAX_STOCKS = int(os.environ.get("WARM_MAX_STOCKS") or 100)
+WARM_TOP_VOLUME = int(os.environ.get("WARM_TOP_VOLUME") or 50)
+# 預熱名單中的代號超過此天數未再出現（未同步自選股、未開啟頁面）即移除
+WARM_SET_DAYS = 14
+WARM_SET_PATH = os.environ.get("WARM_SET_PATH") or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "data", "warm_set.json")
+WARM_CHECK_SECONDS = 60
+# 個股頁實際請求的區塊（股利表頁面未使用）
+WARM_SECTIONS = tuple(s for s in BUNDLE_SECTIONS if s != 'dividend')
+
+
+class WarmSet:
+    """預熱名單：各來源的代號與最後出現時間，定期寫入 JSON 檔，重啟後保留"""
+
+    KINDS = ('watchlist', 'viewed')
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+        self._entries = {kind: {} for kind in self.KINDS}
+        self._dirty = False
+        try:
+            with open(path, encoding='utf-8') as f:
+                saved = json.load(f)
+            for kind in self.KINDS:
+                self._entries[kind].update(saved.get(kind, {}))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning("預熱名單讀取失敗 %s: %s", path, e)
+
+    def touch(self, kind, stock_ids):
+        """記錄代號最後出現的時間；只收股票清單中存在的代號，任意輸入不會被保存並每晚預熱"""
+        stock_ids = [sid for sid in stock_ids if sid in stock_registry]
+        if not stock_ids:
+            return
+        now = time.time()
+        with self._lock:
+            for sid in stock_ids:
+                self._entries[kind][sid] = now
+            self._dirty = True
+
+    def ids(self, kind):
+        """依最後出現時間由新到舊排列，並移除過期的代號"""
+        cutoff = time.time() - WARM_SET_DAYS * 86400
+        with self._lock:
+            entries = self._entries[kind]
+            for sid in [sid for sid, ts in entries.items() if ts < cutoff]:
+                del entries[sid]
+                self._dirty = True
+            return sorted(entries, key=entries.get, reverse=True)
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            snapshot = {kind: dict(v) for kind, v in self._entries.items()}
+            self._dirty = False
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = self.path + ".tmp"
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(snapshot, f)
+            os.replace(tmp, self.path)
+        except Exception as e:
+            logger.warning("預熱名單寫入失敗 %s: %s", self.path, e)
+
+
+warm_set = WarmSet(WARM_SET_PATH)
+
+
+def _add_months(d, months):
+    """與前端 Date.setMonth 相同的月份加減（日期超過當月天數時順延到下個月）"""
+    y, m = divmod(d.month - 1 + months, 12)
+    return datetime(d.year + y, m + 1, 1) + timedelta(days=d.day - 1)
+
+
+def _next_weekday(date_str):
+    d = datetime.strptime(date_str, "%Y-%m-%d") + timedelta(days=1)
+    while d.weekday() >= 5:
+        d += timedelta(days=1)
+    return d
+
+
+def warm_stock(stock_id, day):
+    """以 day 當天開啟個股頁（預設 6 個月區間）的參數，預先抓取並計算所有區塊，回傳失敗的區塊"""
+    fmt = "%Y-%m-%d"
+    ds, builders = plan_bundle(stock_id, _add_months(day, -6).strftime(fmt), day.strftime(fmt),
+                               _add_months(day, -24).strftime(fmt), False, WARM_SECTIONS, now=day)
+    ds.start()
+    failed = []
+    for name, build in builders.items():
+        try:
+            build()
+        except Exception as e:
+            logger.debug("預熱 %s [%s] 失敗: %s", stock_id, name, e)
+            failed.append(name)
+    return failed
+
+
+class WarmScheduler:
+    """收盤後快取預熱排程
+
+    背景執行緒每分鐘檢查一次：每個交易日 WARM_TIME 之後（或重啟後尚未預熱時），
+    以 batch 優先順序為預熱名單逐檔抓取隔天開頁會用到的資料，寫入的快取保留到隔天資料發布為止；
+    batch 可用額度不足時等待補充，隔天 WARM_STOP_TIME 之後停止。集保資料過期時一併觸發每週同步。
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._started = False
+        self.warmed_through = None  # 已完成預熱的發布日
+        self.running = False
+        self.last_run = None
+
+    def start(self):
+        if self._started or not WARM_ENABLED:
+            return
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._loop, name="warm-scheduler", daemon=True).start()
+
+    def due(self, now=None):
+        """需要預熱的發布日；今天的預熱時間未到或已預熱過時回傳 None"""
+        now = now or datetime.now()
+        published = published_through(now)
+        if published == self.warmed_through:
+            return None
+        if published == now.strftime("%Y-%m-%d") and now.time() < WARM_TIME:
+            return None
+        return published
+
+    def warm_ids(self):
+        """預熱名單：自選股 → 最近瀏覽 → 最近交易日成交量排行，去重後取前 WARM_MAX_STOCKS 檔"""
+        ids = warm_set.ids('watchlist') + warm_set.ids('viewed')
+        if WARM_TOP_VOLUME > 0:
+            panel = get_market_panel()
+            if panel is not None:
+                quotes = sorted(panel.latest_quotes(), key=lambda q: q['volume'], reverse=True)
+                ids += [q['stock_id'] for q in quotes[:WARM_TOP_VOLUME]]
+        return list(dict.fromkeys(ids))[:WARM_MAX_STOCKS]
+
+    def run(self, published):
+        day = _next_weekday(published)
+        stop_at = datetime.combine(day.date(), WARM_STOP_TIME)
+        if datetime.now() >= stop_at:
+            # 白天重啟時已過了預熱時段：不必為 0 檔的預熱先回補全市場面板
+            self.warmed_through = published
+            return
+        started = time.time()
+        ids, warmed, failed = [], [], {}
+        self.running = True
+        hold = _cache_hold_until.set(datetime.combine(day.date(), FINMIND_PUBLISH_TIME).timestamp())
+        try:
+            with finmind_priority('batch'):
+                ids = self.warm_ids()
+                for sid in ids:
+                    if not self._wait_for_quota(len(WARM_SECTIONS), stop_at):
+                        break
+                    bad = warm_stock(sid, day)
+                    warmed.append(sid)
+                    if bad:
+                        failed[sid] = bad
+        finally:
+            _cache_hold_until.reset(hold)
+            self.running = False
+        self.warmed_through = published
+        self.last_run = {
+            "published": published,
+            "for_day": day.strftime("%Y-%m-%d"),
+            "started_at": datetime.fromtimestamp(started).strftime("%Y-%m-%d %H:%M:%S"),
+            "seconds": round(time.time() - started, 1),
+            "planned": len(ids),
+            "warmed": len(warmed),
+            "failed": failed,
+        }
+        logger.info("快取預熱完成（%s 盤後資料）：%d/%d 檔，耗時 %.0f 秒",
+                    published, len(warmed), len(ids), time.time() - started)
+
+    @staticmethod
+    def _wait_for_quota(cost, stop_at):
+        """等到 batch 可用額度足夠預熱一檔（每個區塊最多一次請求），超過 stop_at 時回傳 False"""
+        while finmind_limiter.batch_available() < cost:
+            if datetime.now() >= stop_at:
+                return False
+            time.sleep(WARM_CHECK_SECONDS)
+        return datetime.now() < stop_at
+
+    def _loop(self):
+        while True:
+            try:
+                warm_set.save()
+                # 集保每週發布：過期時背景同步並預先計算全市場籌碼週變化
+                ensure_tdcc_fresh()
+                published = self.due()
+                if published:
+                    self.run(published)
+            except Exception as e:
+                logger.error("快取預熱排程錯誤: %s", e)
+            time.sleep(WARM_CHECK_SECONDS)
+
+    def status(self):
+        return {
+            "enabled": WARM_ENABLED,
+            "warm_time": WARM_TIME.strftime("%H:%M"),
+            "running": self.running,
+            "warmed_through": self.warmed_through,
+            "last_run": self.last_run,
+            "watchlist": len(warm_set.ids('watchlist')),
+            "viewed": len(warm_set.ids('viewed')),
+        }
+
+
+warm_scheduler = WarmScheduler()
+
+
+@app.before_request
+def _start_warm_scheduler():
+    # 於第一個請求時啟動（避免 debug reloader 的監控行程也啟動一份）
+    warm_scheduler.start()
+
+
+@app.route('/api/warm/watchlist', methods=['POST'])
+def warm_watchlist():
+    """前端同步自選股到預熱名單：{"ids": ["2330", ...]}"""
+    body = request.get_json(silent=True) or {}
+    ids = [str(s).strip() for s in body.get('ids', [])]
+    ids = [s for s in ids if s.isalnum() and len(s) <= 6]
+    if len(ids) > 200:
+        return api_error("一次最多同步 200 檔")
+    warm_set.touch('watchlist', ids)
+    return api_ok({"count": len(ids)})
+
+
+@app.route('/api/warm/status')
+def warm_status():
+    """快取預熱排程狀態與上次執行結果"""
+    return api_ok(warm_scheduler.status())
+
+
 # ============================================================
 # 啟動伺服器
 # ============================================================
@@ -1058,216 +3553,1194 @@ def stock_news():
 # ============================================================
 # 自訂多空選股掃描 (Screener)
 # ============================================================
-from concurrent.futures import ThreadPoolExecutor
 
-def analyze_single_stock(stock_id, conditions):
-    """分析單檔股票是否符合自訂條件"""
-    try:
-        # 由於需要MA20跟MACD，至少往前抓120天以上確保均線正確
-        start_date = (datetime.now() - timedelta(days=120)).strftime('%Y-%m-%d')
-        end_date = datetime.now().strftime('%Y-%m-%d')
-        
-        # 取得歷史價格 (使用 FinMind)
-        hist = finmind_request("TaiwanStockPrice", data_id=stock_id, start_date=start_date, end_date=end_date)
-        
-        if not hist or len(hist) < 20: 
-            return None # 資料不足
+def _yahoo_chip_diffs(stock_id):
+    """從 Yahoo 大戶籌碼頁取得最近一週的 (大戶變化, 散戶變化)，資料不足時回傳 None
 
-        # 將價格資料轉換成 DataFrame 並運算指標
-        import pandas as pd
-        import ta
-        
-        df = pd.DataFrame(hist)
-        df = df.dropna(subset=['close', 'max', 'min'])
-        
-        if len(df) < 20:
-            return None
-            
-        close = df['close'].astype(float)
-        high = df['max'].astype(float)
-        low = df['min'].astype(float)
-        
-        # 指標預運算與填補空值
-        ma20_list = ta.trend.SMAIndicator(close, window=20).sma_indicator().fillna(0).tolist()
-        stoch = ta.momentum.StochasticOscillator(high, low, close, window=9, smooth_window=3)
-        k_list = stoch.stoch().fillna(0).tolist()
-        d_list = stoch.stoch_signal().fillna(0).tolist()
-        macd = ta.trend.MACD(close, window_slow=26, window_fast=12, window_sign=9)
-        hist_list = macd.macd_diff().fillna(0).tolist()
-        dif_list = macd.macd().fillna(0).tolist()
-        dea_list = macd.macd_signal().fillna(0).tolist()
-        
-        # 取最新一天的數值
-        last_price = float(df.iloc[-1]['close'])
-        ma20 = ma20_list[-1]
-        k = k_list[-1]
-        d = d_list[-1]
-        prev_k = k_list[-2] if len(k_list) > 1 else 0
-        prev_d = d_list[-2] if len(d_list) > 1 else 0
-        
-        macd_hist = hist_list[-1]
-        dif = dif_list[-1]
-        dea = dea_list[-1]
-        prev_dif = dif_list[-2] if len(dif_list) > 1 else 0
-        prev_dea = dea_list[-2] if len(dea_list) > 1 else 0
-
-        # 套用條件過濾
-        match = True
-        for cond in conditions:
-            if cond == 'price_above_ma20':
-                if not (last_price > ma20 and ma20 > 0): match = False
-            elif cond == 'price_below_ma20':
-                if not (last_price < ma20 and ma20 > 0): match = False
-            elif cond == 'kd_golden_cross':
-                if not (prev_k < prev_d and k >= d): match = False
-            elif cond == 'kd_death_cross':
-                if not (prev_k > prev_d and k <= d): match = False
-            elif cond == 'macd_histogram_positive':
-                if not (macd_hist > 0): match = False
-            elif cond == 'macd_golden_cross':
-                if not (prev_dif < prev_dea and dif >= dea): match = False
-            elif cond == 'macd_entanglement':
-                # MACD糾纏：近 4 日內 DIF 與 DEA 的差值(亦即 histogram)絕對值都極小
-                # 設定門檻：過去四根柱狀體絕對值的最大值，小於等於個股當前價格的 0.15% (視為貼合平移)
-                if len(hist_list) < 4:
-                    match = False
-                else:
-                    max_abs_hist = max(abs(h) for h in hist_list[-4:])
-                    if max_abs_hist > (last_price * 0.0015): 
-                        match = False
-                        
-        # 如果包含籌碼條件，需要取得籌碼資料
-        has_chip_cond = any(c.startswith('chip_') for c in conditions)
-        major_diff_str = ""
-        retail_diff_str = ""
-        chip_scenario = ""
-        
-        if match and has_chip_cond:
-            yahoo_cache_key = f"yahoo_{stock_id}"
-            yahoo_data = yahoo_cache.get(yahoo_cache_key)
-            if not yahoo_data:
-                yahoo_data = []
-                yahoo_url = f"https://tw.stock.yahoo.com/quote/{stock_id}/major-holders"
-                yahoo_headers = {'User-Agent': 'Mozilla/5.0'}
-                try:
-                    resp = req.get(yahoo_url, headers=yahoo_headers, timeout=5)
-                    if resp.status_code == 200:
-                        from bs4 import BeautifulSoup
-                        soup = BeautifulSoup(resp.text, 'html.parser')
-                        lis = soup.find_all('li', class_='List(n)')
-                        for li in lis:
-                            rd = li.find('div', class_=lambda x: x and 'table-row' in x)
-                            if rd:
-                                cols = rd.find_all('div', recursive=False)
-                                if len(cols) >= 5:
-                                    d_str = cols[0].text.strip().replace('/', '-')
-                                    col1 = cols[1].text.strip().replace('%', '') # 大戶
-                                    col3 = cols[3].text.strip().replace('%', '') # 散戶
-                                    if d_str and col1 and col1 != '-':
-                                        yahoo_data.append({
-                                            'date': d_str,
-                                            'major_ratio': float(col1),
-                                            'retail_ratio': float(col3) if col3 and col3 != '-' else 0
-                                        })
-                        if yahoo_data:
-                            yahoo_cache.set(yahoo_cache_key, yahoo_data)
-                except Exception as e:
-                    pass
-            
-            if yahoo_data and len(yahoo_data) >= 2:
-                curr = yahoo_data[0]
-                prev = yahoo_data[1]
-                major_diff = curr['major_ratio'] - prev['major_ratio']
-                retail_diff = curr['retail_ratio'] - prev['retail_ratio']
-                
-                major_diff_str = f"{major_diff:+.2f}%"
-                retail_diff_str = f"{retail_diff:+.2f}%"
-                
-                if major_diff > 0 and retail_diff < 0:
-                    chip_scenario = '黃金交叉'
-                elif major_diff < 0 and retail_diff > 0:
-                    chip_scenario = '死亡交叉'
-                elif major_diff > 0 and retail_diff > 0:
-                    chip_scenario = '高檔強軋'
-                else:
-                    chip_scenario = '無人問津'
-                
-                for cond in conditions:
-                    if cond == 'chip_golden_cross':
-                        if not (major_diff > 0 and retail_diff < 0): match = False
-                    elif cond == 'chip_death_cross':
-                        if not (major_diff < 0 and retail_diff > 0): match = False
-                    elif cond == 'chip_divergence':
-                        # 高檔籌碼背離：股價高過 MA20 但大戶連兩降 (簡單邏輯: 大戶減少)
-                        if not (last_price > ma20 and major_diff < 0): match = False
+    Yahoo 沒有散戶（<=50 張）級距，retail_ratio 只是 100 - 大戶比例的粗估，
+    以它算出的散戶變化恆等於負的大戶變化，因此散戶變化回傳 None（無法判定）。
+    """
+    yahoo_data = fetch_yahoo_holders(stock_id)
+    if len(yahoo_data) < 2:
+        return None
+    curr = yahoo_data[0]
+    prev = yahoo_data[1]
+    return curr['major_ratio'] - prev['major_ratio'], None
+
+
+def chip_scenario(major_diff, retail_diff):
+    """大戶 / 散戶週變化對應的籌碼情境"""
+    if major_diff > 0 and retail_diff < 0:
+        return '黃金交叉'
+    if major_diff < 0 and retail_diff > 0:
+        return '死亡交叉'
+    if major_diff > 0 and retail_diff > 0:
+        return '高檔強軋'
+    return '無人問津'
+
+
+# ============================================================
+# 向量化選股引擎（stocks × days 矩陣）
+# ============================================================
+
+def _build_price_matrix(series, stock_ids, fields=('close', 'max', 'min')):
+    """將各檔日K（PricePanel.series 格式）排成右對齊的 (股票數 × 天數) 矩陣
+
+    每一列的最後一欄即該檔最後一根K棒，較早的空位補 NaN；回傳 (ids, lengths, {field: matrix})
+    """
+    ids = [sid for sid in stock_ids if sid in series]
+    lengths = np.array([len(series[sid]['close']) for sid in ids], dtype=int)
+    width = int(lengths.max()) if len(ids) else 0
+    mats = {f: np.full((len(ids), width), np.nan) for f in fields}
+    for i, sid in enumerate(ids):
+        entry = series[sid]
+        n = lengths[i]
+        for f in fields:
+            mats[f][i, width - n:] = entry[f]
+    return ids, lengths, mats
+
+
+def _rolling_matrix(mat, window, func):
+    """逐列滾動視窗運算；視窗內含 NaN（資料不足）時結果為 NaN，等同 min_periods=window"""
+    out = np.full(mat.shape, np.nan)
+    if mat.shape[1] >= window:
+        windows = np.lib.stride_tricks.sliding_window_view(mat, window, axis=1)
+        out[:, window - 1:] = func(windows, axis=2)
+    return out
+
+
+def _ema_matrix(mat, span, alpha=None):
+    """逐列 EMA（adjust=False, min_periods=span），與 ta / pandas ewm 結果一致
+
+    alpha 預設為 2 / (span + 1)；RSI 的 Wilder 平滑傳入 1 / span
+    """
+    if alpha is None:
+        alpha = 2.0 / (span + 1)
+    out = np.full(mat.shape, np.nan)
+    state = np.full(mat.shape[0], np.nan)
+    count = np.zeros(mat.shape[0], dtype=int)
+    for j in range(mat.shape[1]):
+        x = mat[:, j]
+        valid = ~np.isnan(x)
+        state = np.where(valid, np.where(np.isnan(state), x, alpha * x + (1 - alpha) * state), state)
+        count += valid
+        out[:, j] = np.where(valid & (count >= span), state, np.nan)
+    return out
+
+
+def _shift_matrix(mat, n=1):
+    """各列往右平移 n 天（第 j 欄為 n 天前的值），左側補 NaN"""
+    out = np.full(mat.shape, np.nan)
+    if n < mat.shape[1]:
+        out[:, n:] = mat[:, :mat.shape[1] - n]
+    return out
+
+
+def _fillna0(mat):
+    """NaN → 0（inf 保留），對應 pandas fillna(0)"""
+    return np.where(np.isnan(mat), 0.0, mat)
+
+
+def _rsi_matrix(close, window=14):
+    """逐列 RSI（Wilder 平滑），與 ta RSIIndicator 一致：首根K棒的漲跌視為 0，資料不足為 NaN"""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        diff = np.where(np.isnan(close), np.nan, np.nan_to_num(close - _shift_matrix(close)))
+        up = _ema_matrix(np.where(diff > 0, diff, np.where(np.isnan(diff), np.nan, 0.0)), window, 1.0 / window)
+        down = _ema_matrix(np.where(diff < 0, -diff, np.where(np.isnan(diff), np.nan, 0.0)), window, 1.0 / window)
+        return np.where(down == 0, 100.0, 100 - 100 / (1 + up / down))
+
+
+def compute_screen_indicators(close, high, low):
+    """一次計算全部股票的 MA20、KD(9,3)、MACD(12,26,9)，NaN 以 0 填補（與逐檔版本相同）"""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ma20 = _rolling_matrix(close, 20, np.mean)
+        smin = _rolling_matrix(low, 9, np.min)
+        smax = _rolling_matrix(high, 9, np.max)
+        k = 100 * (close - smin) / (smax - smin)
+        d = _rolling_matrix(k, 3, np.mean)
+        macd = _ema_matrix(close, 12) - _ema_matrix(close, 26)
+        signal = _ema_matrix(macd, 9)
+        hist = macd - signal
+    return {
+        'ma20': _fillna0(ma20),
+        'k': _fillna0(k),
+        'd': _fillna0(d),
+        'macd': _fillna0(macd),
+        'macd_signal': _fillna0(signal),
+        'macd_hist': _fillna0(hist),
+    }
+
+
+# ============================================================
+# 選股運算式（宣告式條件 → 向量化遮罩，依取得成本分層求值）
+# ============================================================
+#
+# 例：rsi < 30 and macd_golden_cross and foreign_days > 3 and yield > 5
+#
+# 語法：and / or / not（亦可寫 且 / 或 / 非、&& / || / !）、比較 < <= > >= == !=、
+# 四則運算與括號；原本的勾選條件代號（kd_golden_cross 等）可直接當作布林條件使用。
+# 欄位依取得成本分層：價格與技術指標由本機價格面板整批以矩陣算出，
+# 結果仍無法確定的個股才逐檔往下一層查詢（本益比 → 三大法人 → 集保籌碼）。
+
+TIER_PRICE, TIER_PER, TIER_INSTITUTIONAL, TIER_CHIP = range(4)
+SCREEN_TIERS = ('price', 'per', 'institutional', 'chip')
+
+# 欄位: (層級, 說明)
+SCREEN_FIELDS = {
+    'open': (TIER_PRICE, '開盤價'),
+    'high': (TIER_PRICE, '最高價'),
+    'low': (TIER_PRICE, '最低價'),
+    'close': (TIER_PRICE, '收盤價'),
+    'volume': (TIER_PRICE, '成交量（張）'),
+    'change_pct': (TIER_PRICE, '漲跌幅（%）'),
+    'ma5': (TIER_PRICE, '5 日均線'),
+    'ma10': (TIER_PRICE, '10 日均線'),
+    'ma20': (TIER_PRICE, '20 日均線（月線）'),
+    'ma60': (TIER_PRICE, '60 日均線（季線）'),
+    'rsi': (TIER_PRICE, 'RSI(14)'),
+    'k': (TIER_PRICE, 'KD(9,3) 的 K 值'),
+    'd': (TIER_PRICE, 'KD(9,3) 的 D 值'),
+    'macd': (TIER_PRICE, 'MACD 快線 DIF(12,26)'),
+    'macd_signal': (TIER_PRICE, 'MACD 慢線 DEA(9)'),
+    'macd_hist': (TIER_PRICE, 'MACD 柱狀體'),
+    'per': (TIER_PER, '本益比'),
+    'pbr': (TIER_PER, '股價淨值比'),
+    'yield': (TIER_PER, '殖利率（%）'),
+    'foreign_days': (TIER_INSTITUTIONAL, '外資連續買賣超天數（正=連買，負=連賣）'),
+    'trust_days': (TIER_INSTITUTIONAL, '投信連續買賣超天數'),
+    'dealer_days': (TIER_INSTITUTIONAL, '自營商連續買賣超天數'),
+    'foreign_net': (TIER_INSTITUTIONAL, '外資最近一日買賣超（張）'),
+    'trust_net': (TIER_INSTITUTIONAL, '投信最近一日買賣超（張）'),
+    'dealer_net': (TIER_INSTITUTIONAL, '自營商最近一日買賣超（張）'),
+    'major_diff': (TIER_CHIP, '大戶（>400 張）持股比例週變化（百分點）'),
+    'retail_diff': (TIER_CHIP, '散戶（<=50 張）持股比例週變化（百分點）'),
+}
+
+# 價格層欄位的矩陣算法；MA20、KD、MACD 沿用 compute_screen_indicators（NaN 以 0 填補）
+SCREEN_PRICE_FIELDS = {
+    'open': lambda m: m['open'],
+    'high': lambda m: m['max'],
+    'low': lambda m: m['min'],
+    'close': lambda m: m['close'],
+    'volume': lambda m: m['Trading_Volume'] / 1000,
+    'change_pct': lambda m: (m['close'] / _shift_matrix(m['close']) - 1) * 100,
+    'ma5': lambda m: _rolling_matrix(m['close'], 5, np.mean),
+    'ma10': lambda m: _rolling_matrix(m['close'], 10, np.mean),
+    'ma60': lambda m: _rolling_matrix(m['close'], 60, np.mean),
+    'rsi': lambda m: _rsi_matrix(m['close']),
+}
+
+# 函式: (參數個數, 說明)；需要歷史的函式只能套用在價格層欄位
+SCREEN_FUNCTIONS = {
+    'cross_up': (2, 'cross_up(a, b)：a 由下往上穿過 b（前一日 a < b，當日 a >= b）'),
+    'cross_down': (2, 'cross_down(a, b)：a 由上往下跌破 b'),
+    'prev': ((1, 2), 'prev(x, n)：n 天前的值（n 預設 1）'),
+    'max': (2, 'max(x, n)：近 n 日最大值'),
+    'min': (2, 'min(x, n)：近 n 日最小值'),
+    'avg': (2, 'avg(x, n)：近 n 日平均'),
+    'abs': (1, 'abs(x)：絕對值'),
+}
+
+# 原本的勾選條件改以運算式定義
+SCREEN_MACROS = {
+    'price_above_ma20': 'close > ma20 and ma20 > 0',
+    'price_below_ma20': 'close < ma20 and ma20 > 0',
+    'kd_golden_cross': 'cross_up(k, d)',
+    'kd_death_cross': 'cross_down(k, d)',
+    'macd_histogram_positive': 'macd_hist > 0',
+    'macd_golden_cross': 'cross_up(macd, macd_signal)',
+    # MACD糾纏：近 4 日柱狀體絕對值最大值 ≤ 收盤價 0.15%
+    'macd_entanglement': 'max(abs(macd_hist), 4) <= close * 0.0015',
+    'chip_golden_cross': 'major_diff > 0 and retail_diff < 0',
+    'chip_death_cross': 'major_diff < 0 and retail_diff > 0',
+    # 高檔籌碼背離：股價高過 MA20 但大戶減少
+    'chip_divergence': 'close > ma20 and major_diff < 0',
+}
+
+SCREEN_EXPR_MAX_LENGTH = 500
+# 價格面板涵蓋 PANEL_LOOKBACK_DAYS 個日曆天，扣掉週末與連假後約可用的K棒數；
+# 回看天數（含指標暖機）超過此值的運算式只會得到 NaN，解析時即拒絕
+SCREEN_MAX_LOOKBACK = PANEL_LOOKBACK_DAYS * 5 // 7 - 10
+SCREEN_MIN_BARS = 20  # 日K不足 20 根的個股不列入
+
+# 價格層欄位算出第一個有效值所需的K棒數，未列出者為 1
+SCREEN_FIELD_LOOKBACK = {
+    'change_pct': 2, 'ma5': 5, 'ma10': 10, 'ma20': 20, 'ma60': 60, 'rsi': 14,
+    'k': 9, 'd': 11, 'macd': 26, 'macd_signal': 34, 'macd_hist': 34,
+}
+
+_EXPR_TOKEN = re.compile(r"""\s*(?:
+    (?P<num>\d+(?:\.\d+)?%?)
+  | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+  | (?P<op><=|>=|==|!=|&&|\|\||[<>=!()+\-*/,])
+  | (?P<word>且|或|非)
+)""", re.VERBOSE)
+_EXPR_KEYWORDS = {'and': 'and', '且': 'and', '&&': 'and',
+                  'or': 'or', '或': 'or', '||': 'or',
+                  'not': 'not', '非': 'not', '!': 'not'}
+_EXPR_COMPARE = {
+    '<': np.less, '<=': np.less_equal, '>': np.greater, '>=': np.greater_equal,
+    '==': np.equal, '=': np.equal, '!=': np.not_equal,
+}
+_EXPR_ARITH = {'+': np.add, '-': np.subtract, '*': np.multiply, '/': np.divide}
+
+
+class ScreenExprError(ValueError):
+    """選股運算式無法解析（訊息可直接回給使用者）"""
+
+
+class _ExprNode:
+    """編譯後的節點
+
+    fn(frame, idx, lag) 對 frame 中 idx 這些列、lag 天前求值：
+    數值節點回傳 (values, known)，布林節點回傳 (true, false) 兩個遮罩（皆為 False 代表尚無法判定）。
+    tier 為用到的最高成本層級（常數為 -1），lookback 為需要的K棒數（含指標暖機）。
+    只用到價格層的數值節點改給 build(frame)：對整個 frame 算出 (股票數 × 天數) 矩陣，
+    每個 frame 只算一次，求值時取 lag 天前那一欄，巢狀的 prev / max / avg 不會重複展開。
+    """
+
+    __slots__ = ('kind', 'tier', 'lookback', 'fn', 'build')
+
+    def __init__(self, kind, tier, lookback, fn=None, build=None):
+        self.kind = kind
+        self.tier = tier
+        self.lookback = lookback
+        self.build = build
+        self.fn = fn or self.column
+
+    def matrix(self, frame):
+        return frame.node_matrix(self)
+
+    def column(self, frame, idx, lag):
+        return frame.column(self.matrix(frame), idx, lag), np.ones(len(idx), dtype=bool)
+
+
+def _tokenize_expr(text):
+    """切成 (種類, 值, 位置)；關鍵字統一為 and / or / not"""
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        m = _EXPR_TOKEN.match(text, pos)
+        if m is None or m.end() == pos:
+            pos = len(text) - len(text[pos:].lstrip())
+            raise ScreenExprError(f"第 {pos + 1} 個字元無法辨識：{text[pos:pos + 10]!r}")
+        kind = m.lastgroup
+        value = m.group(kind)
+        at = m.start(kind)
+        if kind == 'name':
+            value = value.lower()
+        if value in _EXPR_KEYWORDS:
+            kind, value = 'kw', _EXPR_KEYWORDS[value]
+        elif kind == 'word':
+            kind = 'kw'
+        tokens.append((kind, value, at))
+        pos = m.end()
+    return tokens
+
+
+class _ExprParser:
+    """遞迴下降解析：or → and → not → 比較 → 加減 → 乘除 → 單元 → 基本項"""
+
+    def __init__(self, text, macro_stack=()):
+        self.text = text
+        self.tokens = _tokenize_expr(text)
+        self.pos = 0
+        self.fields = set()
+        self.macro_stack = macro_stack
+
+    def error(self, message, token=None):
+        token = token or self.peek()
+        where = f"第 {token[2] + 1} 個字元" if token else "結尾"
+        raise ScreenExprError(f"{where}：{message}")
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def accept(self, value):
+        token = self.peek()
+        if token is not None and token[1] == value and token[0] in ('op', 'kw'):
+            self.pos += 1
+            return token
+        return None
+
+    def expect(self, value):
+        if self.accept(value) is None:
+            self.error(f"預期為 {value!r}")
+
+    def parse(self):
+        if not self.tokens:
+            raise ScreenExprError("運算式為空白")
+        node = self.parse_or()
+        if self.peek() is not None:
+            self.error("多餘的內容")
+        return self.require(node, 'bool', self.tokens[0])
+
+    def require(self, node, kind, token):
+        if node.kind != kind:
+            self.error("此處需要條件（例如 rsi < 30）" if kind == 'bool' else "此處需要數值", token)
+        return node
+
+    def parse_or(self):
+        token = self.peek()
+        node = self.parse_and()
+        while (op := self.accept('or')) is not None:
+            left = self.require(node, 'bool', token)
+            right = self.require(self.parse_and(), 'bool', op)
+            node = _bool_node(left, right, 'or')
+        return node
+
+    def parse_and(self):
+        token = self.peek()
+        node = self.parse_not()
+        while (op := self.accept('and')) is not None:
+            left = self.require(node, 'bool', token)
+            right = self.require(self.parse_not(), 'bool', op)
+            node = _bool_node(left, right, 'and')
+        return node
+
+    def parse_not(self):
+        op = self.accept('not')
+        if op is None:
+            return self.parse_compare()
+        operand = self.require(self.parse_not(), 'bool', op)
+        return _ExprNode('bool', operand.tier, operand.lookback,
+                         lambda frame, idx, lag: operand.fn(frame, idx, lag)[::-1])
+
+    def parse_compare(self):
+        token = self.peek()
+        left = self.parse_sum()
+        op = self.peek()
+        if op is None or op[0] != 'op' or op[1] not in _EXPR_COMPARE:
+            return left
+        self.pos += 1
+        self.require(left, 'num', token)
+        right = self.require(self.parse_sum(), 'num', op)
+        compare = _EXPR_COMPARE[op[1]]
+
+        def fn(frame, idx, lag):
+            a, a_known = left.fn(frame, idx, lag)
+            b, b_known = right.fn(frame, idx, lag)
+            with np.errstate(invalid='ignore'):
+                result = compare(a, b)
+            # 已載入但缺值（NaN）同樣視為無法判定，否則 not 會讓缺資料的個股反而成立
+            known = a_known & b_known & np.isfinite(a) & np.isfinite(b)
+            return known & result, known & ~result
+        return _ExprNode('bool', max(left.tier, right.tier), max(left.lookback, right.lookback), fn)
+
+    def parse_sum(self):
+        return self.parse_arith(self.parse_term, ('+', '-'))
+
+    def parse_term(self):
+        return self.parse_arith(self.parse_unary, ('*', '/'))
+
+    def parse_arith(self, operand, ops):
+        token = self.peek()
+        node = operand()
+        while (op := self.peek()) is not None and op[0] == 'op' and op[1] in ops:
+            self.pos += 1
+            left = self.require(node, 'num', token)
+            right = self.require(operand(), 'num', op)
+            node = _arith_node(left, right, _EXPR_ARITH[op[1]])
+        return node
+
+    def parse_unary(self):
+        op = self.accept('-')
+        if op is None:
+            return self.parse_atom()
+        operand = self.require(self.parse_unary(), 'num', op)
+        return _arith_node(_const_node(0.0), operand, np.subtract)
+
+    def parse_atom(self):
+        token = self.peek()
+        if token is None:
+            self.error("運算式不完整")
+        kind, value, _ = token
+        if kind == 'num':
+            self.pos += 1
+            return _const_node(float(value.rstrip('%')))
+        if self.accept('('):
+            node = self.parse_or()
+            self.expect(')')
+            return node
+        if kind != 'name':
+            self.error(f"非預期的 {value!r}")
+        self.pos += 1
+        if self.accept('('):
+            return self.parse_call(token)
+        if value in SCREEN_FIELDS:
+            self.fields.add(value)
+            return _field_node(value)
+        if value in SCREEN_MACROS:
+            return self.parse_macro(token)
+        self.error(f"未知的欄位或條件 {value!r}", token)
+
+    def parse_macro(self, token):
+        name = token[1]
+        if name in self.macro_stack:
+            self.error(f"條件 {name!r} 循環引用", token)
+        sub = _ExprParser(SCREEN_MACROS[name], self.macro_stack + (name,))
+        node = sub.parse()
+        self.fields |= sub.fields
+        return node
+
+    def parse_call(self, token):
+        name = token[1]
+        if name not in SCREEN_FUNCTIONS:
+            self.error(f"未知的函式 {name!r}", token)
+        args = []
+        if self.accept(')') is None:
+            while True:
+                args.append((self.pos, self.parse_or()))
+                if self.accept(')') is not None:
+                    break
+                self.expect(',')
+        arity = SCREEN_FUNCTIONS[name][0]
+        if len(args) not in (arity if isinstance(arity, tuple) else (arity,)):
+            self.error(f"{name}() 參數個數錯誤：{SCREEN_FUNCTIONS[name][1]}", token)
+        nodes = [self.require(node, 'num', self.tokens[at]) for at, node in args]
+
+        if name == 'abs':
+            return _abs_node(nodes[0])
+        for node in nodes:
+            if node.tier > TIER_PRICE:
+                self.error(f"{name}() 需要歷史資料，只能用於價格與技術指標欄位", token)
+        if name in ('cross_up', 'cross_down'):
+            node = _cross_node(nodes[0], nodes[1], name == 'cross_up')
+        else:
+            n = self.window_arg(args[1] if len(args) > 1 else None, name)
+            if name == 'prev':
+                node = _prev_node(nodes[0], n)
+            else:
+                node = _window_node(nodes[0], n, {'max': np.max, 'min': np.min, 'avg': np.mean}[name])
+        if node.lookback > SCREEN_MAX_LOOKBACK:
+            self.error(f"{name}() 需回看 {node.lookback} 根K棒（含指標暖機），"
+                       f"超過價格資料可提供的 {SCREEN_MAX_LOOKBACK} 根", token)
+        return node
+
+    def window_arg(self, arg, name):
+        if arg is None:
+            return 1
+        at, _ = arg
+        token = self.tokens[at]
+        # 天數只接受單一整數常數（其後緊接著 ) 或 ,）
+        if token[0] != 'num' or not token[1].isdigit() or self.tokens[at + 1][1] not in (')', ','):
+            self.error(f"{name}() 的天數必須是正整數", token)
+        n = int(token[1])
+        if not 1 <= n <= SCREEN_MAX_LOOKBACK:
+            self.error(f"{name}() 的天數需介於 1 ~ {SCREEN_MAX_LOOKBACK}", token)
+        return n
+
+
+def _const_node(value):
+    def fn(frame, idx, lag):
+        return np.full(len(idx), value), np.ones(len(idx), dtype=bool)
+    return _ExprNode('num', -1, 0, fn, build=lambda frame: np.full((len(frame), frame.width), value))
+
+
+def _field_node(name):
+    tier = SCREEN_FIELDS[name][0]
+    if tier == TIER_PRICE:
+        return _ExprNode('num', tier, SCREEN_FIELD_LOOKBACK.get(name, 1), build=lambda frame: frame.price(name))
+
+    def fn(frame, idx, lag):
+        return frame.values[name][idx], frame.loaded[tier][idx]
+    return _ExprNode('num', tier, 0, fn)
+
+
+def _bool_node(left, right, op):
+    def fn(frame, idx, lag):
+        lt, lf = left.fn(frame, idx, lag)
+        rt, rf = right.fn(frame, idx, lag)
+        if op == 'and':
+            return lt & rt, lf | rf
+        return lt | rt, lf & rf
+    return _ExprNode('bool', max(left.tier, right.tier), max(left.lookback, right.lookback), fn)
+
+
+def _arith_node(left, right, op):
+    tier = max(left.tier, right.tier)
+    lookback = max(left.lookback, right.lookback)
+    if tier <= TIER_PRICE:
+        return _ExprNode('num', tier, lookback, build=lambda frame: op(left.matrix(frame), right.matrix(frame)))
+
+    def fn(frame, idx, lag):
+        a, a_known = left.fn(frame, idx, lag)
+        b, b_known = right.fn(frame, idx, lag)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return op(a, b), a_known & b_known
+    return _ExprNode('num', tier, lookback, fn)
+
+
+def _abs_node(x):
+    if x.tier <= TIER_PRICE:
+        return _ExprNode('num', x.tier, x.lookback, build=lambda frame: np.abs(x.matrix(frame)))
+
+    def fn(frame, idx, lag):
+        values, known = x.fn(frame, idx, lag)
+        return np.abs(values), known
+    return _ExprNode('num', x.tier, x.lookback, fn)
+
+
+def _cross_node(a, b, upward):
+    def fn(frame, idx, lag):
+        a0, b0 = a.fn(frame, idx, lag)[0], b.fn(frame, idx, lag)[0]
+        a1, b1 = a.fn(frame, idx, lag + 1)[0], b.fn(frame, idx, lag + 1)[0]
+        with np.errstate(invalid='ignore'):
+            result = (a1 < b1) & (a0 >= b0) if upward else (a1 > b1) & (a0 <= b0)
+        known = np.isfinite(a0) & np.isfinite(b0) & np.isfinite(a1) & np.isfinite(b1)
+        return known & result, known & ~result
+    return _ExprNode('bool', TIER_PRICE, max(a.lookback, b.lookback) + 1, fn)
+
+
+def _prev_node(x, n):
+    return _ExprNode('num', x.tier, x.lookback + n, build=lambda frame: _shift_matrix(x.matrix(frame), n))
+
+
+def _window_node(x, n, func):
+    # 視窗內有 NaN 時結果為 NaN
+    return _ExprNode('num', TIER_PRICE, x.lookback + n - 1,
+                     build=lambda frame: _rolling_matrix(x.matrix(frame), n, func))
+
+
+class ScreenExpr:
+    """編譯後的選股運算式
+
+    text 為正規化後的運算式（供工作共用判斷），fields 為用到的欄位，
+    tiers 為需要載入的非價格層級（依成本由低到高）。
+    """
+
+    def __init__(self, text):
+        parser = _ExprParser(text)
+        self.root = parser.parse()
+        self.text = ' '.join(value for _, value, _ in parser.tokens)
+        self.fields = sorted(parser.fields, key=list(SCREEN_FIELDS).index)
+        self.tiers = sorted({SCREEN_FIELDS[f][0] for f in self.fields} - {TIER_PRICE})
+
+    def evaluate(self, frame, idx):
+        """回傳 (符合, 不符合) 兩個遮罩；兩者皆 False 的列需載入下一層欄位後再判斷"""
+        return self.root.fn(frame, idx, 0)
+
+
+def compile_screen(conditions=(), expression=''):
+    """勾選條件與自訂運算式以 and 組合後編譯；兩者皆空時回傳 None"""
+    parts = sorted(set(conditions))
+    for cond in parts:
+        if cond not in SCREEN_MACROS:
+            raise ScreenExprError(f"未知的選股條件 {cond!r}")
+    if expression and expression.strip():
+        if len(expression) > SCREEN_EXPR_MAX_LENGTH:
+            raise ScreenExprError(f"運算式過長（上限 {SCREEN_EXPR_MAX_LENGTH} 字元）")
+        ScreenExpr(expression)  # 先單獨編譯，錯誤訊息中的字元位置才對得上使用者輸入
+        parts.append(f"({expression.strip()})")
+    if not parts:
+        return None
+    return ScreenExpr(' and '.join(parts))
+
+
+class ScreenFrame:
+    """一組個股的選股資料：價格矩陣（指標於首次用到時整批計算）與逐檔載入的非價格欄位"""
+
+    def __init__(self, series, stock_ids):
+        self.ids, self.lengths, self.mats = _build_price_matrix(series, stock_ids, PricePanel.FIELDS)
+        n = len(self.ids)
+        self.width = self.mats['close'].shape[1]
+        self._price = {}
+        self._nodes = {}
+        self.values = {f: np.full(n, np.nan) for f, (tier, _) in SCREEN_FIELDS.items() if tier != TIER_PRICE}
+        self.loaded = [np.ones(n, dtype=bool)] + [np.zeros(n, dtype=bool) for _ in SCREEN_TIERS[1:]]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def price(self, name):
+        mat = self._price.get(name)
+        if mat is None:
+            m = self.mats
+            if name in SCREEN_PRICE_FIELDS:
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    self._price[name] = SCREEN_PRICE_FIELDS[name](m)
+            else:
+                self._price.update(compute_screen_indicators(m['close'], m['max'], m['min']))
+            mat = self._price[name]
+        return mat
+
+    def node_matrix(self, node):
+        """運算式價格層節點的整體矩陣（同一 frame 只算一次）"""
+        mat = self._nodes.get(node)
+        if mat is None:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mat = self._nodes[node] = node.build(self)
+        return mat
+
+    def column(self, mat, idx, lag):
+        """矩陣中 idx 這些列在 lag 天前的值"""
+        if lag >= self.width:
+            return np.full(len(idx), np.nan)
+        return mat[idx, self.width - 1 - lag]
+
+    def next_tier(self, i, tiers):
+        return next((t for t in tiers if not self.loaded[t][i]), None)
+
+    def load(self, i, tier, values):
+        """寫入第 i 檔某一層的欄位值（缺值為 NaN，相關比較無法判定，最終不列入結果）"""
+        for name, value in (values or {}).items():
+            self.values[name][i] = np.nan if value is None else float(value)
+        self.loaded[tier][i] = True
+
+    def row(self, i, expr):
+        """結果列：沿用原本的收盤 / 月線 / KD / 籌碼欄位，另附運算式用到的欄位值"""
+        def value(name):
+            if SCREEN_FIELDS[name][0] == TIER_PRICE:
+                v = self.price(name)[i, -1]
             else:
-                match = False # 缺乏籌碼資料無法判定
+                v = self.values[name][i]
+            return float(v) if np.isfinite(v) else None
+
+        sid = self.ids[i]
+        row = {
+            "stock_id": sid,
+            "stock_name": get_stock_name(sid),
+            "close": value('close'),
+            "ma20": value('ma20'),
+            "k": value('k'),
+            "d": value('d'),
+            "macd_hist": value('macd_hist'),
+            "chip_scenario": "",
+            "major_diff": "",
+            "retail_diff": "",
+            "values": {name: value(name) for name in expr.fields},
+        }
+        major, retail = value('major_diff'), value('retail_diff')
+        if major is not None and retail is not None:
+            row.update({
+                "chip_scenario": chip_scenario(major, retail),
+                "major_diff": f"{major:+.2f}%",
+                "retail_diff": f"{retail:+.2f}%",
+            })
+        return row
 
-        if match:
-            return {
-                "stock_id": stock_id,
-                "stock_name": get_stock_name(stock_id),
-                "close": last_price,
-                "ma20": ma20,
-                "k": k,
-                "d": d,
-                "macd_hist": macd_hist,
-                "chip_scenario": chip_scenario,
-                "major_diff": major_diff_str,
-                "retail_diff": retail_diff_str
-            }
+
+def _screen_price_series(stock_id):
+    """面板沒有的個股改逐檔查詢日K，回傳 PricePanel.series 格式，查無資料時回傳 None"""
+    start_date = (datetime.now() - timedelta(days=PANEL_LOOKBACK_DAYS)).strftime('%Y-%m-%d')
+    end_date = datetime.now().strftime('%Y-%m-%d')
+    hist = finmind_request("TaiwanStockPrice", data_id=stock_id, start_date=start_date, end_date=end_date)
+    hist = [r for r in hist or [] if all(r.get(f) is not None for f in ('close', 'max', 'min'))]
+    if not hist:
         return None
+    entry = {'date': np.array([r['date'] for r in hist])}
+    entry.update({f: np.array([r.get(f) for r in hist], dtype=float) for f in PricePanel.FIELDS})
+    return entry
+
+
+def _screen_per_fields(stock_id):
+    """最近一筆本益比、股價淨值比、殖利率（與個股頁同一區間，可共用快取）"""
+    start_date, end_date = get_default_dates(3)
+    rows = finmind_request("TaiwanStockPER", data_id=stock_id, start_date=start_date, end_date=end_date)
+    if not rows:
+        return {}
+    last = max(rows, key=lambda r: r.get('date', ''))
+    return {'per': last.get('PER'), 'pbr': last.get('PBR'), 'yield': last.get('dividend_yield')}
+
+
+def _screen_institutional_fields(stock_id):
+    """三大法人連續買賣超天數與最近一日買賣超張數（與個股頁預設 6 個月區間相同，可共用快取）"""
+    now = datetime.now()
+    rows = finmind_request("TaiwanStockInstitutionalInvestorsBuySell", data_id=stock_id,
+                           start_date=_add_months(now, -6).strftime('%Y-%m-%d'), end_date=now.strftime('%Y-%m-%d'))
+    if not rows:
+        return {}
+    consecutive = institutional_consecutive(rows)
+    last_date = max(r.get('date', '') for r in rows)
+    fields = {}
+    for key, display in (('foreign', '外資'), ('trust', '投信'), ('dealer', '自營商')):
+        patterns = INSTITUTIONAL_NAME_PATTERNS[display]
+        day = [r for r in rows if r.get('date') == last_date and any(p in (r.get('name') or '') for p in patterns)]
+        fields[f'{key}_days'] = consecutive.get(display)
+        if day:
+            fields[f'{key}_net'] = sum((r.get('buy') or 0) - (r.get('sell') or 0) for r in day) / 1000
+    return fields
+
+
+def _screen_chip_fields(stock_id, deltas=None):
+    """大戶 / 散戶週變化：優先查集保全市場週變化，查無該檔時才抓取 Yahoo 大戶籌碼頁"""
+    diffs = deltas.get(stock_id) if deltas is not None else None
+    if diffs is None:
+        diffs = _yahoo_chip_diffs(stock_id)
+    if diffs is None:
+        return {}
+    return {'major_diff': diffs[0], 'retail_diff': diffs[1]}
+
+
+SCREEN_TIER_LOADERS = {
+    TIER_PER: _screen_per_fields,
+    TIER_INSTITUTIONAL: _screen_institutional_fields,
+    TIER_CHIP: _screen_chip_fields,
+}
+
+
+def _screen_fetch(loader, stock_id, *args):
+    """在選股執行緒池中執行逐檔查詢（批次優先權），失敗時視為缺資料"""
+    try:
+        return run_as_batch(loader, stock_id, *args)
     except Exception as e:
-        print(f"分析 {stock_id} 發生錯誤: {e}")
+        logger.warning("選股查詢 %s（%s）失敗: %s", stock_id, loader.__name__, e)
         return None
 
+
+@app.route('/api/stock/screen/fields')
+def screen_fields():
+    """列出選股運算式可用的欄位（含成本層級）、函式與條件代號，供前端說明與提示"""
+    fields = [{"name": name, "tier": SCREEN_TIERS[tier], "description": desc}
+              for name, (tier, desc) in SCREEN_FIELDS.items()]
+    functions = [{"name": name, "description": desc} for name, (_, desc) in SCREEN_FUNCTIONS.items()]
+    return api_ok(fields, functions=functions, macros=SCREEN_MACROS)
+
+
 @app.route('/api/stock/sectors')
 def stock_sectors():
     """取得所有可用的類股清單"""
-    _, df = get_stock_list()
-    if df is None or df.empty:
+    if not len(stock_registry):
         return api_error("無法取得股票清單", 503)
-    
-    # 取出所有不重複的產業類別 (過濾掉空值)
-    sectors = df['industry_category'].dropna().unique().tolist()
-    # 可以排除沒有分類的或是特定系統自帶的, 這裡簡單過濾空字串
-    sectors = [s for s in sectors if s.strip()]
-    sectors.sort()
-    
-    return api_ok(sectors)
 
+    # 不重複且非空白的產業類別（已排序）
+    return api_ok(stock_registry.industry_list())
 
-@app.route('/api/stock/screen', methods=['POST'])
-def stock_screen():
-    """平行掃描多檔股票是否符合技術面條件 (支援類股批次掃描)"""
-    data = request.get_json(silent=True) or {}
+
+@app.route('/api/stock/ranking')
+def stock_ranking():
+    """全市場 / 類股排行（成交量、漲跌幅），資料來自全市場價格面板"""
+    by = request.args.get('by', 'volume')
+    sector = request.args.get('sector', '')
+    order = request.args.get('order', 'desc')
+    try:
+        limit = min(int(request.args.get('limit', 20)), 200)
+    except ValueError:
+        return api_error("limit 參數錯誤")
+    if by not in ('volume', 'change_pct', 'change', 'close'):
+        return api_error("不支援的排行欄位")
+
+    panel = get_market_panel()
+    if panel is None:
+        return api_error("全市場日K暫時無法取得", 503)
+
+    snap = stock_registry.snapshot()
+    quotes = []
+    for q in panel.latest_quotes():
+        sid = q['stock_id']
+        if snap.names and sid not in snap.names:
+            continue  # 只列出上市櫃股票（排除權證等）
+        industry = snap.industries.get(sid, '')
+        if sector and industry != sector:
+            continue
+        q['stock_name'] = snap.names.get(sid, '')
+        q['industry_category'] = industry
+        quotes.append(q)
+
+    quotes.sort(key=lambda q: q[by], reverse=(order != 'asc'))
+    return api_ok(quotes[:limit], date=panel.last_date)
+
+
+@app.route('/api/stock/chip-ranking')
+def stock_chip_ranking():
+    """集保籌碼週變化排行（預設列出大戶持股比例增加最多的股票）"""
+    by = request.args.get('by', 'major_diff')
+    sector = request.args.get('sector', '')
+    order = request.args.get('order', 'desc')
+    try:
+        limit = min(int(request.args.get('limit', 20)), 200)
+    except ValueError:
+        return api_error("limit 參數錯誤")
+    if by not in ('major_diff', 'retail_diff', 'holders_diff', 'major_ratio'):
+        return api_error("不支援的排行欄位")
+
+    deltas = get_chip_deltas()
+    if deltas is None:
+        return api_error("集保股權分散資料不足兩週", 503)
+
+    snap = stock_registry.snapshot()
+    rows = []
+    for row in deltas.rows():
+        sid = row['stock_id']
+        if snap.names and sid not in snap.names:
+            continue  # 只列出上市櫃股票
+        industry = snap.industries.get(sid, '')
+        if sector and industry != sector:
+            continue
+        row['stock_name'] = snap.names.get(sid, '')
+        row['industry_category'] = industry
+        rows.append(row)
+
+    rows.sort(key=lambda r: r[by], reverse=(order != 'asc'))
+    return api_ok(rows[:limit], date=deltas.date, prev_date=deltas.prev_date)
+
+
+# 串流選股時進度訊框的間隔（秒）：完成的個股再多也不會更頻繁，沒有進展時也照常送出
+SCREEN_PROGRESS_SECONDS = 0.5
+# 所有掃描（串流請求與背景工作）共用的逐檔查詢執行緒數，同時進行多個掃描也不會放大上游負載
+SCREEN_WORKERS = 10
+_screen_pool = ThreadPoolExecutor(max_workers=SCREEN_WORKERS, thread_name_prefix="screen")
+
+
+def iter_screen(stock_ids, expr, should_stop=None):
+    """依完成順序產生選股事件（expr 為 ScreenExpr）
+
+    - {"type": "match", "row": 結果列}
+    - {"type": "progress", "scanned", "total", "matches"}：約每 SCREEN_PROGRESS_SECONDS 秒一次
+    - 最後為 {"type": "done", ..., "elapsed_ms"}
+    價格面板上的個股先以矩陣一次判定；仍無法確定的個股才逐檔查詢下一層欄位，
+    每取得一層就重新判定，符合或確定不符合即停止，不會為已淘汰的個股查詢昂貴資料。
+    產生器被提前關閉（用戶端中斷、工作取消）時，尚未開始的查詢會被取消；
+    should_stop() 回傳 True 時，第一個事件之前的面板回補也會中止，且不再開始逐檔查詢。
+    """
+    started = time.monotonic()
+    stock_ids = list(dict.fromkeys(stock_ids))
+    total = len(stock_ids)
+    scanned = matches = 0
+
+    def frame_event(kind):
+        return {"type": kind, "scanned": scanned, "total": total, "matches": matches}
+
+    # 優先使用全市場價格面板（每個交易日一次整批請求），不可用時才逐檔向 FinMind 查詢
+    # 選股掃描屬批次工作，FinMind 額度讓給頁面載入優先使用
+    with finmind_priority('batch'), stop_when(should_stop):
+        panel = get_market_panel()
+    # 籌碼欄位優先查集保全市場週變化，查無的個股才需逐檔爬取
+    deltas = get_chip_deltas() if TIER_CHIP in expr.tiers else None
+    if should_stop is not None and should_stop():
+        return
+
+    futures = {}  # future -> (frame, 列, 層級)；層級為 None 代表逐檔查詢日K
+
+    def advance(frame, idx):
+        """判定 frame 中 idx 這些列，回傳符合的結果列；無法確定的列排入下一層查詢"""
+        nonlocal scanned
+        rows = []
+        while len(idx):
+            enough = frame.lengths[idx] >= SCREEN_MIN_BARS
+            hit, miss = expr.evaluate(frame, idx)
+            hit &= enough
+            undecided = idx[enough & ~hit & ~miss]
+            scanned += len(idx) - len(undecided)
+            rows += [frame.row(i, expr) for i in idx[hit]]
+            local = []
+            for i in undecided:
+                tier = frame.next_tier(i, expr.tiers)
+                sid = frame.ids[i]
+                if tier is None:
+                    scanned += 1  # 所有欄位皆已載入仍無法判定（缺資料），視為不符合
+                elif tier == TIER_CHIP and deltas is not None and sid in deltas:
+                    frame.load(i, tier, _screen_chip_fields(sid, deltas))
+                    local.append(i)
+                else:
+                    args = (deltas,) if tier == TIER_CHIP else ()
+                    futures[_screen_pool.submit(_screen_fetch, SCREEN_TIER_LOADERS[tier], sid, *args)] = (frame, i, tier)
+            idx = np.array(local, dtype=int)
+        return rows
+
+    def emit(rows):
+        nonlocal matches
+        for row in rows:
+            matches += 1
+            yield {"type": "match", "row": row}
+
+    try:
+        pending = stock_ids
+        if panel is not None:
+            # 價格與技術指標條件以矩陣一次算完
+            board = ScreenFrame(panel.series, stock_ids)
+            yield from emit(advance(board, np.arange(len(board))))
+            pending = [sid for sid in stock_ids if sid not in panel]
+        for sid in pending:
+            futures[_screen_pool.submit(_screen_fetch, _screen_price_series, sid)] = (None, sid, None)
+        yield frame_event("progress")
+        last_progress = time.monotonic()
+
+        while futures:
+            done, _ = wait_futures(futures, timeout=SCREEN_PROGRESS_SECONDS, return_when=FIRST_COMPLETED)
+            for f in done:
+                frame, i, tier = futures.pop(f)
+                result = f.result()
+                if tier is None:
+                    # 面板沒有的個股：單檔組成一個 frame 後同樣由價格層開始判定
+                    if result is None:
+                        scanned += 1
+                        continue
+                    frame, i = ScreenFrame({i: result}, [i]), 0
+                else:
+                    frame.load(i, tier, result)
+                yield from emit(advance(frame, np.array([i])))
+            if time.monotonic() - last_progress >= SCREEN_PROGRESS_SECONDS:
+                last_progress = time.monotonic()
+                yield frame_event("progress")
+    finally:
+        for f in futures:
+            f.cancel()
+
+    done = frame_event("done")
+    done["elapsed_ms"] = round((time.monotonic() - started) * 1000)
+    yield done
+
+
+def _screen_universe(data):
+    """由選股請求取出 (待掃描代號, 編譯後的條件)
+
+    conditions（勾選條件代號）與 expression（自訂運算式）以 and 組合，皆未提供時條件為 None；
+    運算式有誤時拋出 ScreenExprError。
+    """
     stock_ids = data.get('stock_ids', [])
-    conditions = data.get('conditions', [])
     sector = data.get('sector', '')
-    
+
     # 若有指定類股，則從股票清單中查出該類股所有股票代號加入 stock_ids
     if sector:
-        _, df = get_stock_list()
-        if df is not None and not df.empty:
-            sector_stocks = df[df['industry_category'] == sector]['stock_id'].tolist()
-            # 聯集並去重
-            stock_ids = list(set(stock_ids + sector_stocks))
-    
+        sector_stocks = stock_registry.ids_in_industry(sector)
+        # 聯集並去重
+        stock_ids = list(set(stock_ids + sector_stocks))
+    return stock_ids, compile_screen(data.get('conditions', []), data.get('expression', ''))
+
+
+@app.route('/api/stock/screen', methods=['POST'])
+def stock_screen():
+    """平行掃描多檔股票是否符合選股條件 (支援類股批次掃描與自訂運算式)
+
+    body 帶 "stream": true 時以 NDJSON 串流輸出 iter_screen 的事件（符合的個股依完成順序送出），
+    否則掃描完成後一次回傳所有結果列。
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        stock_ids, expr = _screen_universe(data)
+    except ScreenExprError as e:
+        return api_error(str(e))
+
     if not stock_ids:
         return api_error("未提供待掃描股票代碼或找不到該類股之股票")
-    if not conditions:
+    if expr is None:
         return api_ok([]) # 無條件直接回傳空陣列
 
-    results = []
-    # 使用 ThreadPoolExecutor 平行發送查詢，加速多檔股票的過濾
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        futures = [executor.submit(analyze_single_stock, sid, conditions) for sid in stock_ids]
-        for f in futures:
-            res = f.result()
-            if res:
-                results.append(res)
-                
-    return api_ok(results)
+    if data.get('stream'):
+        return ndjson_response(iter_screen(stock_ids, expr))
+    return api_ok([e['row'] for e in iter_screen(stock_ids, expr) if e['type'] == 'match'])
+
+
+# ============================================================
+# 非同步選股工作（送出 → 查詢進度 → 分頁取結果 / 取消）
+# ============================================================
+
+# 完成的工作保留時間（秒）：同一交易日內相同範圍與條件的掃描直接回傳既有結果
+SCREEN_JOB_KEEP_SECONDS = 6 * 3600
+# 進行中的工作超過此秒數沒有被查詢（用戶端已離開）即自動取消，不再消耗上游額度
+SCREEN_JOB_ABANDON_SECONDS = 60
+SCREEN_JOB_MAX_RUNNING = 4
+SCREEN_JOB_MAX_KEPT = 100
+SCREEN_JOB_PAGE_LIMIT = 500
+
+
+class ScreenJob:
+    """一次背景選股掃描：執行 iter_screen，符合的結果列依完成順序累積，供分頁讀取
+
+    相同掃描的多個用戶端共用同一個工作，各自以訂閱代號查詢；某個用戶端取消或離開只移除自己的訂閱，
+    最後一個訂閱者取消或超過 SCREEN_JOB_ABANDON_SECONDS 未查詢時才真正取消工作。
+    """
+
+    def __init__(self, key, stock_ids, expr):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.stock_ids = stock_ids
+        self.expr = expr
+        self.status = 'running'  # running / done / cancelled / error
+        self.cancel_reason = None
+        self.scanned = 0
+        self.total = len(set(stock_ids))
+        self.rows = []
+        self.created = time.time()
+        self.finished = None
+        self._subscribers = {}  # 訂閱代號 -> 最後查詢時間（monotonic）
+        self._lock = Lock()
+        self._cancel = threading.Event()
+
+    def subscribe(self):
+        subscriber = uuid.uuid4().hex
+        with self._lock:
+            self._subscribers[subscriber] = time.monotonic()
+        return subscriber
+
+    def touch(self, subscriber):
+        with self._lock:
+            if subscriber in self._subscribers:
+                self._subscribers[subscriber] = time.monotonic()
+
+    def leave(self, subscriber):
+        """移除一個訂閱者；已沒有訂閱者時取消工作"""
+        with self._lock:
+            self._subscribers.pop(subscriber, None)
+            last = not self._subscribers
+        if last:
+            self.cancel('user')
+
+    def reusable(self):
+        """進行中（且未在取消中）或已完成的工作可直接給相同掃描沿用"""
+        return self.status == 'done' or (self.status == 'running' and not self._cancel.is_set())
+
+    def cancel(self, reason='user'):
+        if self.status == 'running' and not self._cancel.is_set():
+            self.cancel_reason = reason
+            self._cancel.set()
+
+    def should_stop(self):
+        """移除逾時未查詢的訂閱者，全部離開時視為放棄；回傳工作是否已取消"""
+        now = time.monotonic()
+        with self._lock:
+            for sub in [s for s, t in self._subscribers.items() if now - t > SCREEN_JOB_ABANDON_SECONDS]:
+                del self._subscribers[sub]
+            abandoned = not self._subscribers
+        if abandoned:
+            self.cancel('abandoned')
+        return self._cancel.is_set()
+
+    def run(self):
+        events = iter_screen(self.stock_ids, self.expr, self.should_stop)
+        try:
+            for event in events:
+                if event['type'] == 'match':
+                    self.rows.append(event['row'])
+                else:
+                    self.scanned = event['scanned']
+                if self.should_stop():
+                    break
+            self.status = 'cancelled' if self._cancel.is_set() else 'done'
+        except Exception as e:
+            logger.error("選股工作 %s 失敗: %s", self.id, e)
+            self.status = 'error'
+        finally:
+            # 關閉產生器會取消尚未開始查詢的個股
+            events.close()
+            self.finished = time.time()
+
+    def progress(self):
+        end = self.finished or time.time()
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "cancel_reason": self.cancel_reason,
+            "expression": self.expr.text,
+            "subscribers": len(self._subscribers),
+            "scanned": self.scanned,
+            "total": self.total,
+            "matches": len(self.rows),
+            "elapsed_ms": round((end - self.created) * 1000),
+        }
+
+
+class ScreenJobManager:
+    """選股工作登錄表：以 (掃描範圍, 正規化後的運算式, 交易日) 為鍵共用進行中與已完成的工作"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._jobs = OrderedDict()  # job_id -> ScreenJob（依建立順序）
+        self._by_key = {}
+
+    @staticmethod
+    def job_key(stock_ids, expr):
+        raw = json.dumps([sorted(set(stock_ids)), expr.text, published_through()])
+        return hashlib.blake2b(raw.encode('utf-8'), digest_size=16).hexdigest()
+
+    def submit(self, stock_ids, expr):
+        """回傳 (job, reused, 訂閱代號)；同時進行的工作已達上限時回傳 (None, False, None)"""
+        key = self.job_key(stock_ids, expr)
+        with self._lock:
+            self._expire()
+            job = self._jobs.get(self._by_key.get(key))
+            if job is not None and job.reusable():
+                return job, True, job.subscribe()
+            if sum(j.status == 'running' for j in self._jobs.values()) >= SCREEN_JOB_MAX_RUNNING:
+                return None, False, None
+            job = ScreenJob(key, stock_ids, expr)
+            subscriber = job.subscribe()
+            self._jobs[job.id] = job
+            self._by_key[key] = job.id
+        threading.Thread(target=job.run, name=f"screen-job-{job.id[:8]}", daemon=True).start()
+        return job, False, subscriber
+
+    def get(self, job_id, subscriber=None):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None and subscriber:
+            job.touch(subscriber)
+        return job
+
+    def _expire(self):
+        now = time.time()
+        finished = [j for j in self._jobs.values() if j.finished is not None]
+        stale = [j for j in finished if now - j.finished > SCREEN_JOB_KEEP_SECONDS]
+        # 數量超過上限時，由最早建立的已結束工作開始移除
+        stale += finished[:max(len(self._jobs) - len(stale) - SCREEN_JOB_MAX_KEPT, 0)]
+        for job in stale:
+            if self._jobs.pop(job.id, None) is not None and self._by_key.get(job.key) == job.id:
+                del self._by_key[job.key]
+
+
+screen_jobs = ScreenJobManager()
+
+
+@app.route('/api/stock/screen/jobs', methods=['POST'])
+def screen_job_submit():
+    """送出背景選股工作（body 同 /api/stock/screen），回傳工作進度；相同掃描已存在時直接沿用"""
+    data = request.get_json(silent=True) or {}
+    try:
+        stock_ids, expr = _screen_universe(data)
+    except ScreenExprError as e:
+        return api_error(str(e))
+    if not stock_ids:
+        return api_error("未提供待掃描股票代碼或找不到該類股之股票")
+    if expr is None:
+        return api_error("未提供選股條件")
+
+    job, reused, subscriber = screen_jobs.submit(stock_ids, expr)
+    if job is None:
+        return api_error("進行中的選股工作過多，請稍後再試", 429)
+    return api_ok(job.progress(), reused=reused, subscriber=subscriber)
+
+
+@app.route('/api/stock/screen/jobs/<job_id>')
+def screen_job_progress(job_id):
+    """查詢選股工作進度：帶 subscriber 定期查詢，否則視為已離開，所有訂閱者都離開時自動取消"""
+    job = screen_jobs.get(job_id, request.args.get('subscriber'))
+    if job is None:
+        return api_error("找不到選股工作", 404)
+    return api_ok(job.progress())
+
+
+@app.route('/api/stock/screen/jobs/<job_id>/results')
+def screen_job_results(job_id):
+    """分頁取得選股結果：offset / limit，結果依完成順序排列，進行中也可讀取已找到的部分"""
+    job = screen_jobs.get(job_id, request.args.get('subscriber'))
+    if job is None:
+        return api_error("找不到選股工作", 404)
+    try:
+        offset = max(int(request.args.get('offset', 0)), 0)
+        limit = min(max(int(request.args.get('limit', 100)), 1), SCREEN_JOB_PAGE_LIMIT)
+    except ValueError:
+        return api_error("offset / limit 必須為整數")
+
+    progress = job.progress()
+    rows = job.rows[offset:offset + limit]
+    return api_ok(rows, offset=offset, next_offset=offset + len(rows), job=progress)
+
+
+@app.route('/api/stock/screen/jobs/<job_id>', methods=['DELETE'])
+def screen_job_cancel(job_id):
+    """退出選股工作：?subscriber= 為送出時取得的訂閱代號，最後一個訂閱者退出時才取消工作
+    （已查詢的個股結果仍可讀取）"""
+    subscriber = request.args.get('subscriber')
+    if not subscriber:
+        return api_error("缺少 subscriber 參數")
+    job = screen_jobs.get(job_id)
+    if job is None:
+        return api_error("找不到選股工作", 404)
+    job.leave(subscriber)
+    return api_ok(job.progress())
+
 
 if __name__ == '__main__':
     # 確保 app.run 位於真正檔案結尾之前被取代或保留
@@ -19,7 +19,9 @@ async function fetchAPI(url, options = {}) {
         try {
             const res = await fetch(url, fetchOptions);
             if (!res.ok) {
-                throw new Error(`伺服器連線異常 (${res.status})`);
+                // 後端的錯誤回應（api_error）帶有可直接顯示的訊息，例如運算式錯誤、同時掃描數已滿
+                const body = await res.json().catch(() => null);
+                throw new Error(body?.message || `伺服器連線異常 (${res.status})`);
             }
 
             let data;
@@ -56,3 +58,31 @@ async function fetchAPI(url, options = {}) {
         }
     }
 }
+
+/**
+ * 讀取 NDJSON 串流回應，每解析出一行就呼叫 onLine(obj)
+ * options 直接傳給 fetch（如 POST body）；連線失敗或非 2xx 時 throw，由呼叫端決定備援方式
+ */
+async function fetchNDJSON(url, onLine, options = {}) {
+    const res = await fetch(url, options);
+    if (!res.ok || !res.body) {
+        const body = await res.json().catch(() => null);
+        throw new Error(body?.message || `伺服器連線異常 (${res.status})`);
+    }
+
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    for (;;) {
+        const { value, done } = await reader.read();
+        buffer += decoder.decode(value || new Uint8Array(), { stream: !done });
+        let idx;
+        while ((idx = buffer.indexOf('\n')) >= 0) {
+            const line = buffer.slice(0, idx).trim();
+            buffer = buffer.slice(idx + 1);
+            if (line) onLine(JSON.parse(line));
+        }
+        if (done) break;
+    }
+    if (buffer.trim()) onLine(JSON.parse(buffer));
+}
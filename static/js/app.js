@@ -52,6 +52,98 @@ function renderWatchlist() {
 
 renderWatchlist();
 
+// ============================================================
+// 本地股票目錄（IndexedDB 快取，版本不同才重新下載）
+// ============================================================
+
+const DIRECTORY_DB = 'stock-directory';
+const DIRECTORY_STORE = 'directory';
+
+const StockDirectory = {
+    items: null,
+
+    _openDB() {
+        return new Promise((resolve, reject) => {
+            const req = indexedDB.open(DIRECTORY_DB, 1);
+            req.onupgradeneeded = () => req.result.createObjectStore(DIRECTORY_STORE);
+            req.onsuccess = () => resolve(req.result);
+            req.onerror = () => reject(req.error);
+        });
+    },
+
+    async _read() {
+        const db = await this._openDB();
+        return new Promise((resolve) => {
+            const req = db.transaction(DIRECTORY_STORE).objectStore(DIRECTORY_STORE).get('current');
+            req.onsuccess = () => resolve(req.result || null);
+            req.onerror = () => resolve(null);
+        });
+    },
+
+    async _write(directory) {
+        const db = await this._openDB();
+        db.transaction(DIRECTORY_STORE, 'readwrite').objectStore(DIRECTORY_STORE).put(directory, 'current');
+    },
+
+    /**
+     * 載入目錄：先用本地版本，與伺服器版本不同時才下載新目錄
+     */
+    async load() {
+        let local = null;
+        try {
+            local = typeof indexedDB !== 'undefined' ? await this._read() : null;
+        } catch (e) {
+            console.warn('讀取本地股票目錄失敗', e);
+        }
+        if (local) this._use(local);
+
+        const remote = await fetchAPI('/api/stock/directory/version', { throwOnError: false });
+        if (!remote || (local && local.version === remote.version)) return;
+
+        const directory = await fetchAPI(`/api/stock/directory?v=${remote.version}`, { throwOnError: false });
+        if (!directory) return;
+        this._use(directory);
+        try {
+            await this._write(directory);
+        } catch (e) {
+            console.warn('寫入本地股票目錄失敗', e);
+        }
+    },
+
+    _use(directory) {
+        this.items = directory.rows.map(([id, name, ind, otc]) => ({
+            stock_id: id,
+            stock_name: name,
+            industry_category: directory.industries[ind],
+            type: otc ? 'tpex' : 'twse',
+            _id: id.toLowerCase(),
+            _name: String(name).toLowerCase(),
+            _industry: String(directory.industries[ind]).toLowerCase(),
+        }));
+    },
+
+    /**
+     * 本地搜尋，排序與伺服器相同：代號完全相符 → 代號前綴 → 名稱前綴 → 包含 → 產業別
+     */
+    search(query, limit = 20) {
+        const q = query.toLowerCase();
+        const tiers = [[], [], [], [], []];
+        for (const item of this.items) {
+            if (item._id === q) tiers[0].push(item);
+            else if (item._id.startsWith(q)) tiers[1].push(item);
+            else if (item._name.startsWith(q)) tiers[2].push(item);
+            else if (item._id.includes(q) || item._name.includes(q)) tiers[3].push(item);
+            else if (item._industry.includes(q)) tiers[4].push(item);
+        }
+        tiers[1].sort((a, b) => a._id.length - b._id.length);
+        tiers[2].sort((a, b) => a._name.length - b._name.length);
+        tiers[3].sort((a, b) => a._name.length - b._name.length);
+        return tiers.flat().slice(0, limit);
+    }
+};
+
+StockDirectory.load().catch(err => console.warn('股票目錄載入失敗:', err));
+
 // ============================================================
 // 搜尋功能
 // ============================================================
@@ -62,6 +154,14 @@ async function searchStocks(query) {
         return;
     }
 
+    // 目錄已載入時直接在本地搜尋，不需往返伺服器
+    if (StockDirectory.items) {
+        currentResults = StockDirectory.search(query);
+        activeIndex = -1;
+        renderDropdown(currentResults);
+        return;
+    }
+
     try {
         const json = await fetchAPI(`/api/stock/search?q=${encodeURIComponent(query)}`);
         // 支援新格式 { status, data } 和舊格式（直接陣列）
@@ -118,9 +218,10 @@ function navigateToStock(stockId, stockName) {
 
 searchInput.addEventListener('input', (e) => {
     clearTimeout(debounceTimer);
+    // 本地搜尋幾乎沒有成本，只需極短的防抖
     debounceTimer = setTimeout(() => {
         searchStocks(e.target.value.trim());
-    }, 300);
+    }, StockDirectory.items ? 50 : 300);
 });
 
 searchInput.addEventListener('keydown', (e) => {
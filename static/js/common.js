@@ -55,6 +55,28 @@ function getWatchlist() {
 
 function saveWatchlist(list) {
     localStorage.setItem('watchlist', JSON.stringify(list));
+    syncWarmWatchlist(list.map(s => s.id));
+}
+
+// 自選股同步到伺服器的預熱名單：收盤後預先抓取資料，隔天開頁直接命中快取
+function syncWarmWatchlist(ids) {
+    if (!ids || ids.length === 0) return;
+    fetch('/api/warm/watchlist', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ ids: ids.slice(0, 200) }),
+    }).catch(() => { });
+}
+
+// 每個瀏覽工作階段同步一次，讓長期未變更的自選股不會從預熱名單過期
+// 首頁自選股（watchlist）與選股器名單（WatchlistDB 的 user_watchlist）兩份都要同步
+if (!sessionStorage.getItem('warmWatchlistSynced')) {
+    sessionStorage.setItem('warmWatchlistSynced', '1');
+    let screenerIds = [];
+    try {
+        screenerIds = JSON.parse(localStorage.getItem('user_watchlist') || '[]');
+    } catch { }
+    syncWarmWatchlist([...new Set([...getWatchlist().map(s => s.id), ...screenerIds.map(String)])]);
 }
 
 function isInWatchlist(stockId) {
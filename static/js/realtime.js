@@ -2,13 +2,14 @@
  * 即時報價模組 — 盤中自動輪詢 TWSE/TPEX 即時報價
  *
  * 功能：
- * - 每 15 秒更新股價顯示
+ * - 優先以 SSE 串流接收伺服器推播的報價；瀏覽器不支援或串流失敗時改為每 15 秒輪詢
  * - 每 60 秒重算技術指標（含盤中數據）
  * - 交易時段自動啟停
  */
 
 // 輪詢控制
 let _realtimeTimer = null;
+let _realtimeSource = null;
 let _indicatorTimer = null;
 let _realtimeStockId = null;
 let _isPolling = false;
@@ -23,11 +24,12 @@ function startRealtimePolling(stockId) {
     _realtimeStockId = stockId;
     _isPolling = true;
 
-    // 立即執行一次
-    _fetchRealtimeQuote();
-
-    // 價格輪詢：每 15 秒
-    _realtimeTimer = setInterval(_fetchRealtimeQuote, 15000);
+    // 價格：優先使用伺服器推播，否則輪詢
+    if (typeof EventSource !== 'undefined') {
+        _openRealtimeStream();
+    } else {
+        _startQuotePolling();
+    }
 
     // 指標輪詢：每 60 秒
     _indicatorTimer = setInterval(_fetchRealtimeIndicators, 60000);
@@ -40,6 +42,10 @@ function startRealtimePolling(stockId) {
  * 停止即時報價輪詢
  */
 function stopRealtimePolling() {
+    if (_realtimeSource) {
+        _realtimeSource.close();
+        _realtimeSource = null;
+    }
     if (_realtimeTimer) {
         clearInterval(_realtimeTimer);
         _realtimeTimer = null;
@@ -52,6 +58,44 @@ function stopRealtimePolling() {
     _updateRealtimeStatus(false);
 }
 
+/**
+ * 開啟 SSE 報價串流（伺服器單一輪詢後推播有變動的報價）
+ */
+function _openRealtimeStream() {
+    const source = new EventSource(`/api/stock/realtime/stream?ids=${_realtimeStockId}`);
+    _realtimeSource = source;
+
+    source.addEventListener('quote', (e) => {
+        const data = JSON.parse(e.data)[_realtimeStockId];
+        if (data) _applyRealtimeQuote(data);
+    });
+
+    source.addEventListener('closed', () => {
+        stopRealtimePolling();
+        _updateRealtimeStatus(false, '非交易時段');
+    });
+
+    source.onerror = () => {
+        // 串流無法建立或中斷 → 改回輪詢
+        if (_realtimeSource !== source) return;
+        source.close();
+        _realtimeSource = null;
+        if (_isPolling) {
+            console.log('[即時] 串流中斷，改用輪詢');
+            _startQuotePolling();
+        }
+    };
+}
+
+/**
+ * 啟動報價輪詢：每 15 秒
+ */
+function _startQuotePolling() {
+    if (_realtimeTimer) return;
+    _fetchRealtimeQuote();
+    _realtimeTimer = setInterval(_fetchRealtimeQuote, 15000);
+}
+
 /**
  * 取得即時報價並更新 UI
  */
@@ -63,52 +107,57 @@ async function _fetchRealtimeQuote() {
 
         if (!json || json.status !== 'ok' || !json.data) {
             // 非交易時段或無數據 → 停止輪詢
-            if (!json.data?.is_trading) {
+            if (!json?.data?.is_trading) {
                 stopRealtimePolling();
                 _updateRealtimeStatus(false, '非交易時段');
             }
             return;
         }
 
-        const data = json.data;
+        _applyRealtimeQuote(json.data);
 
-        // 更新標題區股價
-        const priceEl = document.getElementById('priceValue');
-        const changeEl = document.getElementById('priceChange');
-        const dataDateEl = document.getElementById('dataDate');
+    } catch (err) {
+        console.error('[即時] 報價錯誤:', err);
+    }
+}
 
-        if (priceEl) {
-            priceEl.textContent = data.price.toFixed(2);
-        }
+/**
+ * 以報價資料更新標題區股價
+ */
+function _applyRealtimeQuote(data) {
+    // 更新標題區股價
+    const priceEl = document.getElementById('priceValue');
+    const changeEl = document.getElementById('priceChange');
+    const dataDateEl = document.getElementById('dataDate');
+
+    if (priceEl) {
+        priceEl.textContent = data.price.toFixed(2);
+    }
 
-        if (changeEl) {
-            const sign = data.change >= 0 ? '+' : '';
-            changeEl.textContent = `${sign}${data.change.toFixed(2)} (${sign}${data.change_pct.toFixed(2)}%)`;
-            changeEl.className = 'price-change ' + (data.change >= 0 ? 'up' : 'down');
-
-            // 閃爍效果
-            changeEl.style.transition = 'none';
-            changeEl.style.opacity = '0.5';
-            setTimeout(() => {
-                changeEl.style.transition = 'opacity 0.3s';
-                changeEl.style.opacity = '1';
-            }, 50);
-        }
+    if (changeEl) {
+        const sign = data.change >= 0 ? '+' : '';
+        changeEl.textContent = `${sign}${data.change.toFixed(2)} (${sign}${data.change_pct.toFixed(2)}%)`;
+        changeEl.className = 'price-change ' + (data.change >= 0 ? 'up' : 'down');
+
+        // 閃爍效果
+        changeEl.style.transition = 'none';
+        changeEl.style.opacity = '0.5';
+        setTimeout(() => {
+            changeEl.style.transition = 'opacity 0.3s';
+            changeEl.style.opacity = '1';
+        }, 50);
+    }
 
-        if (dataDateEl) {
-            dataDateEl.textContent = `即時 ${data.time || ''}`;
-        }
+    if (dataDateEl) {
+        dataDateEl.textContent = `即時 ${data.time || ''}`;
+    }
 
-        // 如果不在交易時段，自動停止
-        if (!data.is_trading) {
-            stopRealtimePolling();
-            if (dataDateEl) {
-                dataDateEl.textContent = `收盤 ${data.time || ''}`;
-            }
+    // 如果不在交易時段，自動停止
+    if (!data.is_trading) {
+        stopRealtimePolling();
+        if (dataDateEl) {
+            dataDateEl.textContent = `收盤 ${data.time || ''}`;
         }
-
-    } catch (err) {
-        console.error('[即時] 報價錯誤:', err);
     }
 }
 
@@ -9,6 +9,8 @@ document.addEventListener('DOMContentLoaded', () => {
     const resultBody = document.getElementById('resultBody');
     const resultCount = document.getElementById('resultCount');
     const themeBtn = document.getElementById('themeToggleBtn');
+    const exprInput = document.getElementById('exprInput');
+    const exprFields = document.getElementById('exprFields');
 
     // ==========================================
     // 0. 佈景主題管理 (Theme Settings)
@@ -58,7 +60,7 @@ document.addEventListener('DOMContentLoaded', () => {
                 <div class="watchlist-item">
                     <div class="item-info">
                         <span class="item-id">${id}</span>
-                        <!-- 未來可從 API 補充名稱 -->
+                        <span class="item-name" data-quote="${id}"></span>
                     </div>
                     <button class="btn-remove" data-id="${id}">移除</button>
                 </div>
@@ -66,6 +68,21 @@ document.addEventListener('DOMContentLoaded', () => {
         });
         listContainer.innerHTML = html;
         bindRemoveButtons();
+        renderWatchlistQuotes(list);
+    }
+
+    /**
+     * 以一次批次查詢補上整份自選股的名稱與即時報價
+     */
+    async function renderWatchlistQuotes(list) {
+        const quotes = await WatchlistDB.quotes(list);
+        listContainer.querySelectorAll('[data-quote]').forEach(el => {
+            const q = quotes[el.getAttribute('data-quote')];
+            if (!q) return;
+            const color = q.change > 0 ? 'var(--accent-red)' : (q.change < 0 ? 'var(--accent-green)' : 'inherit');
+            const sign = q.change > 0 ? '+' : '';
+            el.innerHTML = `${q.name} <span style="color:${color}">${q.price.toFixed(2)} (${sign}${q.change_pct}%)</span>`;
+        });
     }
 
     function bindRemoveButtons() {
@@ -108,43 +125,80 @@ document.addEventListener('DOMContentLoaded', () => {
         const stocks = WatchlistDB.get();
         if (stocks.length === 0) return;
 
-        // 收集勾選的條件
+        const criteria = collectCriteria();
+        if (!criteria) return;
+
+        runScan(scanBtn, { stock_ids: stocks, ...criteria });
+    });
+
+    /**
+     * 收集勾選的條件與自訂運算式（兩者以 and 組合），皆未提供時提示並回傳 null
+     */
+    function collectCriteria() {
         const checkedBoxes = Array.from(document.querySelectorAll('input[name="condition"]:checked'));
         const conditions = checkedBoxes.map(cb => cb.value);
+        const expression = exprInput ? exprInput.value.trim() : '';
 
-        if (conditions.length === 0) {
-            alert('請至少勾選一個過濾條件！');
-            return;
+        if (conditions.length === 0 && !expression) {
+            alert('請至少勾選一個過濾條件或輸入條件運算式！');
+            return null;
         }
+        return { conditions, expression };
+    }
 
-        // UI 狀態：掃描中
-        const originalText = scanBtn.innerHTML;
-        scanBtn.innerHTML = '掃描運算中... <span class="pulse-icon">⏳</span>';
-        scanBtn.disabled = true;
-        resultContainer.style.display = 'none';
+    async function loadExprFields() {
+        if (!exprFields) return;
+        try {
+            const res = await fetchAPI('/api/stock/screen/fields', { fullResponse: true });
+            const tierNames = { price: '價格 / 技術指標', per: '本益比', institutional: '三大法人', chip: '集保籌碼' };
+            const fieldHtml = res.data.map(f =>
+                `<div><code>${f.name}</code>（${tierNames[f.tier] || f.tier}）${f.description}</div>`).join('');
+            const funcHtml = res.functions.map(f => `<div>${f.description}</div>`).join('');
+            const macroHtml = Object.entries(res.macros).map(([name, expr]) =>
+                `<div><code>${name}</code> = <code>${expr}</code></div>`).join('');
+            exprFields.innerHTML = `${fieldHtml}<br>${funcHtml}<br>${macroHtml}`;
+        } catch (e) {
+            console.error('載入運算式欄位失敗', e);
+            exprFields.textContent = '載入失敗';
+        }
+    }
 
+    loadExprFields();
+
+    /**
+     * 以串流模式掃描：符合的個股依完成順序逐列加入結果表，按鈕顯示掃描進度
+     */
+    async function runScan(btn, body) {
+        const originalText = btn.innerHTML;
+        btn.innerHTML = '掃描運算中... <span class="pulse-icon">⏳</span>';
+        btn.disabled = true;
+        resetResults();
+
+        let matched = 0;
         try {
-            // 發送請求給後端平行過濾引擎
-            const resData = await fetchAPI('/api/stock/screen', {
+            await fetchNDJSON('/api/stock/screen', (event) => {
+                if (event.type === 'match') {
+                    appendResult(event.row);
+                    matched++;
+                } else if (event.type === 'progress') {
+                    btn.innerHTML = `掃描中 ${event.scanned}/${event.total}（符合 ${event.matches}）<span class="pulse-icon">⏳</span>`;
+                } else if (event.status === 'error') {
+                    throw new Error(event.message || 'API 錯誤');
+                }
+            }, {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({
-                    stock_ids: stocks,
-                    conditions: conditions
-                })
+                body: JSON.stringify({ ...body, stream: true })
             });
-
-            // 渲染結果
-            renderResults(resData.data);
-
+            finishResults(matched);
         } catch (error) {
             console.error('掃描失敗:', error);
-            // 錯誤已由 fetchAPI 的 Toast 處理
+            showToast(error.message || '掃描失敗，請稍後再試', 'error');
         } finally {
-            scanBtn.innerHTML = originalText;
-            scanBtn.disabled = false;
+            btn.innerHTML = originalText;
+            btn.disabled = false;
         }
-    });
+    }
 
     // ==========================================
     // 3. 類股批次掃描邏輯 (Sector Scan)
@@ -153,9 +207,9 @@ document.addEventListener('DOMContentLoaded', () => {
     async function loadSectors() {
         if (!sectorSelect) return;
         try {
-            const data = await fetchAPI('/api/stock/sectors');
+            const sectors = await fetchAPI('/api/stock/sectors');
             let html = '<option value="">請選擇類股</option>';
-            data.data.forEach(s => {
+            sectors.forEach(s => {
                 html += `<option value="${s}">${s}</option>`;
             });
             sectorSelect.innerHTML = html;
@@ -167,118 +221,185 @@ document.addEventListener('DOMContentLoaded', () => {
 
     if (scanSectorBtn) {
         scanSectorBtn.addEventListener('click', async () => {
+            // 類股掃描進行中時，按鈕作為取消鍵
+            if (activeJob) {
+                cancelScanJob();
+                return;
+            }
+
             const sector = sectorSelect.value;
             if (!sector) {
                 alert('請先選擇一個類股！');
                 return;
             }
 
-            const checkedBoxes = Array.from(document.querySelectorAll('input[name="condition"]:checked'));
-            const conditions = checkedBoxes.map(cb => cb.value);
-            if (conditions.length === 0) {
-                alert('請至少勾選一個過濾條件！');
+            const criteria = collectCriteria();
+            if (!criteria) return;
+
+            runScanJob(scanSectorBtn, { stock_ids: [], sector: sector, ...criteria });
+        });
+    }
+
+    loadSectors();
+
+    // ==========================================
+    // 4. 背景選股工作 (大範圍掃描：送出 → 輪詢進度與結果 → 可取消)
+    // ==========================================
+
+    const JOB_POLL_MS = 1000;
+    // 進行中的類股掃描：{ id, subscriber, cancelled }；送出請求尚未回應時 id 為 null
+    let activeJob = null;
+
+    async function runScanJob(btn, body) {
+        const originalText = btn.innerHTML;
+        btn.innerHTML = '送出掃描... 點此取消';
+        resetResults();
+        // 送出前就進入進行中狀態，回應前再按一次是取消而不是重複送出
+        const current = activeJob = { id: null, subscriber: null, cancelled: false };
+
+        try {
+            const job = await fetchAPI('/api/stock/screen/jobs', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify(body),
+                fullResponse: true
+            });
+            current.id = job.data.job_id;
+            current.subscriber = job.subscriber;
+            if (current.cancelled) {
+                cancelScanJob();
+                showToast('已取消類股掃描', 'info');
                 return;
             }
 
-            const originalText = scanSectorBtn.innerHTML;
-            scanSectorBtn.innerHTML = '掃描運算中... <span class="pulse-icon">⏳</span>';
-            scanSectorBtn.disabled = true;
-            resultContainer.style.display = 'none';
-
-            try {
-                const resData = await fetchAPI('/api/stock/screen', {
-                    method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify({
-                        stock_ids: [],
-                        sector: sector,
-                        conditions: conditions
-                    })
-                });
-                renderResults(resData.data);
-            } catch (error) {
-                console.error('類股掃描失敗:', error);
-                // 錯誤已由 fetchAPI 處理
-            } finally {
-                scanSectorBtn.innerHTML = originalText;
-                scanSectorBtn.disabled = false;
+            // 依序讀取新增的結果列；伺服器端以輪詢判斷用戶端仍在，停止輪詢的訂閱會被自動移除
+            let offset = 0;
+            for (;;) {
+                const page = await fetchAPI(`/api/stock/screen/jobs/${current.id}/results?offset=${offset}&limit=500&subscriber=${current.subscriber}`, { fullResponse: true });
+                page.data.forEach(appendResult);
+                offset = page.next_offset;
+                const progress = page.job;
+                if (current.cancelled || (progress.status !== 'running' && offset >= progress.matches)) {
+                    finishResults(offset);
+                    if (current.cancelled || progress.status === 'cancelled') showToast('已取消類股掃描', 'info');
+                    if (progress.status === 'error') showToast('掃描發生錯誤，結果可能不完整', 'error');
+                    break;
+                }
+                btn.innerHTML = `掃描中 ${progress.scanned}/${progress.total}（符合 ${progress.matches}）點此取消`;
+                if (page.data.length < 500) await new Promise(r => setTimeout(r, JOB_POLL_MS));
             }
-        });
+        } catch (error) {
+            console.error('類股掃描失敗:', error);
+            // 錯誤已由 fetchAPI 處理
+        } finally {
+            activeJob = null;
+            btn.innerHTML = originalText;
+        }
     }
 
-    loadSectors();
+    /**
+     * 退出目前的類股掃描；其他分頁 / 用戶端共用同一工作時，只有最後一個退出才會真正取消
+     */
+    function cancelScanJob(keepalive = false) {
+        if (!activeJob) return;
+        activeJob.cancelled = true;
+        if (!activeJob.id) return; // 送出請求尚未回應，取得工作代號後再退出
+        fetch(`/api/stock/screen/jobs/${activeJob.id}?subscriber=${activeJob.subscriber}`, { method: 'DELETE', keepalive }).catch(() => { });
+    }
 
-    function renderResults(results) {
-        resultContainer.style.display = 'block';
-        resultCount.textContent = results.length;
+    // 離開頁面時退出進行中的工作，避免繼續消耗上游額度
+    window.addEventListener('pagehide', () => cancelScanJob(true));
+
+    function resetResults() {
+        resultBody.innerHTML = '';
+        resultCount.textContent = 0;
+        resultContainer.style.display = 'none';
+    }
 
-        if (results.length === 0) {
+    function finishResults(count) {
+        resultContainer.style.display = 'block';
+        resultCount.textContent = count;
+        if (count === 0) {
             resultBody.innerHTML = `<tr><td colspan="6" class="empty-state-row">沒有符合條件的股票</td></tr>`;
-            return;
         }
+    }
 
-        let html = '';
-        results.forEach(r => {
-            const priceColor = r.close > r.ma20 ? '#ef4444' : '#10b981'; // 假設大於MA為紅
-
-            // 處理判斷邏輯顯示文字與樣式
-            const ma20Class = r.close > r.ma20 ? 'color:var(--accent-red)' : 'color:var(--accent-green)';
-            const ma20Text = r.close > r.ma20 ? '站上月線' : '跌破月線';
-
-            let kdState = '整理中';
-            let kdClass = 'status-badge neutral';
-            if (r.k > r.d && r.k < 80) {
-                kdState = '多頭發散';
-                kdClass = 'status-badge bullish';
-            } else if (r.k < r.d && r.k > 20) {
-                kdState = '空頭發散';
-                kdClass = 'status-badge bearish';
-            } else if (r.k >= 80) {
-                kdState = '高檔超買';
-                kdClass = 'status-badge bearish';
-            } else if (r.k <= 20) {
-                kdState = '低檔超賣';
-                kdClass = 'status-badge bullish';
-            }
+    function appendResult(r) {
+        const first = resultContainer.style.display === 'none';
+        resultContainer.style.display = 'block';
+        resultCount.textContent = Number(resultCount.textContent) + 1;
+        resultBody.insertAdjacentHTML('beforeend', resultRowHtml(r));
+        // 第一筆結果出現時捲動到結果區
+        if (first) resultContainer.scrollIntoView({ behavior: 'smooth', block: 'start' });
+    }
 
-            // 籌碼情境處理
-            let chipHtml = '<span style="color:#64748b">—</span>';
-            if (r.chip_scenario) {
-                let badgeClass = 'neutral';
-                let icon = '🧊';
-                if (r.chip_scenario === '黃金交叉') { badgeClass = 'bullish'; icon = '🔥'; }
-                else if (r.chip_scenario === '死亡交叉') { badgeClass = 'bearish'; icon = '💀'; }
-                else if (r.chip_scenario === '高檔強軋') { badgeClass = 'warning'; icon = '🚀'; }
-
-                let detailHtml = '';
-                if (r.major_diff) {
-                    const mColor = parseFloat(r.major_diff) > 0 ? 'var(--accent-red)' : 'var(--accent-green)';
-                    const rColor = parseFloat(r.retail_diff) > 0 ? 'var(--accent-red)' : 'var(--accent-green)';
-                    detailHtml = `<div style="font-size:11px; margin-top:4px; font-feature-settings: 'tnum';">
-                        大戶 <span style="color:${mColor}">${r.major_diff}</span> | 散戶 <span style="color:${rColor}">${r.retail_diff}</span>
-                    </div>`;
-                }
+    // 運算式用到、但表格沒有的欄位值（例如 rsi、yield、foreign_days）
+    const TABLE_FIELDS = new Set(['close', 'ma20', 'k', 'd', 'major_diff', 'retail_diff']);
 
-                chipHtml = `<div class="status-badge ${badgeClass}">${icon} ${r.chip_scenario}</div>${detailHtml}`;
+    function exprValuesHtml(r) {
+        const items = Object.entries(r.values || {})
+            .filter(([name, v]) => !TABLE_FIELDS.has(name) && v !== null)
+            .map(([name, v]) => `${name} ${Number.isInteger(v) ? v : v.toFixed(2)}`);
+        if (items.length === 0) return '';
+        return `<br><small style="color:#64748b;font-size:10px;">${items.join(' · ')}</small>`;
+    }
+
+    function resultRowHtml(r) {
+        const priceColor = r.close > r.ma20 ? '#ef4444' : '#10b981'; // 假設大於MA為紅
+
+        // 處理判斷邏輯顯示文字與樣式
+        const ma20Class = r.close > r.ma20 ? 'color:var(--accent-red)' : 'color:var(--accent-green)';
+        const ma20Text = r.close > r.ma20 ? '站上月線' : '跌破月線';
+
+        let kdState = '整理中';
+        let kdClass = 'status-badge neutral';
+        if (r.k > r.d && r.k < 80) {
+            kdState = '多頭發散';
+            kdClass = 'status-badge bullish';
+        } else if (r.k < r.d && r.k > 20) {
+            kdState = '空頭發散';
+            kdClass = 'status-badge bearish';
+        } else if (r.k >= 80) {
+            kdState = '高檔超買';
+            kdClass = 'status-badge bearish';
+        } else if (r.k <= 20) {
+            kdState = '低檔超賣';
+            kdClass = 'status-badge bullish';
+        }
+
+        // 籌碼情境處理
+        let chipHtml = '<span style="color:#64748b">—</span>';
+        if (r.chip_scenario) {
+            let badgeClass = 'neutral';
+            let icon = '🧊';
+            if (r.chip_scenario === '黃金交叉') { badgeClass = 'bullish'; icon = '🔥'; }
+            else if (r.chip_scenario === '死亡交叉') { badgeClass = 'bearish'; icon = '💀'; }
+            else if (r.chip_scenario === '高檔強軋') { badgeClass = 'warning'; icon = '🚀'; }
+
+            let detailHtml = '';
+            if (r.major_diff) {
+                const mColor = parseFloat(r.major_diff) > 0 ? 'var(--accent-red)' : 'var(--accent-green)';
+                const rColor = parseFloat(r.retail_diff) > 0 ? 'var(--accent-red)' : 'var(--accent-green)';
+                detailHtml = `<div style="font-size:11px; margin-top:4px; font-feature-settings: 'tnum';">
+                    大戶 <span style="color:${mColor}">${r.major_diff}</span> | 散戶 <span style="color:${rColor}">${r.retail_diff}</span>
+                </div>`;
             }
 
-            html += `
-                <tr>
-                    <td class="result-row-id">${r.stock_id}</td>
-                    <td class="result-row-name">${r.stock_name || 'N/A'}</td>
-                    <td class="text-right result-row-val" style="color:${priceColor}">${r.close.toFixed(2)}</td>
-                    <td class="text-right" style="${ma20Class}">${r.ma20.toFixed(2)}<br><small>${ma20Text}</small></td>
-                    <td class="text-center"><span class="${kdClass}">${kdState}</span><br><small style="color:#64748b;font-size:10px;">K:${r.k.toFixed(1)} D:${r.d.toFixed(1)}</small></td>
-                    <td class="text-center">${chipHtml}</td>
-                    <td class="text-center">
-                        <a href="/stock?id=${r.stock_id}&name=${encodeURIComponent(r.stock_name || '')}" target="_blank" class="result-link">詳情 ↗</a>
-                    </td>
-                </tr>
-            `;
-        });
-        resultBody.innerHTML = html;
+            chipHtml = `<div class="status-badge ${badgeClass}">${icon} ${r.chip_scenario}</div>${detailHtml}`;
+        }
 
-        // 滾動到結果區
-        resultContainer.scrollIntoView({ behavior: 'smooth', block: 'start' });
+        return `
+            <tr>
+                <td class="result-row-id">${r.stock_id}</td>
+                <td class="result-row-name">${r.stock_name || 'N/A'}${exprValuesHtml(r)}</td>
+                <td class="text-right result-row-val" style="color:${priceColor}">${r.close.toFixed(2)}</td>
+                <td class="text-right" style="${ma20Class}">${r.ma20.toFixed(2)}<br><small>${ma20Text}</small></td>
+                <td class="text-center"><span class="${kdClass}">${kdState}</span><br><small style="color:#64748b;font-size:10px;">K:${r.k.toFixed(1)} D:${r.d.toFixed(1)}</small></td>
+                <td class="text-center">${chipHtml}</td>
+                <td class="text-center">
+                    <a href="/stock?id=${r.stock_id}&name=${encodeURIComponent(r.stock_name || '')}" target="_blank" class="result-link">詳情 ↗</a>
+                </td>
+            </tr>
+        `;
     }
 });
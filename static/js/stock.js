@@ -199,117 +199,177 @@ function getYearAgoDate(years) {
 // （已將 fetchAPI 移至獨立的 api.js 共用模組）
 
 // ============================================================
-// 資料載入（分批 + retry）
+// 資料載入（資料包串流 + 個別 API 備援）
 // ============================================================
 
-async function loadAllData() {
-    const { start, end } = getDateRange();
-    const id = state.stockId;
-
-    showLoading('klineChart');
-    showLoading('indicatorChart');
+// 資料包區塊 → 個別 API（資料包失敗或區塊逾時時的備援）
+function sectionRequests(id, start, end) {
+    return {
+        chart: [`/api/stock/chart-data?id=${id}&start=${start}&end=${end}&realtime=1`, {}],
+        per: [`/api/stock/per?id=${id}`, {}],
+        institutional: [`/api/stock/institutional?id=${id}&start=${start}&end=${end}`, { retries: 1, fullResponse: true, throwOnError: false }],
+        holders: [`/api/stock/holders?id=${id}`, { throwOnError: false }],
+        margin: [`/api/stock/margin?id=${id}&start=${start}&end=${end}`, { throwOnError: false }],
+        shareholding: [`/api/stock/shareholding?id=${id}&start=${start}&end=${end}`, { throwOnError: false }],
+        revenue: [`/api/stock/revenue?id=${id}`, { throwOnError: false }],
+        financial: [`/api/stock/financial?id=${id}`, { throwOnError: false }],
+        balance_sheet: [`/api/stock/balance-sheet?id=${id}`, { throwOnError: false }],
+        price: [`/api/stock/price?id=${id}&start=${getYearAgoDate(2)}&end=${end}`, { throwOnError: false }],
+        adjusted_factors: [`/api/stock/adjusted-factors?id=${id}`, { throwOnError: false }], // 除權息還原系數
+    };
+}
 
-    try {
-        // 第一批：最重要的資料（K線 + 指標 + PER）
-        const [chartResp, perResp] = await Promise.all([
-            fetchAPI(`/api/stock/chart-data?id=${id}&start=${start}&end=${end}&realtime=1`),
-            fetchAPI(`/api/stock/per?id=${id}`),
-        ]);
-
-        if (chartResp && chartResp.price && chartResp.price.length > 0) {
-            const priceData = chartResp.price;
-            const indResp = chartResp.indicators;
-            const latest = priceData[priceData.length - 1];
-            const prev = priceData.length > 1 ? priceData[priceData.length - 2] : latest;
-
-            if (chartResp.name && !state.stockName) {
-                state.stockName = chartResp.name;
-                document.getElementById('stockName').textContent = chartResp.name;
-                document.title = `${chartResp.name} (${id}) — 台股資訊查詢`;
-            }
+// 區塊渲染器：needs 中的區塊都到齊（失敗者為 null）後渲染一次
+const SECTION_RENDERERS = [
+    { needs: ['chart'], render: s => renderChartSection(s.chart) },
+    { needs: ['chart', 'per'], render: s => {
+        const priceData = s.chart?.price;
+        if (priceData && priceData.length > 0) updateInfoCards(priceData[priceData.length - 1], s.per);
+    } },
+    { needs: ['chart', 'adjusted_factors'], render: s => {
+        // 儲存原始除權息與股價備用
+        originalPriceData = s.chart?.price;
+        adjustedFactorsData = s.adjusted_factors;
+        currentIndicatorsResp = s.chart?.indicators;
+    } },
+    { needs: ['chart', 'institutional', 'shareholding'], render: s => {
+        // institutional 是完整 JSON { status, data, consecutive }
+        const inst = s.institutional;
+        if (inst && inst.data) {
+            renderInstitutionalTables(inst.data, inst.consecutive, s.shareholding, s.chart?.price);
+            // 由於沒有大戶持股，以法人資料代為計算短線籌碼集中度
+            renderConcentrationChart(inst.data, s.chart?.price);
+        }
+    } },
+    { needs: ['margin'], render: s => { if (s.margin) renderMarginChart(s.margin); } },
+    { needs: ['holders'], render: s => {
+        const hData = Array.isArray(s.holders) ? s.holders : (s.holders?.data || []);
+        if (hData.length > 0) {
+            renderHoldersChart(hData);
+            renderHoldersTable(hData);
+        }
+    } },
+    { needs: ['financial', 'price', 'adjusted_factors'], render: s => {
+        if (s.financial) renderEpsTable(s.financial, s.price, s.adjusted_factors);
+    } },
+    { needs: ['revenue'], render: s => { if (s.revenue) renderRevenueTable(s.revenue); } },
+    { needs: ['financial', 'balance_sheet'], render: s => {
+        if (s.financial && s.balance_sheet) {
+            renderProfitabilityMatrix(s.financial, s.balance_sheet);
+            renderDupontAnalysis(s.financial, s.balance_sheet);
+        }
+    } },
+];
 
-            updatePriceDisplay(latest, prev);
-            updateInfoCards(latest, perResp);
+function renderChartSection(chartResp) {
+    if (!chartResp || !chartResp.price || chartResp.price.length === 0) {
+        showToast('資料載入失敗，請重試', 'error');
+        return;
+    }
+    const id = state.stockId;
+    const priceData = chartResp.price;
+    const indResp = chartResp.indicators;
+    const latest = priceData[priceData.length - 1];
+    const prev = priceData.length > 1 ? priceData[priceData.length - 2] : latest;
+
+    if (chartResp.name && !state.stockName) {
+        state.stockName = chartResp.name;
+        document.getElementById('stockName').textContent = chartResp.name;
+        document.title = `${chartResp.name} (${id}) — 台股資訊查詢`;
+    }
 
-            // 顯示資料截至日期
-            const dataDateEl = document.getElementById('dataDate');
-            if (dataDateEl) {
-                dataDateEl.textContent = `資料截至 ${latest.date}`;
-            }
+    updatePriceDisplay(latest, prev);
 
-            if (indResp) {
-                initKlineChart(priceData, indResp);
-                initIndicatorChart(indResp);
-                const k1 = ChartManager.get('klineChart');
-                const i1 = ChartManager.get('indicatorChart');
-                if (k1 && i1) {
-                    echarts.connect([k1, i1]);
-                }
-            }
+    // 顯示資料截至日期
+    const dataDateEl = document.getElementById('dataDate');
+    if (dataDateEl) {
+        dataDateEl.textContent = `資料截至 ${latest.date}`;
+    }
 
-            // 啟動即時報價輪詢
-            if (typeof startRealtimePolling === 'function') {
-                startRealtimePolling(id);
-            }
+    if (indResp) {
+        initKlineChart(priceData, indResp);
+        initIndicatorChart(indResp);
+        const k1 = ChartManager.get('klineChart');
+        const i1 = ChartManager.get('indicatorChart');
+        if (k1 && i1) {
+            echarts.connect([k1, i1]);
         }
+    }
 
-        // 第二批：延遲載入籌碼面 + 基本面（降低 API 壓力）
-        setTimeout(async () => {
-            try {
-                const [instResp, holdResp, marginResp, shareResp, divResp, revResp, finResp, bsResp, longPriceResp, adjResp] = await Promise.all([
-                    fetchAPI(`/api/stock/institutional?id=${id}&start=${start}&end=${end}`, { retries: 1, fullResponse: true, throwOnError: false }),
-                    fetchAPI(`/api/stock/holders?id=${id}`, { throwOnError: false }),
-                    fetchAPI(`/api/stock/margin?id=${id}&start=${start}&end=${end}`, { throwOnError: false }),
-                    fetchAPI(`/api/stock/shareholding?id=${id}&start=${start}&end=${end}`, { throwOnError: false }),
-                    fetchAPI(`/api/stock/dividend?id=${id}`, { throwOnError: false }),
-                    fetchAPI(`/api/stock/revenue?id=${id}`, { throwOnError: false }),
-                    fetchAPI(`/api/stock/financial?id=${id}`, { throwOnError: false }),
-                    fetchAPI(`/api/stock/balance-sheet?id=${id}`, { throwOnError: false }),
-                    fetchAPI(`/api/stock/price?id=${id}&start=${getYearAgoDate(2)}&end=${end}`, { throwOnError: false }),
-                    fetchAPI(`/api/stock/adjusted-factors?id=${id}`, { throwOnError: false }) // 新增除權息還原系數
-                ]);
-
-                // 儲存原始除權息與股價備用
-                originalPriceData = chartResp?.price;
-                adjustedFactorsData = adjResp;
-                currentIndicatorsResp = chartResp?.indicators;
-
-                // instResp 是完整 JSON { status, data, consecutive }
-                if (instResp && instResp.data) {
-                    renderInstitutionalTables(instResp.data, instResp.consecutive, shareResp, chartResp?.price);
-                    // 由於沒有大戶持股，以法人資料代為計算短線籌碼集中度
-                    renderConcentrationChart(instResp.data, chartResp?.price);
-                }
-                if (marginResp) renderMarginChart(marginResp);
-
-                if (holdResp) {
-                    // 若 holdResp 是陣列，代表 fetchAPI 已經幫忙解構出 data
-                    // 若它是物件而且有 data 屬性，就取 data
-                    const hData = Array.isArray(holdResp) ? holdResp : (holdResp.data || []);
-                    if (hData.length > 0) {
-                        renderHoldersChart(hData);
-                        renderHoldersTable(hData);
-                    }
-                }
+    // 啟動即時報價輪詢
+    if (typeof startRealtimePolling === 'function') {
+        startRealtimePolling(id);
+    }
+}
 
-                if (finResp) renderEpsTable(finResp, longPriceResp || priceResp?.data || priceResp, adjResp);
-                if (revResp) renderRevenueTable(revResp);
-                if (finResp && bsResp) {
-                    renderProfitabilityMatrix(finResp, bsResp);
-                    renderDupontAnalysis(finResp, bsResp);
-                }
+async function loadAllData() {
+    const { start, end } = getDateRange();
+    const id = state.stockId;
+    const requests = sectionRequests(id, start, end);
+    const sections = {};
+    const rendered = new Set();
+
+    showLoading('klineChart');
+    showLoading('indicatorChart');
 
-                // 統一 resize 處理（籌碼面 + 基本面圖表）
-                setupChartResize();
+    const onSection = (name, value) => {
+        sections[name] = value;
+        SECTION_RENDERERS.forEach((r, i) => {
+            if (rendered.has(i) || !r.needs.every(n => n in sections)) return;
+            rendered.add(i);
+            try {
+                r.render(sections);
             } catch (err) {
-                console.error('籌碼面/基本面資料載入錯誤:', err);
+                console.error(`區塊渲染錯誤 (${r.needs.join(',')}):`, err);
             }
-        }, 500);
+        });
+    };
+    const fetchSection = async (name) => {
+        const [url, opts] = requests[name];
+        let value = null;
+        try {
+            value = await fetchAPI(url, opts);
+        } catch (err) {
+            console.error(`載入 ${name} 失敗:`, err);
+        }
+        onSection(name, value);
+    };
 
+    // 單一連線串流所有區塊，到一個畫一個
+    const names = Object.keys(requests);
+    const retry = [];
+    try {
+        const qs = `id=${id}&start=${start}&end=${end}&price_start=${getYearAgoDate(2)}&realtime=1&sections=${names.join(',')}`;
+        await fetchNDJSON(`/api/stock/bundle?${qs}`, line => {
+            if (!line.section) return;
+            if (line.status === 'timeout') {
+                retry.push(line.section);
+            } else if (line.status !== 'ok') {
+                onSection(line.section, null);
+            } else if (line.section === 'institutional') {
+                onSection(line.section, line);
+            } else {
+                onSection(line.section, line.data);
+            }
+        });
     } catch (err) {
-        console.error('載入資料錯誤:', err);
-        showToast('資料載入失敗，請重試', 'error');
+        console.warn('資料包載入失敗，改用個別 API:', err);
     }
+
+    // 逾時或未送達的區塊改打個別 API（K 線與 PER 先，其餘延遲以降低 API 壓力）
+    const missing = names.filter(n => !(n in sections) && !retry.includes(n)).concat(retry);
+    if (missing.length > 0) {
+        const first = missing.filter(n => n === 'chart' || n === 'per');
+        await Promise.all(first.map(fetchSection));
+        const rest = missing.filter(n => !first.includes(n));
+        if (rest.length > 0) {
+            await new Promise(r => setTimeout(r, 500));
+            await Promise.all(rest.map(fetchSection));
+        }
+    }
+
+    // 統一 resize 處理（籌碼面 + 基本面圖表）
+    setupChartResize();
 }
 
 // ============================================================
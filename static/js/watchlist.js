@@ -32,6 +32,7 @@ const WatchlistDB = {
         // 確保為唯一且字串、無空值
         const uniqueList = [...new Set(list)].filter(Boolean).map(String);
         localStorage.setItem(WATCHLIST_KEY, JSON.stringify(uniqueList));
+        if (typeof syncWarmWatchlist === 'function') syncWarmWatchlist(uniqueList);
     },
 
     /**
@@ -66,6 +67,15 @@ const WatchlistDB = {
         return list.includes(String(stockId));
     },
 
+    /**
+     * 一次取得整份自選股的即時報價（後端以批次查詢，回傳 { stock_id: 報價 }）
+     */
+    quotes: async function (list = this.get()) {
+        if (!list.length) return {};
+        const res = await fetchAPI(`/api/stock/realtime?ids=${list.join(',')}`, { throwOnError: false });
+        return res || {};
+    },
+
     /**
      * 恢復預設
      */